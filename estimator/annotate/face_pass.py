@@ -1,10 +1,11 @@
 from .base_pass import BasePass
 from .miscellaneous import require_context, dump_json, format_number
 
+from runtime.container import ImageReader
 from runtime.es_config import EsConfig, EsConfigFns
 from runtime.facealign import FaceAlignment
 from runtime.inference import Inferencer
-from runtime.pipeline import load_model
+from runtime.pipeline import facenet_input, load_model
 from runtime.transform import Transforms
 
 import cv2
@@ -136,12 +137,11 @@ def aligned_face(image: np.ndarray, landmarks: np.ndarray):
 
   return face_patch
 
-def embeded_face(image: np.ndarray, model: onnxruntime.InferenceSession):
+def embeded_face(image: np.ndarray, model: onnxruntime.InferenceSession, buffer: np.ndarray = None):
   '''Embed croped face image into 512-D vector, produced by FaceNet model.'''
 
-  ort_ipt = np.transpose(image, (2, 0, 1)).astype(np.float32)
-  ort_ipt = np.expand_dims((ort_ipt - 127.5) / 128.0, axis=0)
-  ort_opt = np.squeeze(model.run(None, {'img': ort_ipt})[0])
+  # Outputs of bound sessions are overwritten by the next run
+  ort_opt = np.squeeze(model.run(None, facenet_input(image, buffer))[0]).copy()
 
   return ort_opt
 
@@ -167,13 +167,8 @@ class MpInferencer(Inferencer):
     if to_rgb: image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     landmarks, theta = align.process(image)
     if self._validate(image, landmarks):
-      crops, norm_ldmks, _ = align.get_face_crop(
-        image, landmarks, theta, hw_ratio=self.hw_ratio,
-      )
-      pog_scn, pog_cam = self.predict_fn(
-        model, crops, norm_ldmks, theta,
-        gx_filter=self.gx_filter, gy_filter=self.gy_filter,
-      )
+      model_input = self.prepare_input(align, image, landmarks, theta)
+      pog_scn, pog_cam = self.project_output(self.predict_output(model, model_input), theta)
       result.update(success=True, pog_cam=pog_cam, mesh=landmarks)
 
     return result
@@ -208,12 +203,16 @@ class FaceDetectPass(BasePass):
   def before_pass(self, context: dict, **kwargs):
     self.model = load_model(self.model_config_path, **self.checkpoint_cfg)
 
-    self.transforms = Transforms(**self.transforms_cfg)
+    self.transforms = Transforms(**self.transforms_cfg).compile(to_rgb=True)
     self.alignment = FaceAlignment(**self.alignment_cfg)
     self.inferencer = MpInferencer(**self.inferencer_cfg)
+    self.inferencer.use_model(self.model)
+
+    self.images = ImageReader(osp.join(self.recording_path, 'images'))
 
   def after_pass(self, context: dict, **kwargs):
     self.alignment.close()
+    self.images.close()
 
   def collect_data(self, context: dict, **kwargs):
     return context['targets']
@@ -222,10 +221,9 @@ class FaceDetectPass(BasePass):
     image_names = [f'{fid:05d}.jpg' for fid in data['fids']]
 
     for image_name in image_names:
-      image_path = osp.join(self.recording_path, 'images', image_name)
-      image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+      image = self.images.read(image_name)
       image_mp = self.transforms.transform(image)
-      result = self.inferencer.run(self.model, self.alignment, image_mp)
+      result = self.inferencer.run(self.model, self.alignment, image_mp, to_rgb=False)
 
       if result['success']:
         mesh = adjusted_mesh(image, image_mp, result['mesh'])
@@ -256,6 +254,8 @@ class FaceEmbedPass(BasePass):
     self.recording_path = recording_path
 
     self.model_config_path = EsConfigFns.get_config_path(an_config)
+    self.model_variant = EsConfigFns.named_dict(an_config, 'checkpoint').get('variant', '')
+    self.io_binding = EsConfigFns.named_dict(an_config, 'checkpoint').get('io_binding', False)
 
   def before_pass(self, context: dict, **kwargs):
     self.embeds_folder = osp.join(self.recording_path, 'embeds')
@@ -265,11 +265,18 @@ class FaceEmbedPass(BasePass):
     os.makedirs(self.faces_folder, exist_ok=True)
 
     facenet_path = osp.join('resources', 'facenet.onnx')
-    self.facenet = load_model(self.model_config_path, facenet_path)
+    self.facenet = load_model(
+      self.model_config_path, facenet_path,
+      variant=self.model_variant, io_binding=self.io_binding,
+    )
+    self.facenet_buffer = np.empty((1, 3, 160, 160), dtype=np.float32)
 
     self.embeds = dict()  # Image -> Embedding
+    self.images = ImageReader(osp.join(self.recording_path, 'images'))
 
   def after_pass(self, context: dict, **kwargs):
+    self.images.close()
+
     embeds = np.array([(n, e) for n, e in self.embeds.items()], dtype=self.EMBED_DTYPE)
 
     embeds_path = osp.join(self.embeds_folder, 'embeds.npy')
@@ -285,8 +292,7 @@ class FaceEmbedPass(BasePass):
       sample_dict = context['samples'][image_name]
       if not sample_dict['face_mesh']: continue
 
-      image_path = osp.join(self.recording_path, 'images', image_name)
-      image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+      image = self.images.read(image_name)
 
       mesh_name = image_name.replace('.jpg', '.npy')
       mesh_path = osp.join(self.recording_path, 'meshes', mesh_name)
@@ -296,7 +302,7 @@ class FaceEmbedPass(BasePass):
       face_path = osp.join(self.faces_folder, image_name)
       cv2.imwrite(face_path, face)
 
-      embed = embeded_face(face, self.facenet)
+      embed = embeded_face(face, self.facenet, self.facenet_buffer)
       self.embeds[image_name] = embed
 
   def run(self, context: dict, **kwargs):
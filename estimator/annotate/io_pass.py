@@ -1,7 +1,9 @@
 from .base_pass import BasePass
 from .miscellaneous import load_json
 
+from runtime.container import export_chunks, is_chunked, remove_chunks
 from runtime.es_config import EsConfig
+from runtime.storage import load_label_journal
 
 import os.path as osp
 
@@ -15,4 +17,24 @@ class LoadTargetsPass(BasePass):
 
   def run(self, context: dict, **kwargs):
     json_path = osp.join(self.recording_path, 'labels', 'targets.json')
-    context['targets'] = load_json(json_path)
+    if osp.exists(json_path):
+      context['targets'] = load_json(json_path)
+    else:  # Labels journal, not compacted due to a crash
+      context['targets'] = load_label_journal(json_path + 'l')
+
+
+class ExportImagesPass(BasePass):
+
+  PASS_NAME = 'io_pass.export_images'
+
+  def __init__(self, recording_path: str, an_config: EsConfig):
+    self.recording_path = recording_path
+
+  def run(self, **kwargs):
+    # Frames appended to chunk files are exported as image files in place,
+    # chunk files are removed once all frames are exported, so that frames
+    # are kept once and read from the image files from then on
+    images_folder = osp.join(self.recording_path, 'images')
+    if is_chunked(images_folder):
+      export_chunks(images_folder, images_folder)
+      remove_chunks(images_folder)
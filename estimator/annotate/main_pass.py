@@ -1,7 +1,7 @@
 from .base_pass import BasePass
 from .data_pass import LoadSamplesPass, SaveSamplesPass
 from .face_pass import FaceDetectPass, FaceEmbedPass, FaceVerifyPass
-from .io_pass import LoadTargetsPass
+from .io_pass import ExportImagesPass, LoadTargetsPass
 from .mgmt_pass import ReorganizeFolderPass, RestoreFolderPass
 from .out_pass import LocalOutlierPass
 from .vis_pass import VisualizePass
@@ -20,6 +20,7 @@ IMPLEMENTED_PASSES = [
   FaceDetectPass,
   FaceEmbedPass,
   FaceVerifyPass,
+  ExportImagesPass,
   LoadTargetsPass,
   ReorganizeFolderPass,
   RestoreFolderPass,
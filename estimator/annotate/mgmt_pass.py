@@ -29,9 +29,12 @@ class ReorganizeFolderPass(BasePass):
     meshes_folder = osp.join(temp_folder, 'meshes')
     os.makedirs(meshes_folder, exist_ok=True)
 
-    labels_src_path = osp.join(self.recording_path, 'labels.json')
-    labels_dst_path = osp.join(labels_folder, 'targets.json')
-    shutil.move(labels_src_path, labels_dst_path)
+    # Recordings interrupted by a crash only have the labels journal
+    for labels_ext in ['.json', '.jsonl']:
+      labels_src_path = osp.join(self.recording_path, f'labels{labels_ext}')
+      labels_dst_path = osp.join(labels_folder, f'targets{labels_ext}')
+      if osp.exists(labels_src_path):
+        shutil.move(labels_src_path, labels_dst_path)
 
     # Create images folder by moving and renaming
     shutil.move(self.recording_path, temp_folder)
@@ -61,9 +64,11 @@ class RestoreFolderPass(BasePass):
     shutil.move(images_src_folder, temp_folder)
 
     # Restore original label file by moving and renaming
-    labels_src_path = osp.join(self.recording_path, 'labels', 'targets.json')
-    labels_dst_path = osp.join(temp_folder, 'labels.json')
-    shutil.move(labels_src_path, labels_dst_path)
+    for labels_ext in ['.json', '.jsonl']:
+      labels_src_path = osp.join(self.recording_path, 'labels', f'targets{labels_ext}')
+      labels_dst_path = osp.join(temp_folder, f'labels{labels_ext}')
+      if osp.exists(labels_src_path):
+        shutil.move(labels_src_path, labels_dst_path)
 
     # Remove reorganized recording folder
     shutil.rmtree(self.recording_path, ignore_errors=False)
@@ -1,6 +1,7 @@
 from .base_pass import BasePass
 from .miscellaneous import require_context
 
+from runtime.container import ImageReader
 from runtime.es_config import EsConfig, EsConfigFns
 
 import functools
@@ -62,7 +63,8 @@ def function_plot_frame(frame_params, context, fig, ax_image, ax_label):
   '''Visualize the status of each frame with functional animation backend
 
   Note that the frame_params contains the following parameters:
-    - image_path: path to the image captured when gazing at the target
+    - images: image reader of the recording
+    - image_name: name of the image captured when gazing at the target
     - target: target location, aka. groundtruth
     - pseudo: pseudo-label location, used for outlier detection
     - inlier: whether the current frame is treated as an inlier
@@ -73,7 +75,8 @@ def function_plot_frame(frame_params, context, fig, ax_image, ax_label):
   '''
 
   # Display the image captured when gazing at the target
-  context.display_image(ax_image, plt.imread(frame_params['image_path']))
+  image = frame_params['images'].read(frame_params['image_name'])
+  context.display_image(ax_image, image[..., ::-1])  # BGR -> RGB
 
   # Display all the pseudo-labels for current target (gray dots)
   inlier, pseudos = frame_params['inlier'], frame_params['pseudos']
@@ -195,6 +198,7 @@ class VisualizePass(BasePass):
     fig, ax_image, ax_label = create_preview_plots(self.pass_config)
     self.plots = dict(fig=fig, ax_image=ax_image, ax_label=ax_label)
     self.frame_params = []  # Params of each frame
+    self.images = ImageReader(osp.join(self.recording_path, 'images'))
 
   def after_pass(self, context: dict, **kwargs):
     anim_path = osp.join(self.recording_path, 'labels', 'samples.mp4')
@@ -204,6 +208,7 @@ class VisualizePass(BasePass):
     ).save(anim_path, writer='ffmpeg')
 
     close_preview_plots(self.plots['fig'])
+    self.images.close()
 
   def collect_data(self, context: dict, **kwargs):
     return context['targets']
@@ -211,8 +216,6 @@ class VisualizePass(BasePass):
   def process_data(self, data, context: dict, **kwargs):
     image_names = [f'{fid:05d}.jpg' for fid in data['fids']]
 
-    images_folder = osp.join(self.recording_path, 'images')
-
     pseudos = list()  # Pseudo-labels for current target
     for image_name in image_names:
       sample_dict = context['samples'][image_name]
@@ -224,7 +227,7 @@ class VisualizePass(BasePass):
       sample_dict = context['samples'][image_name]
 
       self.frame_params.append(dict(
-        image_path=osp.join(images_folder, image_name),
+        images=self.images, image_name=image_name,
         target=sample_dict['target_xy'],
         pseudo=sample_dict['pseudo_xy'],
         inlier=sample_dict['inlier'],
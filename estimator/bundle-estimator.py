@@ -11,7 +11,7 @@ from runtime.es_config import EsConfig, EsConfigFns
 from runtime.log import runtime_logger
 from runtime.server import http_server
 
-from estimator import websocket_handler, run_http_server, run_websocket_server
+from estimator import CameraHub, websocket_handler, run_http_server, run_websocket_server
 
 import argparse
 import functools
@@ -46,8 +46,12 @@ def entry_server_mode(config_updater_path):
     webbrowser.open(game_url, new=2, autoraise=True)
   rt_logger.info(f'serving eye shooting game on {game_url}')
 
-  ws_handler = functools.partial(websocket_handler, es_config=es_config)
+  hub = CameraHub(es_config)  # Shared by all connections
+  if hub.persistent: hub.start()
+
+  ws_handler = functools.partial(websocket_handler, hub=hub, es_config=es_config)
   run_websocket_server(ws_handler, httpd, **ws_server_addr)
+  hub.stop()
 
   http_thread.join()
 
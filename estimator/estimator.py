@@ -1,12 +1,18 @@
 from runtime.captures import VideoCaptureBuilder, CaptureHandler
 from runtime.es_config import EsConfig, EsConfigFns
 from runtime.facealign import FaceAlignment
+from runtime.framepool import release_frame, retain_frame
 from runtime.inference import Inferencer
 from runtime.log import runtime_logger
-from runtime.pipeline import load_model
+from runtime.pipeline import ModelInputBuffers, do_model_inference, load_model, model_input_layout
 from runtime.preview import *
-from runtime.server import http_server, websocket_server
-from runtime.storage import FrameCache, RecordingManager
+from runtime.protocol import gaze_protocols, pack_gaze_records
+from runtime.replay import ReplayResults, ReplaySource, replay_output_path
+from runtime.ringbuf import ResultRing
+from runtime.server import forward_connection, http_server, websocket_server
+from runtime.stages import StagedExecutor
+from runtime.timing import measure
+from runtime.storage import FrameCache, RecordingManager, RecordingWriter
 from runtime.transform import Transforms
 
 import argparse
@@ -19,6 +25,7 @@ import numpy as np
 import os.path as osp
 import queue
 import threading
+import time
 import webbrowser
 import websockets
 
@@ -27,7 +34,7 @@ rt_logger = runtime_logger(name='estimator')
 
 
 class PreviewFrameConsumer:
-  def __call__(self, src_image, set_exit_cond, pipeline):
+  def __call__(self, src_image, set_exit_cond, pipeline, timestamp=None):
     image, result = pipeline(src_image)
     exit_cond = self.display(image, result)
     set_exit_cond(exit_cond)
@@ -64,9 +71,10 @@ class PreviewFrameConsumer:
     return display_canvas(self.pv_window, canvas, self.pv_mode, self.pv_items)
 
 class ServerFrameConsumer:
-  def __call__(self, src_image, set_exit_cond, pipeline):
+  def __call__(self, src_image, set_exit_cond, pipeline, timestamp=None):
+    timestamp = timestamp if timestamp is not None else time.time()
     result = pipeline(src_image)
-    exit_cond = self.process(src_image, result)
+    exit_cond = self.process(src_image, result, timestamp)  # Capture timestamp
     set_exit_cond(exit_cond)
 
   def __init__(self, open_event, kill_event, sync_result, record_info):
@@ -82,69 +90,234 @@ class ServerFrameConsumer:
     self.open_event.set() # Notify the parent process (websocket server, blocking)
 
     if self.record_info['enable']:
-      self.frame_cache = FrameCache(self.record_info['cache_size'])
-      self.rec_manager = RecordingManager(self.record_info['root'])
+      self.frame_cache = FrameCache(self.record_info['cache_size'], self.record_info['cache_retain'])
+      self.rec_manager = RecordingManager(
+        self.record_info['root'], RecordingWriter(**self.record_info['writer']),
+      )
       self.rec_manager.new_recording(self.record_info['name'])
 
   def __exit__(self, exc_type, exc_val, exc_tb):
     if self.record_info['enable']:
       while not self.record_info['save_queue'].empty():
-        self.save_frame_in_queue(self.record_info['save_queue'])
+        self.save_frame_in_queue(self.record_info['save_queue'], block=True)
+      self.rec_manager.close()
       self.rec_manager.save_label()
+      rt_logger.info('frame cache stats: {hits} hits, {misses} misses, '
+                     '{evictions} evictions'.format(**self.frame_cache.stats()))
 
-  def process(self, src_image, result):
-    self.sync_result(result, self.frame_count)
+  def process(self, src_image, result, timestamp):
+    self.sync_result(result, self.frame_count, timestamp)
 
     if self.record_info['enable']:
       self.frame_cache.insert_frame(src_image, self.frame_count)
-      if not self.record_info['save_queue'].empty():
-        self.save_frame_in_queue(self.record_info['save_queue'])
+      while not self.record_info['save_queue'].empty():
+        if not self.save_frame_in_queue(self.record_info['save_queue']): break
 
     self.frame_count += 1
 
     return self.kill_event.is_set()
 
-  def save_frame_in_queue(self, save_queue):
-    try:  # Fetch save task from save queue
-      result_item = save_queue.get(timeout=0.01)
-      fetched_item = self.frame_cache.fast_fetch(result_item['fid'])
+  def save_frame_in_queue(self, save_queue, block=False):
+    '''Submit a save task to the recording writer, returns False if there is
+    nothing to save, or if the writer is full unless `block` is set.
+    '''
 
-      if fetched_item is not None:
-        if result_item.get('tid', None) is not None:
-          tid, lx, ly = result_item['tid'], result_item['lx'], result_item['ly']
-          self.rec_manager.new_target(tid, lx, ly)
-        self.rec_manager.save_frame(fetched_item)
+    if not block and self.rec_manager.writer.full():
+      self.rec_manager.writer.defer()
+      return False  # Left in the save queue, frames are kept in the cache
 
+    try:  # Fetch save task from save queue
+      result_item = save_queue.get(timeout=0.01) if block else save_queue.get_nowait()
     except queue.Empty:
-      pass  # Nothing to save
+      return False  # Nothing to save
+
+    fetched_item = self.frame_cache.fast_fetch(result_item['fid'])
+
+    if fetched_item is not None:
+      if result_item.get('tid', None) is not None:
+        tid, lx, ly = result_item['tid'], result_item['lx'], result_item['ly']
+        self.rec_manager.new_target(tid, lx, ly)
+      self.rec_manager.save_frame(fetched_item)
+
+    return True
+
+
+class StagedFrameConsumer:
+  def __call__(self, src_image, set_exit_cond, pipeline, timestamp=None):
+    # The pipeline is a staged executor, frames complete a few calls later
+    retain_frame(src_image)  # Kept in the frame pool until completed
+    pipeline.submit(dict(
+      index=self.frame_index, src_image=src_image,
+      timestamp=timestamp if timestamp is not None else time.time(),
+      start=time.perf_counter_ns(), timings=dict(),
+    ))
+    self.frame_index += 1
+
+    for frame in pipeline.completed():
+      self.forward(frame, set_exit_cond)
+
+  def flush(self, set_exit_cond, pipeline):
+    # Frames still in flight once capture ends complete as well
+    for frame in pipeline.drain():
+      self.forward(frame, set_exit_cond)
+
+  def forward(self, frame, set_exit_cond):
+    output = self.output_fn(frame)
+    self.consumer(
+      frame['src_image'], set_exit_cond,
+      pipeline=lambda _: output, timestamp=frame['timestamp'],
+    )
+    release_frame(frame['src_image'])
+
+  def __init__(self, consumer, output_fn):
+    '''Adapter that feeds captured frames to a staged executor, then forwards
+    each completed frame to the wrapped consumer, in capture order.
+
+    `consumer`: the wrapped frame consumer, which receives a pipeline that
+    returns the output of the completed frame.
+
+    `output_fn`: build the pipeline output from the completed frame.
+    '''
+
+    self.consumer = consumer
+    self.output_fn = output_fn
+    self.frame_index = 0
+
+
+def frames_in_flight(stage_count, depth):
+  '''Max number of frames submitted to a staged executor and not yet
+  completed, namely at most one frame running and depth frames waiting for
+  each stage, and one submitted.
+  '''
+
+  return stage_count * (depth + 1) + 1
+
+def create_frame_stages(model, transforms, alignment, inferencer, depth, to_rgb=False):
+  '''Split the frame pipeline into stages that run concurrently on consecutive
+  frames, each frame is a dict passed from one stage to the next.
 
+  `to_rgb`: transform frames into RGB images, unless BGR images are used
+  after the transform stage, such as for previews.
+  '''
 
-def create_server_consumer(es_config, record_info, open_event, kill_event,
-                           next_ready, next_valid, value_bank, value_lock):
-  '''Run camera process and send the estimated PoG to the client.'''
+  # Frames between the crop stage and the model stage use distinct buffers
+  buffers_pool = [
+    ModelInputBuffers(
+      inferencer.crop_sizes['face_size'], inferencer.crop_sizes['eyes_size'],
+      layout=model_input_layout(model),
+    )
+    for _ in range(depth + 2)
+  ]
+
+  def transform_stage(frame):
+    frame['image'] = plan.transform(frame['src_image'])
+    return frame
+
+  def align_stage(frame):
+    frame['rgb'], frame['landmarks'], frame['theta'] = inferencer.align_image(
+      alignment, frame['image'], to_rgb=not plan.to_rgb, timings=frame['timings'],
+    )
+    return frame
+
+  def crop_stage(frame):
+    if len(frame['landmarks']) > 0:
+      buffers = buffers_pool[frame['index'] % len(buffers_pool)]
+      frame['model_input'] = inferencer.prepare_input(
+        alignment, frame['rgb'], frame['landmarks'], frame['theta'],
+        buffers, timings=frame['timings'],
+      )
+    return frame
+
+  def model_stage(frame):
+    if 'model_input' in frame:
+      # Outputs are copied, as bound sessions overwrite them on the next run
+      frame['ort_outputs'] = [np.array(output) for output in inferencer.predict_output(
+        model, frame['model_input'], timings=frame['timings'],
+      )]
+    return frame
+
+  def project_stage(frame):
+    frame['result'] = dict(success=False, stages=frame['timings'], timestamp=frame['timestamp'])
+    if 'ort_outputs' in frame:
+      pog_scn, pog_cam = inferencer.project_output(
+        frame['ort_outputs'], frame['theta'], timings=frame['timings'],
+      )
+      frame['result'].update(dict(
+        success=True, pog_scn=pog_scn, pog_cam=pog_cam,
+        time=(time.perf_counter_ns() - frame['start']) / 1e9,
+      ))
+    inferencer.record_timings(frame['timings'])
+    return frame
+
+  stages = [
+    ('transform', transform_stage),
+    ('align', align_stage),
+    ('crop', crop_stage),
+    ('model', model_stage),
+    ('project', project_stage),
+  ]
+
+  # Transformed images are kept until frames complete
+  plan = transforms.compile(to_rgb=to_rgb, slots=frames_in_flight(len(stages), depth))
+
+  return stages
+
+def run_capture_loop(capture_builder, consumer, pipeline, stages_config,
+                     create_stages=None, output_fn=None):
+  '''Run capture loop with the serial pipeline, or with a staged executor if
+  enabled in `stages_config`, built from stages created by `create_stages`.
+  '''
+
+  if stages_config['enable'] and create_stages is not None:
+    depth = stages_config['depth']
+    stages = create_stages(depth)
+
+    # Captured frames are kept until completed, along with the frame being
+    # read and the latest frame kept by the capture thread, otherwise the
+    # capture falls back to allocating frames once the pool is exhausted
+    pool_size = getattr(capture_builder, 'pool_size', 0)
+    min_pool_size = frames_in_flight(len(stages), depth) + 2
+    if 0 < pool_size < min_pool_size:
+      rt_logger.info(f'capture pool size raised from {pool_size} to {min_pool_size}, '
+                     f'the number of frames in flight for {len(stages)} stages of depth {depth}')
+      capture_builder.pool_size = min_pool_size
+
+    with StagedExecutor(stages, depth=depth) as executor:
+      staged_consumer = StagedFrameConsumer(consumer, output_fn)
+      capture_handler = CaptureHandler(capture_builder, staged_consumer)
+      capture_handler.main_loop(pipeline=executor)
+
+  else:
+    capture_handler = CaptureHandler(capture_builder, consumer)
+    capture_handler.main_loop(pipeline=pipeline)
 
-  def sync_result(result, frame_count):
-    with value_lock:
-      if result['success'] and result['pog_scn'] is not None:
-        value_bank[0] = result['pog_cam'][0]  # Gaze: x
-        value_bank[1] = result['pog_cam'][1]  # Gaze: y
-        next_valid.value = True     # PoG: valid
-      else:
-        next_valid.value = False
 
-      value_bank[2] = frame_count   # Fid: frame
-    next_ready.set()
+def create_server_worker(es_config, commands, idle_event, open_event, kill_event,
+                         save_queue, result_ring, result_conn):
+  '''Run camera worker process, which loads the model and the face mesh once,
+  then runs a capture round for each record info received from `commands`,
+  until `None` is received. Each round lasts until `kill_event` is set.
+  '''
+
+  def sync_result(result, frame_count, timestamp):
+    # Write the result to the ring buffer, stamped with the capture time of
+    # the frame, then notify the websocket server
+    valid = result['success'] and result['pog_scn'] is not None
+    seq = result_ring.write(
+      frame_count, timestamp, valid,
+      result.get('pog_cam', None), result.get('pog_scn', None),
+      result.get('stages', dict()),
+    )
+    result_conn.send(seq)
 
   capture_builder = VideoCaptureBuilder(**EsConfigFns.named_dict(es_config, 'capture'))
-  consumer = ServerFrameConsumer(open_event, kill_event, sync_result, record_info)
+  stages_config = EsConfigFns.named_dict(es_config, 'stages')
 
   if EsConfigFns.record_without_inference(es_config):
     def pipeline(src_image):
       return dict(success=False)
 
-    with consumer:
-      capture_handler = CaptureHandler(capture_builder, consumer)
-      capture_handler.main_loop(pipeline=pipeline)
+    alignment, inferencer, create_stages = None, None, None
 
   else:
     config_path = EsConfigFns.get_config_path(es_config)
@@ -153,20 +326,270 @@ def create_server_consumer(es_config, record_info, open_event, kill_event,
     transforms = Transforms(**EsConfigFns.named_dict(es_config, 'transform'))
     alignment = FaceAlignment(**EsConfigFns.named_dict(es_config, 'alignment'))
     inferencer = Inferencer(**EsConfigFns.named_dict(es_config, 'inference'))
+    inferencer.use_model(model)
+
+    plan = transforms.compile(to_rgb=True)
 
     def pipeline(src_image):
-      image = transforms.transform(src_image)
-      return inferencer.run(model, alignment, image)
+      image = plan.transform(src_image)
+      return inferencer.run(model, alignment, image, to_rgb=False)
+
+    create_stages = functools.partial(
+      create_frame_stages, model, transforms, alignment, inferencer, to_rgb=True,
+    )
+
+  try:  # Serve capture rounds, until the server shuts down
+    while True:
+      idle_event.set()
+      record_info = commands.get()
+      if record_info is None: break
+      idle_event.clear()
+
+      if alignment is not None:
+        alignment.reset()   # Frames from the last round are not tracked
+        inferencer.reset()
+      if record_info['enable']:
+        record_info['save_queue'] = save_queue
+
+      consumer = ServerFrameConsumer(open_event, kill_event, sync_result, record_info)
+      with consumer:
+        run_capture_loop(
+          capture_builder, consumer, pipeline, stages_config,
+          create_stages, output_fn=lambda frame: frame['result'],
+        )
+
+  except KeyboardInterrupt:
+    pass  # Interrupted along with the server
+
+  finally:
+    if alignment is not None:
+      alignment.close()
+
+class GazeSubscriber:
+  def __init__(self, websocket, protocol, queue_size=16):
+    '''A websocket connection subscribed to the results of a camera hub,
+    sent by its own task, so that a slow client never blocks the others.
+
+    `protocol`: gaze protocol of the connection, updated by the client.
+
+    `queue_size`: max number of batches waiting to be sent, the oldest batch
+    is dropped when a new batch arrives on a full queue.
+    '''
+
+    self.websocket = websocket
+    self.protocol = protocol
+
+    self.queue = asyncio.Queue(maxsize=queue_size)
+    self.dropped = 0
+    self.sender_task = None
+
+  def start(self):
+    self.sender_task = asyncio.create_task(self.send_loop())
+
+  def stop(self):
+    if self.sender_task is not None:
+      self.sender_task.cancel()
+    if self.dropped > 0:
+      rt_logger.warning(f'{self.dropped} results dropped for slow client {self.websocket.remote_address}')
+
+  def publish(self, records):
+    '''Queue a batch of results, never blocks.'''
+
+    if self.queue.full():
+      self.dropped += len(self.queue.get_nowait())
+    self.queue.put_nowait(records)
+
+  async def send_loop(self):
+    while True:
+      batches = [await self.queue.get()]
+      while not self.queue.empty():
+        batches.append(self.queue.get_nowait())
+      records = np.concatenate(batches)
+
+      try:
+        await send_gaze_predicts(self.websocket, self.protocol, records)
+      except websockets.ConnectionClosed:
+        break
+
+def wait_for_worker(event, proc, timeout=0.1):
+  '''Wait for an event set by the worker process, unless the worker exits.'''
+
+  while not event.wait(timeout):
+    if not proc.is_alive():
+      raise RuntimeError(f'camera worker exited with code {proc.exitcode}')
+
+class CameraHub:
+  def __init__(self, es_config: EsConfig):
+    '''Camera worker shared by all websocket connections of the server. The
+    worker runs a capture round while at least one connection subscribes to
+    its results, and pauses in between, keeping the model and face mesh
+    loaded. A persistent worker is started (and warmed up) along with the
+    server, otherwise it is started on demand and stopped once unused.
+    '''
+
+    self.es_config = es_config
+    self.persistent = EsConfigFns.persistent_camera(es_config)
+
+    self.worker = dict()  # Worker process and its result channel
+    self.subscribers = set()
+    self.capturing = False
+    self.next_seq = 0
+
+    self.lock = asyncio.Lock()
+
+  def start(self):
+    '''Start the camera worker, which loads the model in the background.'''
+
+    if self.worker: return
+    es_config, worker = self.es_config, self.worker
+
+    worker['commands'] = mp.Queue()
+    worker['save_queue'] = mp.Queue()
+    worker['worker_idle'] = mp.Event()
+    worker['camera_open'] = mp.Event()
+    worker['camera_kill'] = mp.Event()
+
+    # Results written by the worker, which notifies new sequence numbers
+    worker['result_ring'] = ResultRing(EsConfigFns.result_capacity(es_config))
+    result_recv, result_send = mp.Pipe(duplex=False)
+    worker['result_recv'] = result_recv
+    worker['result_thread'] = None
+
+    worker['worker_proc'] = mp.Process(
+      target=create_server_worker,
+      args=(es_config, ),
+      kwargs=dict(
+        commands=worker['commands'],
+        idle_event=worker['worker_idle'],
+        open_event=worker['camera_open'],
+        kill_event=worker['camera_kill'],
+        save_queue=worker['save_queue'],
+        result_ring=worker['result_ring'],
+        result_conn=result_send,
+      ),
+    )
+
+    worker['worker_proc'].start()
+    result_send.close()  # Only the worker writes results
+
+  def stop(self):
+    '''Stop the camera worker, after its current capture round.'''
+
+    worker = self.worker
+
+    if worker.get('worker_proc', None):
+      worker['camera_kill'].set()
+      worker['commands'].put(None)
+      worker['worker_proc'].join()
+      if worker['result_thread'] is not None:
+        worker['result_thread'].join()
+      worker['result_recv'].close()
+      worker['result_ring'].close()
+    worker.clear()
+
+    self.capturing = False
+
+  async def resume(self, record_name):
+    '''Start a capture round on the worker, as soon as it is idle.'''
+
+    resume_start = time.perf_counter()
+
+    self.start()
+    es_config, worker = self.es_config, self.worker
+
+    loop = asyncio.get_running_loop()
+    if worker['result_thread'] is None:
+      on_next_seq = functools.partial(self.on_next_seq, worker['result_ring'])
+      worker['result_thread'] = forward_connection(worker['result_recv'], loop, on_next_seq)
+
+    if EsConfigFns.record_mode(es_config):
+      record_info = dict(
+        enable=True, root=EsConfigFns.record_path(es_config), name=record_name,
+        writer=EsConfigFns.record_writer(es_config),
+        **EsConfigFns.record_cache(es_config),
+      )
+    else:
+      record_info = dict(enable=False)
+
+    # Serve other connections while the worker warms up or finishes a round
+    await loop.run_in_executor(None, wait_for_worker, worker['worker_idle'], worker['worker_proc'])
+
+    worker['camera_kill'].clear()
+    worker['camera_open'].clear()
+    self.next_seq = worker['result_ring'].head
+    worker['commands'].put(record_info)
+
+    await loop.run_in_executor(None, wait_for_worker, worker['camera_open'], worker['worker_proc'])
+    self.capturing = True
+
+    camera_on_ms = (time.perf_counter() - resume_start) * 1000.0
+    rt_logger.info(f'camera on in {camera_on_ms:.1f} ms')
+
+  def pause(self):
+    '''End the capture round, the worker is stopped unless persistent.'''
+
+    if self.worker:
+      self.worker['camera_kill'].set()
+    self.capturing = False
+
+    if not self.persistent:
+      self.stop()
+
+  async def subscribe(self, subscriber, record_name=''):
+    async with self.lock:
+      self.subscribers.add(subscriber)
+      subscriber.start()
+
+      if not self.capturing:
+        try:  # The first results are sent to the new subscriber
+          await self.resume(record_name)
+        except Exception:
+          subscriber.stop()
+          self.subscribers.discard(subscriber)
+          raise
 
-    with alignment, consumer:
-      capture_handler = CaptureHandler(capture_builder, consumer)
-      capture_handler.main_loop(pipeline=pipeline)
+    rt_logger.info(f'{len(self.subscribers)} clients subscribed to camera')
+
+  async def unsubscribe(self, subscriber):
+    async with self.lock:
+      if subscriber not in self.subscribers: return
+
+      subscriber.stop()
+      self.subscribers.discard(subscriber)
+
+      if not self.subscribers:
+        self.pause()
+
+  async def close(self):
+    async with self.lock:
+      for subscriber in self.subscribers:
+        subscriber.stop()
+      self.subscribers.clear()
+
+      self.stop()
+
+  def on_next_seq(self, result_ring, seq):
+    '''Fan out results written since the last notification to subscribers.'''
+
+    if self.worker.get('result_ring', None) is not result_ring:
+      return  # Notified by a worker already stopped
+    if not self.capturing:
+      return  # Results from the last round, or kept until the round starts
+
+    records, missing = result_ring.read(self.next_seq, seq + 1)
+    if missing:
+      rt_logger.warning(f'{len(missing)} results overwritten before being sent')
+    self.next_seq = max(self.next_seq, seq + 1)
+
+    if len(records) == 0: return
+
+    for subscriber in self.subscribers:
+      subscriber.publish(records)
+
+  def save_result(self, result):
+    if self.capturing:
+      self.worker['save_queue'].put(result)
 
-def clean_up_context(context):
-  if context.get('camera_proc', None):
-    context['camera_kill'].set()
-    context['camera_proc'].join()
-  context.clear()
 
 async def websocket_send_json(websocket, message_obj):
   '''Send a JSON object over websocket.'''
@@ -180,126 +603,107 @@ async def send_server_hello(websocket, es_config: EsConfig):
   message_obj['screen_size_cm'] = EsConfigFns.screen_size_cm(es_config)
   message_obj['record_mode'] = EsConfigFns.record_mode(es_config)
   message_obj['game_settings'] = EsConfigFns.collect_game_settings(es_config)
+  message_obj['protocols'] = gaze_protocols()
 
   await websocket_send_json(websocket, message_obj)
 
-async def send_gaze_predict(websocket, context):
-  if context.get('camera_proc', None) and context['next_ready'].is_set():
-    with context['value_lock']:
-      # Sync value and status from the server consumer
-      gx, gy, fid = context['value_bank'][:]
-      next_valid = context['next_valid'].value
-    context['next_ready'].clear()
+def gaze_predict_message(record):
+  message_obj = dict(
+    status='next_ready', seq=int(record['seq']),
+    valid=bool(record['valid']), fid=int(record['fid']),
+    timestamp=float(record['timestamp']),
+  )
+  if message_obj['valid']:
+    gx, gy = record['pog_cam'].tolist()
+    message_obj.update(dict(gx=gx, gy=gy))
 
-    message_obj = dict(status='next_ready', valid=next_valid, fid=fid)
-    if next_valid:
-      message_obj.update(dict(gx=gx, gy=gy))
+  return message_obj
 
-    await websocket_send_json(websocket, message_obj)
+async def send_gaze_predicts(websocket, protocol, records):
+  '''Send results to the client in order, with the protocol of the client.'''
 
-async def recv_client_message(websocket):
-  exit_cond = False
+  if protocol['name'] == 'binary':
+    batch = protocol['batch']
+    for start in range(0, len(records), batch):
+      await websocket.send(pack_gaze_records(records[start:start + batch]))
+  else:
+    for record in records:
+      await websocket_send_json(websocket, gaze_predict_message(record))
 
-  try:  # Wait for the message until a timeout occurs
-    message = await asyncio.wait_for(websocket.recv(), timeout=0.01)
-  except websockets.ConnectionClosed:
-    exit_cond = True
-  except asyncio.TimeoutError:
-    message = None
+async def on_use_protocol(message_obj, websocket, context):
+  '''Switch gaze updates to the protocol chosen by the client, the binary
+  protocol packs up to `batch` results into a single frame.
+  '''
 
-  return exit_cond, message
+  name = message_obj['protocol']
+  if name not in gaze_protocols():
+    raise ValueError(f'unsupported gaze protocol "{name}"')
 
-async def on_open_camera(message_obj, websocket, context, es_config):
-  context['camera_open'] = mp.Event()
-  context['camera_kill'] = mp.Event()
+  batch = int(message_obj.get('batch', 32))
+  context['protocol'].update(dict(name=name, batch=min(max(batch, 1), 65535)))
 
-  context['next_ready'] = mp.Event()
-  context['next_valid'] = mp.Value('b', False)
-  context['value_bank'] = mp.Array('d', (0.0, 0.0, 0.0))
-  context['value_lock'] = mp.Lock()
+  return False
 
-  if EsConfigFns.record_mode(es_config):
-    context['save_queue'] = mp.Queue()
-    record_info = dict(
-      enable=True, cache_size=600,
-      root=EsConfigFns.record_path(es_config),
-      name=message_obj.get('record_name', ''),
-      save_queue=context['save_queue'],
+async def on_open_camera(message_obj, websocket, context, hub, es_config):
+  if not context.get('subscriber', None):
+    context['subscriber'] = GazeSubscriber(
+      websocket, context['protocol'],
+      queue_size=EsConfigFns.subscriber_queue(es_config),
     )
-  else:
-    record_info = dict(enable=False)
-
-  context['camera_proc'] = mp.Process(
-    target=create_server_consumer,
-    args=(es_config, record_info),
-    kwargs=dict(
-      open_event=context['camera_open'],
-      kill_event=context['camera_kill'],
-      next_ready=context['next_ready'],
-      next_valid=context['next_valid'],
-      value_bank=context['value_bank'],
-      value_lock=context['value_lock'],
-    ),
-  )
-
-  context['camera_proc'].start()
-  context['camera_open'].wait()
+    await hub.subscribe(context['subscriber'], message_obj.get('record_name', ''))
 
   await websocket_send_json(websocket, { 'status': 'camera_on' })
 
   return False
 
-async def on_kill_camera(message_obj, websocket, context):
-  clean_up_context(context)
+async def on_kill_camera(message_obj, websocket, context, hub):
+  if context.get('subscriber', None):
+    await hub.unsubscribe(context.pop('subscriber'))
 
   if not message_obj['hard']:
     await websocket_send_json(websocket, { 'status': 'camera_off' })
 
   return True
 
-async def on_kill_server(message_obj, websocket, context, stop_future):
-  clean_up_context(context)
+async def on_kill_server(message_obj, websocket, context, hub, stop_future):
+  await hub.close()
 
   stop_future.set_result(True)
 
   return True
 
-async def on_save_result(message_obj, websocket, context, es_config):
+async def on_save_result(message_obj, websocket, context, hub, es_config):
   if EsConfigFns.record_mode(es_config):
     # Item: frame id, gaze x, gaze y, label x, label y
-    context['save_queue'].put(message_obj['result'])
+    hub.save_result(message_obj['result'])
 
   return False
 
-async def websocket_handler(websocket, stop_future, es_config: EsConfig):
+async def websocket_handler(websocket, stop_future, hub: CameraHub, es_config: EsConfig):
   '''Handler for incoming websocket requests, sent by main game loop.'''
 
-  server_alive, exit_cond_1, exit_cond_2 = True, False, False
-
   await send_server_hello(websocket, es_config)
 
   handler_infos = dict(
-    open_camera=dict(fn=on_open_camera, kw=dict(es_config=es_config)),
-    kill_camera=dict(fn=on_kill_camera, kw=dict()),
-    kill_server=dict(fn=on_kill_server, kw=dict(stop_future=stop_future)),
-    save_result=dict(fn=on_save_result, kw=dict(es_config=es_config)),
+    open_camera=dict(fn=on_open_camera, kw=dict(hub=hub, es_config=es_config)),
+    kill_camera=dict(fn=on_kill_camera, kw=dict(hub=hub)),
+    kill_server=dict(fn=on_kill_server, kw=dict(hub=hub, stop_future=stop_future)),
+    save_result=dict(fn=on_save_result, kw=dict(hub=hub, es_config=es_config)),
+    use_protocol=dict(fn=on_use_protocol, kw=dict()),
   )
 
-  context = dict()  # Context shared by handler functions
-  while server_alive:
-    await send_gaze_predict(websocket, context)
-
-    exit_cond_1, message = await recv_client_message(websocket)
-
-    if message is not None:
+  context = dict(protocol=dict(name='json'))  # Context shared by handler functions
+  try:  # Handle client messages until the connection closes or exit
+    async for message in websocket:
       message_obj = json.loads(message) # Deserialize
       info = handler_infos[message_obj['opcode']]
       args = (message_obj, websocket, context)
-      exit_cond_2 = await info['fn'](*args, **info['kw'])
-
-    server_alive = not exit_cond_1 and not exit_cond_2
+      if await info['fn'](*args, **info['kw']): break
+  except websockets.ConnectionClosed:
+    pass  # Connection closed by the client
 
-  clean_up_context(context)
+  if context.get('subscriber', None):
+    await hub.unsubscribe(context['subscriber'])
 
 
 def run_http_server(httpd):
@@ -344,8 +748,12 @@ def entry_server_mode(config_path):
     webbrowser.open(game_url, new=2, autoraise=True)
   rt_logger.info(f'serving eye shooting game on {game_url}')
 
-  ws_handler = functools.partial(websocket_handler, es_config=es_config)
+  hub = CameraHub(es_config)  # Shared by all connections
+  if hub.persistent: hub.start()
+
+  ws_handler = functools.partial(websocket_handler, hub=hub, es_config=es_config)
   run_websocket_server(ws_handler, httpd, **ws_server_addr)
+  hub.stop()
 
   http_thread.join()
 
@@ -362,18 +770,82 @@ def entry_preview_mode(config_path):
   transforms = Transforms(**EsConfigFns.named_dict(es_config, 'transform'))
   alignment = FaceAlignment(**EsConfigFns.named_dict(es_config, 'alignment'))
   inferencer = Inferencer(**EsConfigFns.named_dict(es_config, 'inference'))
+  inferencer.use_model(model)
+
+  plan = transforms.compile()  # BGR images are previewed
 
   def pipeline(src_image):
-    image = transforms.transform(src_image)
+    image = plan.transform(src_image)
     result = inferencer.run(model, alignment, image)
     return image, result
 
+  create_stages = functools.partial(
+    create_frame_stages, model, transforms, alignment, inferencer,
+  )
+
   with alignment, consumer:
-    capture_handler = CaptureHandler(capture_builder, consumer)
-    capture_handler.main_loop(pipeline=pipeline)
+    run_capture_loop(
+      capture_builder, consumer, pipeline,
+      EsConfigFns.named_dict(es_config, 'stages'),
+      create_stages, output_fn=lambda frame: (frame['image'], frame['result']),
+    )
+
+def entry_replay_mode(config_path):
+  '''Replay a recording or a video through the pipeline, without pacing,
+  then save per-frame results with stage timings.
+  '''
+
+  es_config = EsConfig.from_toml(config_path)
+  replay_config = EsConfigFns.named_dict(es_config, 'replay')
+
+  source = ReplaySource(replay_config['source'], replay_config['fps'])
+  output_path = replay_config['output'] or replay_output_path(replay_config['source'])
+  batch_size = max(replay_config['batch_size'], 1)
+
+  model = load_model(config_path, **EsConfigFns.named_dict(es_config, 'checkpoint'))
+
+  transforms = Transforms(**EsConfigFns.named_dict(es_config, 'transform'))
+  alignment = FaceAlignment(**EsConfigFns.named_dict(es_config, 'alignment'))
+  inferencer = Inferencer(**EsConfigFns.named_dict(es_config, 'inference'))
+  inferencer.use_model(model)
+
+  plan = transforms.compile(to_rgb=True, slots=batch_size)
+  replay_results = ReplayResults()
+
+  def run_batch(batch):
+    fids, timestamps, images = zip(*batch)
+    images = list(images)
+    timings = [dict() for _ in batch]
+    for index, frame_timings in enumerate(timings):
+      with measure(frame_timings, 'transform'):
+        images[index] = plan.transform(images[index])
+
+    results = inferencer.run_batch(model, alignment, images, timestamps, to_rgb=False)
+    for result, frame_timings in zip(results, timings):
+      result['stages'].update(frame_timings)
+      inferencer.timer.update(frame_timings)
+    replay_results.extend(fids, timestamps, results)
+    batch.clear()
+
+  replay_start = time.perf_counter()
+
+  with alignment:
+    batch = []
+    for frame in source:
+      batch.append(frame)
+      if len(batch) == batch_size: run_batch(batch)
+    if len(batch) > 0: run_batch(batch)
+
+  replay_time = time.perf_counter() - replay_start
+  replay_results.save(output_path)
+
+  rt_logger.info(f'replayed {len(replay_results)} frames in {replay_time:.2f} s '
+                 f'({len(replay_results) / max(replay_time, 1e-9):.1f} fps), '
+                 f'results saved to "{output_path}"')
+  rt_logger.info(f'stage latency (p50/p95/p99): {inferencer.timer.format_summary()}')
 
 
-MAIN_ENTRIES = dict(preview=entry_preview_mode, server=entry_server_mode)
+MAIN_ENTRIES = dict(preview=entry_preview_mode, server=entry_server_mode, replay=entry_replay_mode)
 
 
 def main_procedure(cmdargs: argparse.Namespace):
@@ -387,7 +859,7 @@ if __name__ == '__main__':
 
   parser.add_argument('--config', type=str, default='estimator.toml',
                       help='Configuration for this PoG estimator.')
-  parser.add_argument('--mode', type=str, default='server', choices=['server', 'preview'],
+  parser.add_argument('--mode', type=str, default='server', choices=['server', 'preview', 'replay'],
                       help='The mode to run the PoG estimator. Default is server.')
 
   main_procedure(parser.parse_args())
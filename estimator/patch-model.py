@@ -0,0 +1,50 @@
+from runtime.graph import fold_crops, fold_preprocess
+from runtime.log import runtime_logger
+
+import argparse
+import onnx
+import os.path as osp
+
+
+rt_logger = runtime_logger(name='patch-model')
+
+
+def patch_fold_preprocess(cmdargs: argparse.Namespace):
+  model = onnx.load_model(cmdargs.model)
+  return fold_preprocess(model)
+
+
+def patch_fold_crops(cmdargs: argparse.Namespace):
+  model = onnx.load_model(cmdargs.model)
+  return fold_crops(model)
+
+
+PATCH_ENTRIES = {
+  'fold-preprocess': patch_fold_preprocess,
+  'fold-crops': patch_fold_crops,
+}
+
+
+def main_procedure(cmdargs: argparse.Namespace):
+  model_path = osp.abspath(cmdargs.model)
+  output_path = osp.abspath(cmdargs.output)
+  if model_path == output_path:
+    raise ValueError('the patched model should not overwrite the original one')
+
+  model = PATCH_ENTRIES[cmdargs.patch](cmdargs)
+  onnx.save_model(model, output_path)
+
+  rt_logger.info(f'patched model "{model_path}" saved to "{output_path}"')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Patch the PoG estimation model for faster inference.')
+
+  parser.add_argument('patch', type=str, choices=list(PATCH_ENTRIES.keys()),
+                      help='The patch to apply to the model.')
+  parser.add_argument('--model', type=str, default='checkpoint/model.onnx',
+                      help='The model to patch.')
+  parser.add_argument('--output', type=str, required=True,
+                      help='Where to save the patched model.')
+
+  main_procedure(parser.parse_args())
@@ -0,0 +1,337 @@
+from annotate.miscellaneous import dump_json, load_json
+from runtime.container import ImageReader
+from runtime.es_config import EsConfig, EsConfigFns
+from runtime.facealign import FaceAlignment
+from runtime.inference import Inferencer, predict_model_input
+from runtime.log import runtime_logger
+from runtime.pipeline import (
+  ModelInputBuffers,
+  do_model_inference,
+  facenet_input,
+  load_onnx_model,
+  model_input_layout,
+  rotate_vector_a,
+)
+from runtime.quantize import QUANT_VARIANTS, quantize_model
+from runtime.timing import StageTimer
+from runtime.transform import Transforms
+
+import argparse
+import cv2
+import numpy as np
+import os
+import os.path as osp
+import random
+import time
+
+
+rt_logger = runtime_logger(name='quantize-model')
+
+
+def collect_recordings(cmdargs: argparse.Namespace):
+  if cmdargs.record_path:
+    record_path = osp.abspath(cmdargs.record_path)
+    recordings = [
+      r for r in os.listdir(record_path)
+      if osp.isdir(osp.join(record_path, r))
+    ]
+  else:
+    record_path = osp.dirname(osp.abspath(cmdargs.recording))
+    recordings = [osp.basename(osp.abspath(cmdargs.recording))]
+
+  recordings.sort(reverse=False)
+  return [osp.join(record_path, r) for r in recordings]
+
+def collect_samples(recording_paths):
+  '''Annotated samples (recording path, image name, target xy) with a face,
+  which are not outliers, grouped by recording in the order of images.
+  '''
+
+  samples = dict()
+
+  for recording_path in recording_paths:
+    json_path = osp.join(recording_path, 'labels', 'samples.json')
+    if not osp.isfile(json_path):
+      rt_logger.warning(f'skip "{recording_path}", which has not been annotated')
+      continue
+
+    samples[recording_path] = [
+      (recording_path, image_name, sample['target_xy'])
+      for image_name, sample in sorted(load_json(json_path).items())
+      if sample.get('face_mesh', False) and sample.get('inlier', True)
+    ]
+
+  n_samples = sum(len(s) for s in samples.values())
+  rt_logger.info(f'collected {n_samples} samples from {len(samples)} recordings')
+
+  return samples
+
+def split_samples(samples, calib_count, eval_count, seed=0):
+  '''Split samples into calibration and evaluation samples by recording, as
+  frames of a recording are nearly identical, so that evaluation samples are
+  never close to calibration samples. Samples are drawn at random within the
+  recordings of each split.
+
+  A single recording is split in two halves in the order of images instead,
+  which is less reliable, thus a warning is logged.
+  '''
+
+  rng = random.Random(seed)
+  recordings = [r for r in samples if samples[r]]
+  rng.shuffle(recordings)
+
+  if len(recordings) == 1:
+    rt_logger.warning('samples of a single recording are split in two halves, '
+                      'evaluation samples may resemble calibration samples')
+    recording = samples[recordings[0]]
+    calib_pool, eval_pool = recording[:len(recording) // 2], recording[len(recording) // 2:]
+
+  else:
+    # Recordings go to calibration until enough samples, at least one is left
+    calib_pool, eval_pool = [], []
+    for index, recording in enumerate(recordings):
+      last = index == len(recordings) - 1
+      if len(calib_pool) < calib_count and not (last and not eval_pool):
+        calib_pool.extend(samples[recording])
+      else:
+        eval_pool.extend(samples[recording])
+
+  rng.shuffle(calib_pool)
+  rng.shuffle(eval_pool)
+
+  return calib_pool[:calib_count], eval_pool[:eval_count]
+
+
+class AlignedSamples:
+  def __init__(self, es_config: EsConfig):
+    '''Align and crop samples as the estimator does, frames are treated as
+    stand-alone images, since samples are shuffled.
+    '''
+
+    self.transforms = Transforms(**EsConfigFns.named_dict(es_config, 'transform')).compile(to_rgb=True)
+    self.alignment = FaceAlignment(**dict(
+      EsConfigFns.named_dict(es_config, 'alignment'),
+      static_image_mode=True, roi_tracking=False,
+    ))
+    self.inferencer = Inferencer(**EsConfigFns.named_dict(es_config, 'inference'))
+    self.readers = dict()  # Recording path -> ImageReader
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.alignment.close()
+    for reader in self.readers.values():
+      reader.close()
+
+  def read_image(self, recording_path, image_name):
+    if recording_path not in self.readers:
+      self.readers[recording_path] = ImageReader(osp.join(recording_path, 'images'))
+    return self.readers[recording_path].read(image_name)
+
+  def __call__(self, samples):
+    '''Yields a tuple `(sample, crops, norm_ldmks, theta)` for each sample
+    with a detected face, crops are warped at the model input size.
+    '''
+
+    for sample in samples:
+      image = self.read_image(sample[0], sample[1])
+      if image is None: continue
+
+      image = self.transforms.transform(image)
+      image, landmarks, theta = self.inferencer.align_image(self.alignment, image, to_rgb=False)
+      if len(landmarks) == 0: continue
+
+      crops, norm_ldmks, _ = self.alignment.get_face_crop(
+        image, landmarks, theta, hw_ratio=self.inferencer.hw_ratio,
+        **self.inferencer.crop_sizes,
+      )
+      yield sample, crops, norm_ldmks, theta
+
+  def model_inputs(self, samples, layout):
+    # Model inputs are copied, as buffers are reused across frames
+    crop_sizes = self.inferencer.crop_sizes
+    buffers = ModelInputBuffers(crop_sizes['face_size'], crop_sizes['eyes_size'], layout=layout)
+
+    for _, crops, norm_ldmks, _ in self(samples):
+      model_input = predict_model_input(
+        crops, norm_ldmks, crop_sizes['face_size'], crop_sizes['eyes_size'], buffers,
+      )
+      yield {name: np.array(array) for name, array in model_input.items()}
+
+
+def face_images(samples):
+  # Aligned faces saved by the face embedding pass
+  for recording_path, image_name, _ in samples:
+    face_path = osp.join(recording_path, 'embeds', 'faces', image_name)
+    if osp.isfile(face_path):
+      yield cv2.imread(face_path, cv2.IMREAD_COLOR)
+
+def summarize_values(values):
+  values = np.array(values, dtype=np.float64)
+  if len(values) == 0: return dict(count=0)
+  return dict(
+    count=len(values), mean=round(float(values.mean()), 4),
+    **{f'p{p}': round(float(np.percentile(values, p)), 4) for p in (5, 50, 95)},
+  )
+
+def variant_report(model_path, timer: StageTimer):
+  return dict(
+    path=model_path,
+    size_mb=round(os.path.getsize(model_path) / (1 << 20), 2),
+    model_latency_ms=timer.summary().get('model', dict(count=0)),
+  )
+
+
+def evaluate_gaze_models(model_paths, aligned: AlignedSamples, samples, session):
+  '''Gaze error (cm) in camera coordinates against targets, and latency of
+  model calls of each variant, on the same aligned samples. The latency is
+  model-only, alignment and cropping shared by variants are not timed.
+
+  Predictions are compared before the one-euro filters, which would carry
+  state from sample to sample, and from one variant to the next.
+  '''
+
+  crop_sizes = aligned.inferencer.crop_sizes
+
+  variants = dict()
+  for variant, model_path in model_paths.items():
+    model = load_onnx_model(model_path, session, warmup=2)
+    buffers = ModelInputBuffers(
+      crop_sizes['face_size'], crop_sizes['eyes_size'], layout=model_input_layout(model),
+    )
+    variants[variant] = (model, buffers, StageTimer(window=max(len(samples), 1)), [])
+
+  for sample, crops, norm_ldmks, theta in aligned(samples):
+    for model, buffers, timer, errors in variants.values():
+      model_input = predict_model_input(
+        crops, norm_ldmks, crop_sizes['face_size'], crop_sizes['eyes_size'], buffers,
+      )
+
+      start = time.perf_counter_ns()
+      ort_outputs = do_model_inference(model, model_input)
+      timer.record('model', time.perf_counter_ns() - start)
+
+      gcx, gcy = ort_outputs[0].squeeze(0).tolist()
+      pog_cam = rotate_vector_a(gcx, gcy, theta)
+      errors.append(np.linalg.norm(np.array(pog_cam[:2]) - np.array(sample[2])))
+
+  return {
+    variant: dict(variant_report(model_paths[variant], timer), error_cm=summarize_values(errors))
+    for variant, (_, _, timer, errors) in variants.items()
+  }
+
+def evaluate_facenet_models(model_paths, samples, session):
+  '''Cosine similarity of embeddings to those of the original model, and
+  latency of model calls (model-only) of each variant.
+  '''
+
+  variants = {
+    variant: (load_onnx_model(model_path, session, warmup=2), StageTimer(window=max(len(samples), 1)), [])
+    for variant, model_path in model_paths.items()
+  }
+
+  for face in face_images(samples):
+    facenet_ipt = facenet_input(face)
+
+    embeds = dict()
+    for variant, (model, timer, _) in variants.items():
+      start = time.perf_counter_ns()
+      embeds[variant] = np.squeeze(model.run(None, facenet_ipt)[0])
+      timer.record('model', time.perf_counter_ns() - start)
+
+    for variant, (_, _, similarities) in variants.items():
+      similarity = np.dot(embeds[variant], embeds['float']) / (
+        np.linalg.norm(embeds[variant]) * np.linalg.norm(embeds['float']) + 1e-12)
+      similarities.append(similarity)
+
+  return {
+    variant: dict(variant_report(model_paths[variant], timer), cosine=summarize_values(similarities))
+    for variant, (_, timer, similarities) in variants.items()
+  }
+
+
+def quantize_variants(model_path, modes, calib_inputs):
+  model_paths = dict(float=model_path)
+  for mode in modes:
+    inputs_iter = calib_inputs() if mode == 'static' else None
+    model_paths[QUANT_VARIANTS[mode]] = quantize_model(model_path, mode, inputs_iter)
+  return model_paths
+
+def log_report(model_name, report, metric):
+  for variant, stats in report.items():
+    latency, quality = stats['model_latency_ms'], stats[metric]
+    rt_logger.info(
+      f'{model_name} {variant:>12}: {metric} {quality.get("mean", float("nan")):.4f} '
+      f'(p5 {quality.get("p5", float("nan")):.4f}, p95 {quality.get("p95", float("nan")):.4f}), '
+      f'model latency p50 {latency.get("p50", float("nan")):.2f} ms, '
+      f'p95 {latency.get("p95", float("nan")):.2f} ms, size {stats["size_mb"]:.1f} MB'
+    )
+
+
+def main_procedure(cmdargs: argparse.Namespace):
+  config_path = osp.abspath(cmdargs.config)
+  config_root = osp.dirname(config_path)
+  es_config = EsConfig.from_toml(config_path)
+
+  checkpoint = EsConfigFns.named_dict(es_config, 'checkpoint')
+  session = checkpoint.get('session', dict())
+  gaze_path = osp.join(config_root, checkpoint['model_path'])
+  facenet_path = osp.join(config_root, 'resources', 'facenet.onnx')
+
+  calib_samples, eval_samples = split_samples(
+    collect_samples(collect_recordings(cmdargs)),
+    cmdargs.calib_count, cmdargs.eval_count, cmdargs.seed,
+  )
+
+  report = dict(
+    calib_samples=len(calib_samples), eval_samples=len(eval_samples),
+    modes=cmdargs.modes,
+  )
+
+  with AlignedSamples(es_config) as aligned:
+    if 'gaze' in cmdargs.models:
+      float_layout = model_input_layout(load_onnx_model(gaze_path, session))
+      model_paths = quantize_variants(
+        gaze_path, cmdargs.modes,
+        lambda: aligned.model_inputs(calib_samples, float_layout),
+      )
+      report['gaze'] = evaluate_gaze_models(model_paths, aligned, eval_samples, session)
+      log_report('gaze', report['gaze'], 'error_cm')
+
+  if 'facenet' in cmdargs.models:
+    model_paths = quantize_variants(
+      facenet_path, cmdargs.modes,
+      lambda: (facenet_input(face) for face in face_images(calib_samples)),
+    )
+    report['facenet'] = evaluate_facenet_models(model_paths, eval_samples, session)
+    log_report('facenet', report['facenet'], 'cosine')
+
+  report_path = cmdargs.report or osp.join(osp.dirname(gaze_path), 'quantize-report.json')
+  dump_json(report_path, report, indent=2)
+  rt_logger.info(f'quantization report saved to "{report_path}"')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Quantize models to INT8, then compare them with the original models.')
+
+  targets = parser.add_mutually_exclusive_group(required=True)
+  targets.add_argument('--record-path', type=str, help='The path to the annotated recordings.')
+  targets.add_argument('--recording', type=str, help='The path to a specific annotated recording.')
+
+  parser.add_argument('--config', type=str, default='estimator.toml',
+                      help='Configuration for the PoG estimator.')
+  parser.add_argument('--models', type=str, nargs='+', default=['gaze', 'facenet'],
+                      choices=['gaze', 'facenet'], help='The models to quantize.')
+  parser.add_argument('--modes', type=str, nargs='+', default=list(QUANT_VARIANTS.keys()),
+                      choices=list(QUANT_VARIANTS.keys()), help='The quantization modes.')
+  parser.add_argument('--calib-count', type=int, default=200,
+                      help='Number of samples for calibration (static quantization).')
+  parser.add_argument('--eval-count', type=int, default=500,
+                      help='Number of samples for evaluation, from recordings apart from calibration.')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='Random seed to draw samples.')
+  parser.add_argument('--report', type=str, default='',
+                      help='Where to save the report, next to the gaze model by default.')
+
+  main_procedure(parser.parse_args())
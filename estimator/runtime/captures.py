@@ -1,19 +1,35 @@
+from .framepool import FramePool
+from .log import runtime_logger
 from .miscellaneous import use_state
 
 import cv2
+import numpy as np
+import threading
+import time
+
+
+rt_logger = runtime_logger(name='runtime').getChild('captures')
 
 
 class VideoCaptureBuilder:
-  def __init__(self, capture_id, resolution=None):
+  def __init__(self, capture_id, resolution=None, drop_stale=False, pool_size=0):
     '''Build cv2.VideoCapture with the given capture_id and resolution.
 
     `capture_id`: index, filename, image sequence or url, see also cv2.VideoCapture.
 
     `resolution`: resolution (h, w) to set for the video capture.
+
+    `drop_stale`: read frames on a dedicated thread and only keep the latest
+    one, so that consumers slower than the camera never process stale frames.
+
+    `pool_size`: number of preallocated frames that the capture reads into,
+    frames are allocated by OpenCV for each read if set to zero.
     '''
 
     self.capture_id = capture_id
     self.resolution = resolution
+    self.drop_stale = drop_stale
+    self.pool_size = pool_size
 
   def build(self):
     capture = cv2.VideoCapture(self.capture_id, cv2.CAP_ANY)
@@ -25,27 +41,170 @@ class VideoCaptureBuilder:
     return capture
 
 
+def read_frame(capture, frame_pool=None):
+  '''Read a frame from the capture into a free slot of the frame pool, the
+  frame is allocated by OpenCV if no slot is free, or if the frame does not
+  fit the slot (the slot is given back then).
+
+  Returns a tuple `(success, frame)`, as `cv2.VideoCapture.read`.
+  '''
+
+  slot = frame_pool.acquire() if frame_pool is not None else None
+  if slot is None: return capture.read()
+
+  success, frame = capture.read(image=slot)
+  if not success or frame is not slot:
+    frame_pool.release(slot)
+
+  return success, frame
+
+
+class LatestFrameReader:
+  def __init__(self, capture, frame_pool=None):
+    '''Read frames from the capture on a dedicated thread, keeping only the
+    newest frame and its capture timestamp in a single slot.
+
+    `capture`: an opened cv2.VideoCapture, which is read by this reader only.
+
+    `frame_pool`: read frames into this pool, a stale frame is released once
+    replaced, while the frame returned by `read` belongs to the caller.
+    '''
+
+    self.capture = capture
+    self.frame_pool = frame_pool
+
+    self._cond = threading.Condition()
+    self._frame, self._timestamp = None, 0.0
+    self._stopped = False
+    self._thread = threading.Thread(target=self._read_loop, daemon=True)
+
+    self.captured, self.consumed, self.dropped = 0, 0, 0
+
+  def __enter__(self):
+    self._thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    with self._cond:
+      self._stopped = True
+      self._cond.notify_all()
+    self._thread.join()
+
+    if self._frame is not None and self.frame_pool is not None:
+      self.frame_pool.release(self._frame)
+    self._frame = None
+
+  def _read_loop(self):
+    while not self._stopped:
+      success, frame = read_frame(self.capture, self.frame_pool)
+      timestamp = time.time()
+      if not success: continue
+
+      with self._cond:
+        if self._frame is not None:
+          self.dropped += 1 # The last frame has never been consumed
+          if self.frame_pool is not None: self.frame_pool.release(self._frame)
+        self._frame, self._timestamp = frame, timestamp
+        self.captured += 1
+        self._cond.notify()
+
+  def read(self, timeout=None):
+    '''Wait for a frame newer than the last one read, returns a tuple
+    `(frame, timestamp)`, or `(None, None)` on timeout or once stopped.
+
+    `timestamp`: capture time of the frame, from `time.time`.
+    '''
+
+    with self._cond:
+      self._cond.wait_for(lambda: self._frame is not None or self._stopped, timeout)
+
+      frame, timestamp = self._frame, self._timestamp
+      if frame is None: return None, None
+
+      self._frame = None
+      self.consumed += 1
+
+    return frame, timestamp
+
+  def stats(self):
+    '''Counters of captured, consumed and dropped (stale) frames.'''
+    with self._cond:
+      return dict(captured=self.captured, consumed=self.consumed, dropped=self.dropped)
+
+
 class CaptureHandler:
   def __init__(self, capture_builder, frame_consumer):
     '''CaptureHandler maintains a cv2.VideoCapture and calls the given
     frame consumer for each frame captured, until the exit flag is set.
 
+    If the builder asks for `drop_stale`, frames are read on a dedicated
+    thread and the consumer always receives the latest captured frame.
+
+    If the builder asks for a `pool_size`, frames are read into a frame pool,
+    sized after the frame size reported by the capture. Each frame is released once the consumer
+    returns, consumers that keep the frame call `retain_frame` beforehand.
+
+    Consumers that keep frames across calls may implement `flush`, which is
+    called with the same arguments once capture ends, before the frame pool
+    is closed.
+
     `capture_builder`: capture builder that implements a `build` method.
 
     `frame_consumer`: a callable that takes the captured frame and the
-    callback function that sets the exit condition.
+    callback function that sets the exit condition, as well as the capture
+    timestamp of the frame (`timestamp`, from `time.time`).
     '''
 
     self.capture_builder = capture_builder
     self.frame_consumer = frame_consumer
 
+  def create_frame_pool(self, capture):
+    pool_size = getattr(self.capture_builder, 'pool_size', 0)
+    if pool_size <= 0: return None
+
+    # Frames of another size are allocated by OpenCV, see `read_frame`
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    if height <= 0 or width <= 0:
+      rt_logger.warning('frame size of the capture is unknown, frame pool disabled')
+      return None
+
+    return FramePool(pool_size, (height, width, 3), np.uint8)
+
+  def consume(self, src_image, set_exit_cond, frame_pool, timestamp, **extra_kwargs):
+    try:
+      self.frame_consumer(src_image, set_exit_cond, timestamp=timestamp, **extra_kwargs)
+    finally:
+      if frame_pool is not None: frame_pool.release(src_image)
+
   def main_loop(self, **extra_kwargs):
     capture = self.capture_builder.build()
     exit_cond, set_exit_cond = use_state(False)
 
-    while not exit_cond():
-      success, src_image = capture.read()
-      if not success: continue
-      self.frame_consumer(src_image, set_exit_cond, **extra_kwargs)
+    frame_pool = self.create_frame_pool(capture)
+
+    if getattr(self.capture_builder, 'drop_stale', False):
+      with LatestFrameReader(capture, frame_pool) as reader:
+        while not exit_cond():
+          src_image, timestamp = reader.read(timeout=0.1)
+          if src_image is None: continue
+          self.consume(src_image, set_exit_cond, frame_pool, timestamp, **extra_kwargs)
+      rt_logger.info('capture stats: {captured} captured, {consumed} consumed, '
+                     '{dropped} dropped as stale'.format(**reader.stats()))
+
+    else:
+      while not exit_cond():
+        success, src_image = read_frame(capture, frame_pool)
+        timestamp = time.time()
+        if not success: continue
+        self.consume(src_image, set_exit_cond, frame_pool, timestamp, **extra_kwargs)
+
+    if hasattr(self.frame_consumer, 'flush'):
+      self.frame_consumer.flush(set_exit_cond, **extra_kwargs)
+
+    if frame_pool is not None:
+      rt_logger.info('frame pool stats: {acquired} acquired, {exhausted} exhausted, '
+                     '{in_use} in use'.format(**frame_pool.stats()))
+      frame_pool.close()
 
     capture.release()
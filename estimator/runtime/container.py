@@ -0,0 +1,218 @@
+from .log import runtime_logger
+
+import cv2  # OpenCV-Python
+import mmap
+import numpy as np
+import os
+import os.path as osp
+import re
+import threading
+
+
+rt_logger = runtime_logger(name='runtime').getChild('container')
+
+
+# Encoded frames are appended to chunk files, each located by an index record,
+# the index file starts with a header: magic (8 bytes), image ext (8 bytes)
+INDEX_NAME = 'frames.idx'
+CHUNK_NAME = 'frames-{:05d}.bin'
+
+_INDEX_MAGIC = b'GPEIDX01'
+_INDEX_HEADER_SIZE = 16
+_INDEX_DTYPE = np.dtype([
+  ('item', '<u4'), ('chunk', '<u4'), ('offset', '<u8'), ('length', '<u4'), ('reserved', '<u4'),
+])
+
+
+def is_chunked(folder):
+  '''Whether the folder holds frames in chunk files, instead of image files.'''
+  return osp.isfile(osp.join(folder, INDEX_NAME))
+
+
+class ChunkWriter():
+  def __init__(self, folder, image_ext='.jpg', chunk_size=256 << 20):
+    '''Append encoded frames to chunk files in the folder, a new chunk file is
+    started once the current one exceeds `chunk_size` bytes. Appending is
+    thread-safe, and frames appended before a crash remain readable.
+    '''
+
+    self.folder = folder
+    self.image_ext = image_ext
+    self.chunk_size = chunk_size
+
+    self._lock = threading.Lock()
+    self._chunk_id, self._chunk_fp = -1, None
+
+    self._index_fp = open(osp.join(folder, INDEX_NAME), 'wb')
+    self._index_fp.write(_INDEX_MAGIC + image_ext.encode('ascii').ljust(8, b'\0'))
+    self._next_chunk()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  def _next_chunk(self):
+    if self._chunk_fp is not None:
+      self._chunk_fp.close()
+
+    self._chunk_id += 1
+    chunk_path = osp.join(self.folder, CHUNK_NAME.format(self._chunk_id))
+    self._chunk_fp = open(chunk_path, 'wb')
+
+  def append(self, item_id, encoded):
+    '''Append an encoded frame (bytes-like), tagged by `item_id`.'''
+
+    encoded = memoryview(encoded).cast('B')
+
+    with self._lock:
+      if self._chunk_fp.tell() > 0 and self._chunk_fp.tell() + len(encoded) > self.chunk_size:
+        self._next_chunk()
+
+      offset = self._chunk_fp.tell()
+      self._chunk_fp.write(encoded)
+      self._chunk_fp.flush()  # Frame data lands before its index record
+
+      record = np.zeros(1, dtype=_INDEX_DTYPE)
+      record[0] = (item_id, self._chunk_id, offset, len(encoded), 0)
+      self._index_fp.write(record.tobytes())
+      self._index_fp.flush()
+
+  def close(self):
+    with self._lock:
+      self._chunk_fp.close()
+      self._index_fp.close()
+
+
+class ChunkReader():
+  def __init__(self, folder):
+    '''Random access to frames in chunk files, which are memory-mapped, so
+    that no file is opened per frame.
+    '''
+
+    self.folder = folder
+
+    index_path = osp.join(folder, INDEX_NAME)
+    with open(index_path, 'rb') as fp:
+      header = fp.read(_INDEX_HEADER_SIZE)
+    if header[:8] != _INDEX_MAGIC:
+      raise ValueError(f'invalid frame index "{index_path}"')
+    self.image_ext = header[8:].rstrip(b'\0').decode('ascii')
+
+    # A record may be partially written, if the writer crashed
+    index_size = os.path.getsize(index_path) - _INDEX_HEADER_SIZE
+    index = np.fromfile(
+      index_path, dtype=_INDEX_DTYPE, offset=_INDEX_HEADER_SIZE,
+      count=index_size // _INDEX_DTYPE.itemsize,
+    )
+
+    self._maps = dict()  # Chunk id -> mmap
+    self._records = dict()
+    for record in index:
+      if self._chunk_map(int(record['chunk'])) is None: continue
+      if record['offset'] + record['length'] > len(self._maps[int(record['chunk'])]): continue
+      self._records[int(record['item'])] = record
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  def __contains__(self, item_id):
+    return item_id in self._records
+
+  def __len__(self):
+    return len(self._records)
+
+  def _chunk_map(self, chunk_id):
+    if chunk_id not in self._maps:
+      chunk_path = osp.join(self.folder, CHUNK_NAME.format(chunk_id))
+      if not osp.isfile(chunk_path) or osp.getsize(chunk_path) == 0:
+        return None
+      with open(chunk_path, 'rb') as fp:
+        self._maps[chunk_id] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return self._maps[chunk_id]
+
+  def items(self):
+    return sorted(self._records.keys())
+
+  def read_encoded(self, item_id):
+    '''Returns the encoded frame, a view into the memory-mapped chunk.'''
+
+    record = self._records[item_id]
+    chunk = self._maps[int(record['chunk'])]
+    return np.frombuffer(chunk, dtype=np.uint8, count=int(record['length']), offset=int(record['offset']))
+
+  def read(self, item_id, flags=cv2.IMREAD_UNCHANGED):
+    return cv2.imdecode(self.read_encoded(item_id), flags)
+
+  def close(self):
+    self._records.clear()
+    for chunk in self._maps.values():
+      chunk.close()
+    self._maps.clear()
+
+
+class ImageReader():
+  def __init__(self, folder):
+    '''Read frames by image name (`{item:05d}.jpg`) from a recording folder,
+    either from chunk files or from image files.
+    '''
+
+    self.folder = folder
+    self.chunks = ChunkReader(folder) if is_chunked(folder) else None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  def read(self, image_name, flags=cv2.IMREAD_UNCHANGED):
+    if self.chunks is not None:
+      item_id = int(osp.splitext(image_name)[0])
+      return self.chunks.read(item_id, flags) if item_id in self.chunks else None
+    return cv2.imread(osp.join(self.folder, image_name), flags)
+
+  def close(self):
+    if self.chunks is not None:
+      self.chunks.close()
+
+
+def _export_frame(reader, item_id, image_path):
+  # Views of the frame must not outlive the reader, which unmaps chunks
+  encoded = reader.read_encoded(item_id)
+  encoded.tofile(image_path)
+  if osp.getsize(image_path) != len(encoded):
+    raise OSError(f'frame {item_id} exported to "{image_path}" is incomplete')
+
+def export_chunks(folder, out_folder):
+  '''Export frames in chunk files as image files `{item:05d}{ext}`, namely
+  the folder layout of recordings without chunk files. Raises `OSError` if
+  any image file does not hold the whole frame once written.
+  '''
+
+  os.makedirs(out_folder, exist_ok=True)
+
+  with ChunkReader(folder) as reader:
+    for item_id in reader.items():
+      image_path = osp.join(out_folder, f'{item_id:05d}{reader.image_ext}')
+      _export_frame(reader, item_id, image_path)
+
+    rt_logger.info(f'exported {len(reader)} frames from "{folder}" to "{out_folder}"')
+
+def remove_chunks(folder):
+  '''Remove the index and chunk files of the folder, such as once frames are
+  exported. The index goes first, so that the folder never looks chunked
+  with chunk files missing.
+  '''
+
+  os.remove(osp.join(folder, INDEX_NAME))
+
+  chunk_names = [n for n in os.listdir(folder) if re.fullmatch(r'frames-\d+\.bin', n)]
+  for chunk_name in chunk_names:
+    os.remove(osp.join(folder, chunk_name))
+
+  rt_logger.info(f'removed {len(chunk_names)} chunk files from "{folder}"')
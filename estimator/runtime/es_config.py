@@ -70,6 +70,18 @@ class EsConfigFns:
   def get_config_path(es_config: EsConfig) -> str:
     return getattr(es_config, 'config_path')
 
+  @staticmethod
+  def result_capacity(es_config: EsConfig) -> int:
+    return es_config['server']['results']['capacity']
+
+  @staticmethod
+  def persistent_camera(es_config: EsConfig) -> bool:
+    return es_config['server']['camera']['persistent']
+
+  @staticmethod
+  def subscriber_queue(es_config: EsConfig) -> int:
+    return es_config['server']['results']['queue']
+
   @staticmethod
   def topleft_offset(es_config: EsConfig) -> list:
     return es_config['inference']['topleft_offset']
@@ -86,6 +98,21 @@ class EsConfigFns:
   def record_path(es_config: EsConfig) -> str:
     return es_config['server']['record']['path']
 
+  @staticmethod
+  def record_cache(es_config: EsConfig) -> dict:
+    record = es_config['server']['record'].to_dict()
+    return dict(
+      cache_size=record.get('cache_size', 600),
+      cache_retain=record.get('cache_retain', False),
+    )
+
+  @staticmethod
+  def record_writer(es_config: EsConfig) -> dict:
+    writer = dict(image_format='jpg', quality=95, workers=2, queue_size=64, container=False, chunk_size=256)
+    if 'writer' in es_config['server'].to_dict():
+      writer.update(es_config['server']['writer'].to_dict())
+    return writer
+
   @staticmethod
   def record_mode(es_config: EsConfig) -> bool:
     return EsConfigFns.record_path(es_config) != ''
@@ -8,7 +8,10 @@ class FaceAlignment():
                static_image_mode=True,
                max_num_faces=1,
                min_detection_confidence=0.6,
-               min_tracking_confidence=0.6):
+               min_tracking_confidence=0.6,
+               roi_tracking=False,
+               roi_expand=2.0,
+               roi_margin=0.05):
     '''Helper class for mediapipe face mesh solution with context management.
 
     Similar to mediapipe solutions, we recommand the use of `with` block:
@@ -29,6 +32,13 @@ class FaceAlignment():
     `min_detection_confidence`: minimum confidence value (0.0, 1.0) for successful face detection.
 
     `min_tracking_confidence`: minimum confidence value (0.0, 1.0) for successful face landmarks tracking.
+
+    `roi_tracking`: run face mesh on a region around the face from the last frame,
+    falling back to the full frame once the face is lost or leaves the region.
+
+    `roi_expand`: size of the tracking region relative to the last face.
+
+    `roi_margin`: landmarks closer than this ratio to the region border count as leaving.
     '''
 
     self._static_image_mode = static_image_mode
@@ -36,6 +46,10 @@ class FaceAlignment():
     self._min_detection_confidence = min_detection_confidence
     self._min_tracking_confidence = min_tracking_confidence
 
+    self._roi_tracking = roi_tracking
+    self._roi_expand = roi_expand
+    self._roi_margin = roi_margin
+
   def __enter__(self):
     return self
 
@@ -51,13 +65,18 @@ class FaceAlignment():
   def process(self, image: np.ndarray):
     raise NotImplementedError(f'for full functionality, please install mediapipe ...')
 
+  def reset(self):
+    raise NotImplementedError(f'for full functionality, please install mediapipe ...')
+
   def close(self):
     raise NotImplementedError(f'for full functionality, please install mediapipe ...')
 
   def get_face_crop_without_align(self, image, landmarks, with_eyes=True,
-                                  width_expand=1.6, hw_ratio=0.6):
+                                  width_expand=1.6, hw_ratio=0.6,
+                                  face_size=None, eyes_size=None, warp=True):
     raise NotImplementedError(f'for full functionality, please install mediapipe ...')
 
   def get_face_crop(self, image, landmarks, theta, with_eyes=True,
-                    width_expand=1.6, hw_ratio=0.6):
+                    width_expand=1.6, hw_ratio=0.6,
+                    face_size=None, eyes_size=None, warp=True):
     raise NotImplementedError(f'for full functionality, please install mediapipe ...')
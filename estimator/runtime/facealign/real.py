@@ -22,7 +22,7 @@ def _get_landmark_group_indices(connections):
   for connection in connections:
     landmark_connections.extend(connection)
 
-  return list(set(landmark_connections))
+  return np.array(sorted(set(landmark_connections)), dtype=np.intp)
 
 _FACEMESH_CONTOURS = _get_landmark_group_indices(
   mp.solutions.face_mesh_connections.FACEMESH_CONTOURS)
@@ -50,14 +50,51 @@ _LEFT_EYE_CENTER = [473]
 _RIGHT_EYE_CENTER = [468]
 
 
+def _unpack_landmark_list(landmark_list, out: np.ndarray):
+  '''Decode (x, y, z) of a `NormalizedLandmarkList` into `out` of shape (n, 3)
+  from its wire format, without creating python objects for each landmark.
+
+  Each landmark is serialized as a length-delimited message (tag 0x0a) that
+  starts with fixed32 floats x (tag 0x0d), y (tag 0x15) and z (tag 0x1d).
+  Returns False if landmarks do not share this layout, eg. missing fields.
+  '''
+
+  n_ldmks = len(out)
+  buffer = landmark_list.SerializeToString()
+
+  stride = len(buffer) // n_ldmks if n_ldmks > 0 else 0
+  if stride < 17 or stride - 2 >= 128 or stride * n_ldmks != len(buffer):
+    return False
+
+  records = np.frombuffer(buffer, dtype=np.uint8).reshape(n_ldmks, stride)
+  expected = {0: 0x0a, 1: stride - 2, 2: 0x0d, 7: 0x15, 12: 0x1d}
+  for column, value in expected.items():
+    if not np.all(records[:, column] == value): return False
+
+  for axis, offset in enumerate([3, 8, 13]):
+    out[:, axis] = np.ndarray((n_ldmks, ), dtype='<f4', buffer=buffer,
+                              offset=offset, strides=(stride, ))
+
+  return True
+
+
 class NormalizedCropRegion():
-  def __init__(self, crop: np.ndarray, sas: np.ndarray):
-    self._crop = crop  # 3-channel (RGB) image crop
-    self._sas = sas    # Screen coordinate: (x, y, w, h)
+  def __init__(self, crop: np.ndarray, sas: np.ndarray,
+               warp: np.ndarray = None, source: np.ndarray = None):
+    self._crop = crop      # 3-channel (RGB) image crop, None if not warped
+    self._sas = sas        # Screen coordinate: (x, y, w, h)
+    self._warp = warp      # Affine transform (2, 3): crop pixel -> source pixel
+    self._source = source  # Source image that the crop is warped from
 
   def get_crop(self):
     return self._crop
 
+  def get_warp(self):
+    return self._warp
+
+  def get_source(self):
+    return self._source
+
   def get_sas(self):
     return self._sas
 
@@ -74,7 +111,10 @@ class FaceAlignment():
                static_image_mode=True,
                max_num_faces=1,
                min_detection_confidence=0.6,
-               min_tracking_confidence=0.6):
+               min_tracking_confidence=0.6,
+               roi_tracking=False,
+               roi_expand=2.0,
+               roi_margin=0.05):
     '''Helper class for mediapipe face mesh solution with context management.
 
     Similar to mediapipe solutions, we recommand the use of `with` block:
@@ -95,6 +135,15 @@ class FaceAlignment():
     `min_detection_confidence`: minimum confidence value (0.0, 1.0) for successful face detection.
 
     `min_tracking_confidence`: minimum confidence value (0.0, 1.0) for successful face landmarks tracking.
+
+    `roi_tracking`: run face mesh on a region around the face from the last frame,
+    falling back to the full frame once the face is lost or leaves the region.
+    Regions move and change size across frames, thus they are processed by a
+    face mesh in static image mode, regardless of `static_image_mode`.
+
+    `roi_expand`: size of the tracking region relative to the last face.
+
+    `roi_margin`: landmarks closer than this ratio to the region border count as leaving.
     '''
 
     self._static_image_mode = static_image_mode
@@ -102,19 +151,38 @@ class FaceAlignment():
     self._min_detection_confidence = min_detection_confidence
     self._min_tracking_confidence = min_tracking_confidence
 
+    self._roi_tracking = roi_tracking
+    self._roi_expand = roi_expand
+    self._roi_margin = roi_margin
+
     # TODO: Add support for multiple faces in one image
     if max_num_faces != 1:
       rt_logger.warning(f"currently, multiple faces ({max_num_faces}) are not supported")
       self._max_num_faces = 1
 
-    self._face_mesh = mp.solutions.face_mesh.FaceMesh(
-      static_image_mode=self._static_image_mode,
+    self._face_mesh = self._create_face_mesh(self._static_image_mode)
+    self._closed = False
+
+    # Tracking within the face mesh would smooth landmarks of moving regions
+    self._roi_mesh = None
+    if self._roi_tracking:
+      self._roi_mesh = self._face_mesh if self._static_image_mode else self._create_face_mesh(True)
+
+    self._last_ldmks = None   # Landmarks from the last frame, for roi tracking
+    self._last_in_roi = False # Whether the last landmarks were found in a region
+
+    self._ldmk_buffer = np.zeros((478, 3), dtype=np.float32)
+    self._ldmk_scale = np.zeros((2, ), dtype=np.float64)
+    self._ldmk_fallback = False  # Whether landmarks have been decoded one by one
+
+  def _create_face_mesh(self, static_image_mode):
+    return mp.solutions.face_mesh.FaceMesh(
+      static_image_mode=static_image_mode,
       max_num_faces=self._max_num_faces,
       refine_landmarks=True,
       min_detection_confidence=self._min_detection_confidence,
       min_tracking_confidence=self._min_tracking_confidence,
     )
-    self._closed = False
 
   def __enter__(self):
     return self
@@ -122,12 +190,28 @@ class FaceAlignment():
   def __exit__(self, exc_type, exc_val, exc_tb):
     self.close()
 
-  def _parse_mediapipe_landmarks(self, landmarks):
-    # TODO: Add interface for z coordinate
-    return np.array([(ldmk.x, ldmk.y) for ldmk in landmarks], dtype=np.float32)
+  def _parse_mediapipe_landmarks(self, landmark_list):
+    # Decode normalized (x, y, z) into the buffer reused across frames
+    n_ldmks = len(landmark_list.landmark)
+    if self._ldmk_buffer.shape[0] != n_ldmks:
+      self._ldmk_buffer = np.empty((n_ldmks, 3), dtype=np.float32)
+
+    if not _unpack_landmark_list(landmark_list, self._ldmk_buffer):
+      if not self._ldmk_fallback:
+        rt_logger.warning('landmarks do not match the expected wire format (schema changed?), '
+                          'decoding them one by one, which is slower')
+        self._ldmk_fallback = True
+      self._ldmk_buffer[:] = np.fromiter(
+        (v for ldmk in landmark_list.landmark for v in (ldmk.x, ldmk.y, ldmk.z)),
+        dtype=np.float32, count=3 * n_ldmks,
+      ).reshape(n_ldmks, 3)
+
+    return self._ldmk_buffer[:, :2]
 
   def _denormalize_landmarks(self, image_h, image_w, landmarks: np.ndarray):
-    return landmarks * np.array([image_w, image_h])
+    if self._ldmk_scale[0] != image_w or self._ldmk_scale[1] != image_h:
+      self._ldmk_scale = np.array([image_w, image_h], dtype=np.float64)
+    return np.multiply(landmarks, self._ldmk_scale)
 
   def _l2_norm(self, array: np.ndarray, axis=None):
     return np.sqrt(np.sum(array**2, axis=axis))
@@ -157,15 +241,54 @@ class FaceAlignment():
     P = np.concatenate([points, np.ones(shape=(len(points), 1))], axis=1)
     return np.transpose(np.dot(M, np.transpose(P)))
 
-  def _rotate_with_bounds(self, image, angle):
-    height, width, _ = image.shape
-    # TODO: Consider the nubmer of padded pixels for better efficiency
+  def _rotation_with_bounds(self, height, width, angle):
+    # Rotation of the image padded to `2*max(h, w)` square, note that the
+    # padded image is never built, crops are warped from the source instead
     length = 2 * max(height, width)
     a = int((length - width) / 2)
     b = int((length - height) / 2)
-    padded = cv2.copyMakeBorder(image, b, b, a, a, cv2.BORDER_CONSTANT, None, value=(0, 0, 0))
     M = self.get_rotation_matrix_2d((width/2 + a, height/2 + b), angle, scale=1.0)
-    return cv2.warpAffine(padded, M, (width + 2*a, height + 2*b)), a, b, M
+    return (width + 2*a, height + 2*b), a, b, M
+
+  def _warp_crop_region(self, image, M, a, b, bbox, dsize=None, warp=True):
+    '''Warp region `bbox` of the rotated padded image directly from the source
+    image, then resize the region to `dsize` (w, h) within the same warp.
+
+    Returns the crop (None unless `warp`) and the affine transform that maps
+    crop pixels to source pixels, so that the crop can be warped elsewhere.
+    '''
+
+    x_min, y_min, x_max, y_max = bbox
+    crop_w, crop_h = max(x_max - x_min, 1), max(y_max - y_min, 1)
+
+    if dsize is None:
+      dsize, interpolation = (crop_w, crop_h), cv2.INTER_LINEAR
+    else:
+      dsize, interpolation = tuple(dsize), cv2.INTER_CUBIC
+
+    # Map destination pixels back to the source image, in homogeneous form:
+    #   crop (pixel centers as in cv2.resize) -> rotated -> padded -> source
+    sx, sy = crop_w / dsize[0], crop_h / dsize[1]
+    to_rotated = np.array([
+      [sx, 0.0, 0.5 * sx - 0.5 + x_min],
+      [0.0, sy, 0.5 * sy - 0.5 + y_min],
+      [0.0, 0.0, 1.0],
+    ])
+    to_padded = np.concatenate([cv2.invertAffineTransform(M), [[0.0, 0.0, 1.0]]])
+    to_source = np.array([[1.0, 0.0, -a], [0.0, 1.0, -b], [0.0, 0.0, 1.0]])
+    W = np.dot(to_source, np.dot(to_padded, to_rotated))[:2]
+
+    if not warp: return None, W
+
+    return cv2.warpAffine(
+      image, W, dsize, flags=interpolation | cv2.WARP_INVERSE_MAP,
+      borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0),
+    ), W
+
+  def _get_crop_region(self, image, M, a, b, bbox, dsize, cam_center, cam_metric, warp=True):
+    crop, W = self._warp_crop_region(image, M, a, b, bbox, dsize, warp)
+    sas = self._get_crop_shift_and_size(cam_center, bbox, cam_metric)
+    return NormalizedCropRegion(crop, sas, W, image)
 
   def _get_eye_crop_bbox(self, eye_center, bbox, width_expand, hw_ratio):
     width = width_expand * (bbox[2] - bbox[0])
@@ -178,10 +301,10 @@ class FaceAlignment():
 
     return x_min, y_min, x_max, y_max
 
-  def _get_eyes_crop(self, rotated, landmarks, cam_center, cam_metric,
-                     width_expand=1.6, hw_ratio=0.6):
-    '''Takes as input the cropped face and correspoinding landmarks,
-    return the cropped regions for both eyes.
+  def _get_eyes_crop(self, image, M, a, b, landmarks, cam_center, cam_metric,
+                     width_expand=1.6, hw_ratio=0.6, eyes_size=None, warp=True):
+    '''Takes as input the source image, the rotation and correspoinding
+    landmarks in the rotated image, return the cropped regions for both eyes.
     '''
 
     # Get landmarks for both right eye and left eye
@@ -196,47 +319,92 @@ class FaceAlignment():
     rx_min, ry_min, rx_max, ry_max = np.asarray(rcrop_bbox, dtype=int)
     lx_min, ly_min, lx_max, ly_max = np.asarray(lcrop_bbox, dtype=int)
 
-    reye_crop = NormalizedCropRegion(
-      rotated[ry_min:ry_max, rx_min:rx_max],
-      self._get_crop_shift_and_size(
-        cam_center,
-        [rx_min, ry_min, rx_max, ry_max],
-        cam_metric,
-        ),
+    reye_crop = self._get_crop_region(
+      image, M, a, b, [rx_min, ry_min, rx_max, ry_max],
+      eyes_size, cam_center, cam_metric, warp,
     )
-    leye_crop = NormalizedCropRegion(
-      rotated[ly_min:ly_max, lx_min:lx_max],
-      self._get_crop_shift_and_size(
-        cam_center,
-        [lx_min, ly_min, lx_max, ly_max],
-        cam_metric,
-      ),
+    leye_crop = self._get_crop_region(
+      image, M, a, b, [lx_min, ly_min, lx_max, ly_max],
+      eyes_size, cam_center, cam_metric, warp,
     )
 
     return reye_crop, leye_crop
 
+  def _detect_landmarks(self, image: np.ndarray, face_mesh=None):
+    height, width, _ = image.shape
+    face_mesh = face_mesh if face_mesh is not None else self._face_mesh
+
+    # Mark the image as not writable to pass by reference
+    image.flags.writeable = False
+    results = face_mesh.process(image)
+    image.flags.writeable = True
+
+    if not results.multi_face_landmarks:
+      return None
+
+    landmarks = results.multi_face_landmarks[0]
+    landmarks = self._parse_mediapipe_landmarks(landmarks)
+    landmarks = self._denormalize_landmarks(height, width, landmarks)
+
+    return landmarks
+
+  def _get_tracking_roi(self, height, width):
+    x_min, y_min, x_max, y_max = self._get_bbox_for_points(self._last_ldmks)
+
+    # Square region around the last face, clipped by image bounds
+    half_l = 0.5 * self._roi_expand * max(x_max - x_min, y_max - y_min)
+    center_x, center_y = (x_min + x_max) / 2, (y_min + y_max) / 2
+
+    rx_min, ry_min = max(int(center_x - half_l), 0), max(int(center_y - half_l), 0)
+    rx_max, ry_max = min(int(center_x + half_l), width), min(int(center_y + half_l), height)
+
+    return rx_min, ry_min, rx_max, ry_max
+
+  def _detect_landmarks_in_roi(self, image: np.ndarray):
+    height, width, _ = image.shape
+
+    rx_min, ry_min, rx_max, ry_max = self._get_tracking_roi(height, width)
+    if rx_max - rx_min < 2 or ry_max - ry_min < 2: return None
+
+    roi = np.ascontiguousarray(image[ry_min:ry_max, rx_min:rx_max])
+    landmarks = self._detect_landmarks(roi, self._roi_mesh)
+    if landmarks is None: return None
+
+    # The face leaves the region if it approaches the borders inside the image
+    x_min, y_min, x_max, y_max = self._get_bbox_for_points(landmarks)
+    margin = self._roi_margin * max(rx_max - rx_min, ry_max - ry_min)
+    if rx_min > 0 and x_min < margin: return None
+    if ry_min > 0 and y_min < margin: return None
+    if rx_max < width and x_max > rx_max - rx_min - margin: return None
+    if ry_max < height and y_max > ry_max - ry_min - margin: return None
+
+    return landmarks + np.array([rx_min, ry_min])
+
   def process(self, image: np.ndarray):
     '''Takes as input an RGB image of shape `(h, w, c)` and produces facial
     landmarks with mediapipe face mesh solution. Additionally, a rotation
     angle `theta` is returned, which the caller may use as a hint for alignment.
 
+    With roi tracking, landmarks are first searched for in a region around
+    the face from the last frame, then in the full frame if not found.
+
     Note that `uint8` is assumed as the data type for the input image.
     '''
 
-    height, width, _ = image.shape
+    landmarks = None
+    if self._roi_tracking and self._last_ldmks is not None:
+      landmarks = self._detect_landmarks_in_roi(image)
+    in_roi = landmarks is not None
 
-    # Mark the image as not writable to pass by reference
-    image.flags.writeable = False
-    results = self._face_mesh.process(image)
-    image.flags.writeable = True
+    if landmarks is None:
+      # Frames found in regions were not seen by the full frame face mesh
+      if self._last_in_roi and not self._static_image_mode: self._face_mesh.reset()
+      landmarks = self._detect_landmarks(image)
 
-    if not results.multi_face_landmarks:
+    self._last_ldmks, self._last_in_roi = landmarks, in_roi
+    if landmarks is None:
       return np.array([]), 0.0
 
-    landmarks = results.multi_face_landmarks[0].landmark
-    landmarks = self._parse_mediapipe_landmarks(landmarks)
-    landmarks = self._denormalize_landmarks(height, width, landmarks)
-
     # Simply use inner eye cornors to align the face, explanation:
     #   pt_r = landmarks[133]   # Right inner eye cornor
     #   pt_l = landmarks[362]   # Left inner eye cornor
@@ -247,14 +415,24 @@ class FaceAlignment():
 
     return landmarks, theta
 
+  def reset(self):
+    '''Forget the face tracked so far, before frames of a new video stream.'''
+    self._last_ldmks, self._last_in_roi = None, False
+    self._face_mesh.reset()
+    if self._roi_mesh is not None and self._roi_mesh is not self._face_mesh:
+      self._roi_mesh.reset()
+
   def close(self):
     '''Wrapper method for `close()` method of `FaceMesh` object.'''
     if not self._closed:
       self._face_mesh.close()
+      if self._roi_mesh is not None and self._roi_mesh is not self._face_mesh:
+        self._roi_mesh.close()
       self._closed = True
 
   def get_face_crop_without_align(self, image, landmarks, with_eyes=True,
-                                  width_expand=1.6, hw_ratio=0.6):
+                                  width_expand=1.6, hw_ratio=0.6,
+                                  face_size=None, eyes_size=None, warp=True):
     '''Takes as input an RGB image of shape `(h, w, c)`, and results
     from `process()` method, generates a face crop, and eye
     regions for both eyes if `with_eyes` is True.
@@ -265,6 +443,13 @@ class FaceAlignment():
     which is then used to crop eye regions.
 
     `hw_ratio`: the ratio of height and width for crop eye regions.
+
+    `face_size`: size (w, h) of the face crop, or None to keep crop size.
+
+    `eyes_size`: size (w, h) of the eye crops, or None to keep crop size.
+
+    `warp`: whether to warp the crops, otherwise crops only keep the affine
+    transform and the source image, for models that crop in the graph.
     '''
 
     height, width, _ = image.shape
@@ -278,7 +463,7 @@ class FaceAlignment():
     crop_half_b = 0.1 * (cy_max - cy_min)
     crop_half_w = crop_half_a + crop_half_b
 
-    padded, a, b, M = self._rotate_with_bounds(image, 0.0)
+    padded_size, a, b, M = self._rotation_with_bounds(height, width, 0.0)
     new_ldmks = landmarks + np.array([a, b])
 
     cx_min = int(center_x - crop_half_w + a)
@@ -287,24 +472,20 @@ class FaceAlignment():
     cy_max = int(center_y + crop_half_w + b)
     cy_max = cx_max - cx_min + cy_min
 
-    camera_center = [padded.shape[1] / 2, padded.shape[0] / 2]
+    camera_center = [padded_size[0] / 2, padded_size[1] / 2]
     camera_metric = max(height, width)
 
-    face_crop = NormalizedCropRegion(
-      padded[cy_min:cy_max, cx_min:cx_max],
-      self._get_crop_shift_and_size(
-        camera_center,
-        [cx_min, cy_min, cx_max, cy_max],
-        camera_metric,
-      ),
+    face_crop = self._get_crop_region(
+      image, M, a, b, [cx_min, cy_min, cx_max, cy_max],
+      face_size, camera_center, camera_metric, warp,
     )
 
     reye_crop, leye_crop = None, None
     if with_eyes:
       reye_crop, leye_crop = self._get_eyes_crop(
-        padded, new_ldmks,
+        image, M, a, b, new_ldmks,
         camera_center, camera_metric,
-        width_expand, hw_ratio,
+        width_expand, hw_ratio, eyes_size, warp,
       )
 
     # Normalize landmarks using camera center and camera metric (used for training)
@@ -316,28 +497,40 @@ class FaceAlignment():
     return (face_crop, reye_crop, leye_crop), norm_ldmks, new_ldmks
 
   def get_face_crop(self, image, landmarks, theta, with_eyes=True,
-                    width_expand=1.6, hw_ratio=0.6):
+                    width_expand=1.6, hw_ratio=0.6,
+                    face_size=None, eyes_size=None, warp=True):
     '''Takes as input an RGB image of shape `(h, w, c)`, and results
     from `process()` method, generates an aligned face crop, and eye
     regions for both eyes if `with_eyes` is True.
 
+    Each crop is warped from the source image in a single affine transform,
+    optionally resized to the model input size given by `face_size` and
+    `eyes_size`, which spares the caller from resizing the crops.
+
     `with_eyes`: whether to generate crops for both eyes.
 
     `width_expand`: expand the width between inner and outer eye corners,
     which is then used to crop eye regions.
 
     `hw_ratio`: the ratio of height and width for crop eye regions.
+
+    `face_size`: size (w, h) of the face crop, or None to keep crop size.
+
+    `eyes_size`: size (w, h) of the eye crops, or None to keep crop size.
+
+    `warp`: whether to warp the crops, otherwise crops only keep the affine
+    transform and the source image, for models that crop in the graph.
     '''
 
     height, width, _ = image.shape
 
     # Generate rotation matrix using `theta`, rotate around image center
-    rotated, a, b, M = self._rotate_with_bounds(image, theta)
+    padded_size, a, b, M = self._rotation_with_bounds(height, width, theta)
     new_ldmks = self.apply_rotation_matrix_2d(M, landmarks + np.array([a, b]))
 
     # The center of rotation is the center of the original image
     # Thus, a normalized position vector `CA = A - C` can be calculated
-    camera_center = [rotated.shape[1] / 2, rotated.shape[0] / 2]
+    camera_center = [padded_size[0] / 2, padded_size[1] / 2]
     camera_metric = max(height, width)
 
     # Crop face from the rotated image according to the bounding box
@@ -348,22 +541,18 @@ class FaceAlignment():
     # well with face mesh approximation (cx_max - cx_min)
     cy_max = cx_max - cx_min + cy_min
 
-    face_crop = NormalizedCropRegion(
-      rotated[cy_min:cy_max, cx_min:cx_max],
-      self._get_crop_shift_and_size(
-        camera_center,
-        [cx_min, cy_min, cx_max, cy_max],
-        camera_metric,
-      ),
+    face_crop = self._get_crop_region(
+      image, M, a, b, [cx_min, cy_min, cx_max, cy_max],
+      face_size, camera_center, camera_metric, warp,
     )
 
     # Crop eye regions from the rotated image, if cropping with eyes
     reye_crop, leye_crop = None, None
     if with_eyes:
       reye_crop, leye_crop = self._get_eyes_crop(
-        rotated, new_ldmks,
+        image, M, a, b, new_ldmks,
         camera_center, camera_metric,
-        width_expand, hw_ratio,
+        width_expand, hw_ratio, eyes_size, warp,
       )
 
     # Normalize landmarks using camera center and camera metric (used for training)
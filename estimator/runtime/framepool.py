@@ -0,0 +1,134 @@
+import numpy as np
+import threading
+import weakref
+
+
+_LIVE_POOLS = weakref.WeakSet()
+
+
+class FramePool:
+  def __init__(self, capacity, shape, dtype=np.uint8, register=True):
+    '''Fixed-size slots of frames with reference counts, frames are captured
+    into free slots and passed downstream as views, instead of copies.
+
+    A slot is taken by `acquire` with one reference, consumers that keep the
+    frame longer call `retain`, and each reference is dropped by `release`,
+    the slot is reused once no reference is left.
+
+    `capacity`: number of slots, `acquire` returns None if all are taken.
+
+    `shape`, `dtype`: layout of a frame, such as `(720, 1280, 3)`.
+
+    `register`: let `retain_frame` and `release_frame` find frames of this
+    pool, private pools that manage their slots themselves are left out.
+    '''
+
+    self.capacity = capacity
+    self.shape = tuple(shape)
+    self.dtype = np.dtype(dtype)
+
+    self._slots = np.empty((capacity, *self.shape), dtype=self.dtype)
+
+    self._base = self._slots.__array_interface__['data'][0]
+    self._stride = self._slots.strides[0]
+
+    self._lock = threading.Lock()
+    self._refs = [0] * capacity
+    self._free = list(range(capacity - 1, -1, -1))
+
+    self.acquired, self.exhausted = 0, 0
+
+    if register:
+      _LIVE_POOLS.add(self)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  def slot_index(self, frame):
+    '''Index of the slot that the frame (or a view into it) lives in, or None
+    if the frame is not from this pool.
+    '''
+
+    if self._slots is None or not isinstance(frame, np.ndarray): return None
+
+    offset = frame.__array_interface__['data'][0] - self._base
+    if offset < 0 or offset >= self._stride * self.capacity: return None
+
+    return offset // self._stride
+
+  def acquire(self):
+    '''Take a free slot with one reference, returns its frame, or None if all
+    slots are in use, so that the caller falls back to a new allocation.
+    '''
+
+    with self._lock:
+      if not self._free:
+        self.exhausted += 1
+        return None
+      index = self._free.pop()
+      self._refs[index] = 1
+      self.acquired += 1
+
+    return self._slots[index]
+
+  def retain(self, frame):
+    '''Add a reference to the slot of the frame, returns False if the frame
+    is not from this pool.
+    '''
+
+    index = self.slot_index(frame)
+    if index is None: return False
+
+    with self._lock:
+      self._refs[index] += 1
+
+    return True
+
+  def release(self, frame):
+    '''Drop a reference to the slot of the frame, returns False if the frame
+    is not from this pool.
+    '''
+
+    index = self.slot_index(frame)
+    if index is None: return False
+
+    with self._lock:
+      if self._refs[index] <= 0:
+        raise RuntimeError(f'slot {index} released more than retained')
+      self._refs[index] -= 1
+      if self._refs[index] == 0:
+        self._free.append(index)
+
+    return True
+
+  def stats(self):
+    '''Counters of acquired slots, failed acquisitions, and slots in use.'''
+    with self._lock:
+      return dict(acquired=self.acquired, exhausted=self.exhausted, in_use=self.capacity - len(self._free))
+
+  def close(self):
+    '''Drop the slots, frames still referenced must not be used afterwards.'''
+
+    _LIVE_POOLS.discard(self)
+    self._slots = None
+
+
+def retain_frame(frame):
+  '''Add a reference to the frame, if it lives in a frame pool, so that its
+  slot is not reused until `release_frame`. Other frames are left as is.
+  '''
+
+  for pool in list(_LIVE_POOLS):
+    if pool.retain(frame): return True
+  return False
+
+
+def release_frame(frame):
+  '''Drop a reference to the frame, if it lives in a frame pool.'''
+
+  for pool in list(_LIVE_POOLS):
+    if pool.release(frame): return True
+  return False
@@ -0,0 +1,209 @@
+from .log import runtime_logger
+from .pipeline import IMAGENET_MEAN, IMAGENET_STD
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper, version_converter
+
+
+rt_logger = runtime_logger(name='runtime').getChild('graph')
+
+
+IMAGE_INPUTS = ('face', 'reye', 'leye')
+
+# Patched models are marked in the metadata, listing the folded steps
+PATCHES_KEY = 'gpe.patches'
+
+
+def model_patches(model: onnx.ModelProto):
+  '''Names of patches applied to the model, such as `['preprocess']`.'''
+
+  for prop in model.metadata_props:
+    if prop.key == PATCHES_KEY:
+      return [name for name in prop.value.split(',') if name]
+  return []
+
+def mark_model_patch(model: onnx.ModelProto, patch_name):
+  patches = model_patches(model) + [patch_name]
+
+  for prop in model.metadata_props:
+    if prop.key == PATCHES_KEY:
+      prop.value = ','.join(patches)
+      return
+  model.metadata_props.add(key=PATCHES_KEY, value=patch_name)
+
+def find_graph_input(graph: onnx.GraphProto, name):
+  for graph_input in graph.input:
+    if graph_input.name == name:
+      return graph_input
+  raise KeyError(f'input "{name}" not found in the model graph')
+
+def rename_graph_input(graph: onnx.GraphProto, name, new_name):
+  # Nodes and outputs that consume the input read the renamed tensor instead
+  for node in graph.node:
+    node.input[:] = [new_name if x == name else x for x in node.input]
+  for graph_output in graph.output:
+    if graph_output.name == name:
+      graph_output.name = new_name
+
+def prepend_nodes(graph: onnx.GraphProto, nodes):
+  graph_nodes = list(nodes) + list(graph.node)
+  del graph.node[:]
+  graph.node.extend(graph_nodes)
+
+def image_input_dims(graph_input):
+  # Dimensions (n, c, h, w) of a float image input, copied as protos
+  tensor_type = graph_input.type.tensor_type
+  if tensor_type.elem_type != TensorProto.FLOAT:
+    raise ValueError(f'input "{graph_input.name}" is not a float tensor')
+
+  dims = [onnx.TensorShapeProto.Dimension() for _ in range(4)]
+  for dim, src_dim in zip(dims, tensor_type.shape.dim):
+    dim.CopyFrom(src_dim)
+  return dims
+
+def add_normalize_initializers(graph: onnx.GraphProto, mean, std):
+  # Normalization of pixel values (0 to 255): x * scale + bias, as (1, c, 1, 1)
+  scale = 1.0 / (255.0 * np.array(std, dtype=np.float64))
+  bias = -np.array(mean, dtype=np.float64) / np.array(std, dtype=np.float64)
+  graph.initializer.extend([
+    numpy_helper.from_array(scale.reshape(1, 3, 1, 1).astype(np.float32), 'gpe_normalize_scale'),
+    numpy_helper.from_array(bias.reshape(1, 3, 1, 1).astype(np.float32), 'gpe_normalize_bias'),
+  ])
+
+def make_normalize_nodes(name, output):
+  return [
+    helper.make_node('Mul', [name, 'gpe_normalize_scale'], [f'{name}_scaled']),
+    helper.make_node('Add', [f'{name}_scaled', 'gpe_normalize_bias'], [output]),
+  ]
+
+def graph_opset(model: onnx.ModelProto):
+  for opset in model.opset_import:
+    if opset.domain in ('', 'ai.onnx'):
+      return opset.version
+  raise ValueError('default opset not found in the model')
+
+
+def fold_preprocess(model: onnx.ModelProto, image_inputs=IMAGE_INPUTS,
+                    mean=IMAGENET_MEAN, std=IMAGENET_STD):
+  '''Prepend normalization and layout conversion of image inputs to the graph,
+  so that the model takes uint8 crops (n, h, w, c), instead of normalized
+  float32 crops (n, c, h, w). The model is patched in place.
+
+  Each image input is cast to float, transposed to (n, c, h, w), then scaled
+  by `1 / (255 * std)` and shifted by `-mean / std`, which matches host-side
+  normalization (`normalize_image_crop`).
+  '''
+
+  if model_patches(model):
+    raise ValueError(f'model has been patched already ({", ".join(model_patches(model))})')
+
+  graph = model.graph
+  add_normalize_initializers(graph, mean, std)
+
+  nodes = []
+  for name in image_inputs:
+    graph_input = find_graph_input(graph, name)
+    n, c, h, w = image_input_dims(graph_input)
+
+    rename_graph_input(graph, name, f'{name}_normalized')
+    nodes.extend([
+      helper.make_node('Cast', [name], [f'{name}_float'], to=TensorProto.FLOAT),
+      helper.make_node('Transpose', [f'{name}_float'], [f'{name}_nchw'], perm=[0, 3, 1, 2]),
+      *make_normalize_nodes(f'{name}_nchw', f'{name}_normalized'),
+    ])
+
+    tensor_type = graph_input.type.tensor_type
+    tensor_type.elem_type = TensorProto.UINT8
+    del tensor_type.shape.dim[:]
+    tensor_type.shape.dim.extend([n, h, w, c])
+
+  prepend_nodes(graph, nodes)
+  mark_model_patch(model, 'preprocess')
+
+  onnx.checker.check_model(model)
+  rt_logger.info(f'preprocess folded into inputs {", ".join(image_inputs)}')
+
+  return model
+
+def fold_crops(model: onnx.ModelProto, image_inputs=IMAGE_INPUTS,
+               mean=IMAGENET_MEAN, std=IMAGENET_STD):
+  '''Crop image inputs from the source frame in the graph, so that the model
+  takes a uint8 frame `frame` (n, h, w, c) and a crop transform of shape
+  (n, 2, 3) for each image input, such as `face_warp`, instead of crops.
+  Returns the patched model, which may be converted to opset 16.
+
+  A crop transform maps crop pixels to normalized frame coordinates (see
+  `normalize_crop_warp`), crops are then sampled by `GridSample` (bicubic),
+  which matches the warp in `get_face_crop`, and normalized on the fly.
+  '''
+
+  if model_patches(model):
+    raise ValueError(f'model has been patched already ({", ".join(model_patches(model))})')
+
+  # GridSample is available since opset 16, bicubic is renamed in opset 20
+  if graph_opset(model) < 16:
+    model = version_converter.convert_version(model, 16)
+  cubic_mode = 'cubic' if graph_opset(model) >= 20 else 'bicubic'
+
+  graph = model.graph
+  add_normalize_initializers(graph, mean, std)
+  graph.initializer.extend([
+    numpy_helper.from_array(np.array(0.0, dtype=np.float32), 'gpe_pixel_min'),
+    numpy_helper.from_array(np.array(255.0, dtype=np.float32), 'gpe_pixel_max'),
+  ])
+
+  batch_dim = image_input_dims(find_graph_input(graph, image_inputs[0]))[0]
+  frame_input = helper.make_tensor_value_info('frame', TensorProto.UINT8, [None, 'height', 'width', 3])
+  frame_input.type.tensor_type.shape.dim[0].CopyFrom(batch_dim)
+
+  nodes = [
+    helper.make_node('Cast', ['frame'], ['frame_float'], to=TensorProto.FLOAT),
+    helper.make_node('Transpose', ['frame_float'], ['frame_nchw'], perm=[0, 3, 1, 2]),
+  ]
+
+  warp_inputs = dict()
+  for name in image_inputs:
+    graph_input = find_graph_input(graph, name)
+    n, _, h, w = image_input_dims(graph_input)
+    if not h.HasField('dim_value') or not w.HasField('dim_value'):
+      raise ValueError(f'input "{name}" should have a fixed size (h, w)')
+    h, w = h.dim_value, w.dim_value
+
+    # Homogeneous pixel coordinates (x, y, 1) of the crop, in row-major order
+    ys, xs = np.mgrid[0:h, 0:w]
+    pixels = np.stack([xs.ravel(), ys.ravel(), np.ones(h * w)], axis=1)
+    graph.initializer.extend([
+      numpy_helper.from_array(pixels.astype(np.float32), f'gpe_{name}_pixels'),
+      numpy_helper.from_array(np.array([-1, h, w, 2], dtype=np.int64), f'gpe_{name}_grid_shape'),
+    ])
+
+    rename_graph_input(graph, name, f'{name}_normalized')
+    nodes.extend([
+      helper.make_node('Transpose', [f'{name}_warp'], [f'{name}_warp_t'], perm=[0, 2, 1]),
+      helper.make_node('MatMul', [f'gpe_{name}_pixels', f'{name}_warp_t'], [f'{name}_points']),
+      helper.make_node('Reshape', [f'{name}_points', f'gpe_{name}_grid_shape'], [f'{name}_grid']),
+      helper.make_node(
+        'GridSample', ['frame_nchw', f'{name}_grid'], [f'{name}_sampled'],
+        mode=cubic_mode, padding_mode='zeros', align_corners=0,
+      ),
+      helper.make_node('Clip', [f'{name}_sampled', 'gpe_pixel_min', 'gpe_pixel_max'], [f'{name}_crop']),
+      *make_normalize_nodes(f'{name}_crop', f'{name}_normalized'),
+    ])
+
+    warp_input = helper.make_tensor_value_info(f'{name}_warp', TensorProto.FLOAT, [None, 2, 3])
+    warp_input.type.tensor_type.shape.dim[0].CopyFrom(n)
+    warp_inputs[name] = warp_input
+
+  # The frame comes first, crop transforms take the place of image inputs
+  graph_inputs = [frame_input] + [warp_inputs.get(x.name, x) for x in graph.input]
+  del graph.input[:]
+  graph.input.extend(graph_inputs)
+
+  prepend_nodes(graph, nodes)
+  mark_model_patch(model, 'crops')
+
+  onnx.checker.check_model(model)
+  rt_logger.info(f'crops of inputs {", ".join(image_inputs)} folded into the graph')
+
+  return model
@@ -1,9 +1,14 @@
+from .log import runtime_logger
 from .one_euro import OneEuroFilter
 from .pipeline import (
+  ModelInputBuffers,
   prepare_model_input,
   rotate_vector_a,
+  model_batch_size,
+  model_input_layout,
   do_model_inference,
 )
+from .timing import StageTimer, measure
 
 import cv2
 import functools
@@ -11,6 +16,9 @@ import numpy as np
 import time
 
 
+rt_logger = runtime_logger(name='runtime').getChild('inference')
+
+
 def clamp_with_converter(value, v_min, v_max, converter=None):
   clipped_v = value
 
@@ -35,46 +43,87 @@ def gaze_vec_to_screen_xy(gaze_vector, screen_topleft_off_cm,
 
   return None
 
-def predict_model_output(model, crops, norm_ldmks, face_resize, eyes_resize):
+def predict_model_input(crops, norm_ldmks, face_resize, eyes_resize,
+                        buffers=None, index=0):
   # Prepare model input according to model type
   face_crop, reye_crop, leye_crop = crops
   reye_center, leye_center = norm_ldmks[468], norm_ldmks[473]
   eye_ldmks = np.concatenate([reye_center, leye_center])
 
-  model_input = prepare_model_input(face_crop, reye_crop, leye_crop, eye_ldmks,
-                                    face_resize, eyes_resize)
+  return prepare_model_input(face_crop, reye_crop, leye_crop, eye_ldmks,
+                             face_resize, eyes_resize, buffers, index)
+
+def predict_model_output(model, crops, norm_ldmks, face_resize, eyes_resize,
+                         buffers=None):
+  model_input = predict_model_input(crops, norm_ldmks, face_resize, eyes_resize, buffers)
   ort_outputs = do_model_inference(model, model_input)
 
   return ort_outputs
 
-def predict_screen_xy(model, crops, norm_ldmks, theta,
-                      topleft_offset, screen_size_px, screen_size_cm,
-                      face_resize, eyes_resize, gx_filter, gy_filter):
-  ort_outputs = predict_model_output(model, crops, norm_ldmks, face_resize, eyes_resize)
-
+def predict_model_output_batch(model, crops_batch, norm_ldmks_batch,
+                               face_resize, eyes_resize, buffers=None, batch_size=None,
+                               timings=None):
+  n_frames = len(crops_batch)
+
+  # Models exported with a fixed batch axis are fed chunk by chunk, the last
+  # chunk is padded with copies of the last frame, whose outputs are dropped
+  chunk_size = batch_size or n_frames
+  n_padded = -(-n_frames // chunk_size) * chunk_size
+
+  # Fill all frames into the batch slots of the (reused) input buffers
+  if buffers is None:
+    buffers = ModelInputBuffers(face_resize, eyes_resize, capacity=n_padded)
+  buffers.reserve(n_padded)
+
+  with measure(timings, 'normalize'):
+    for index, (crops, norm_ldmks) in enumerate(zip(crops_batch, norm_ldmks_batch)):
+      predict_model_input(crops, norm_ldmks, face_resize, eyes_resize, buffers, index)
+    buffers.repeat(n_frames - 1, n_frames, n_padded)
+
+  with measure(timings, 'model'):
+    # Outputs of chunks are copied, as bound sessions overwrite them on the next run
+    ort_outputs = [
+      [np.array(output) for output in do_model_inference(model, buffers.view(i, i + chunk_size))]
+      for i in range(0, n_padded, chunk_size)
+    ]
+
+  return [np.concatenate(outputs, axis=0)[:n_frames] for outputs in zip(*ort_outputs)]
+
+def project_screen_xy(gaze_cxy, theta, topleft_offset, screen_size_px, screen_size_cm,
+                      gx_filter, gy_filter, timestamp=None):
   # Gaze point predicted by model should be projected from prediction space
   # back into camera coordinate space, by rotating around origin with `theta`
   #   gx, gy = rotate_vector_a(gcx, gcy, theta).tolist()
-  gcx, gcy = ort_outputs[0].squeeze(0).tolist()
+  gcx, gcy = gaze_cxy.tolist()
   gaze_vec = rotate_vector_a(gcx, gcy, theta)
 
   # Display predicted gaze point on the screen
   gaze_screen_xy = gaze_vec_to_screen_xy(gaze_vec, topleft_offset,
                                          screen_size_px, screen_size_cm)
   if gaze_screen_xy is not None:
-    gx = gx_filter.filter(gaze_screen_xy[0])
-    gy = gy_filter.filter(gaze_screen_xy[1])
+    gx = gx_filter.filter(gaze_screen_xy[0], timestamp)
+    gy = gy_filter.filter(gaze_screen_xy[1], timestamp)
     gx = clamp_with_converter(gx, 0, screen_size_px[1], converter=int)
     gy = clamp_with_converter(gy, 0, screen_size_px[0], converter=int)
     gaze_screen_xy = (gx, gy)
 
   return gaze_screen_xy, gaze_vec
 
+def predict_screen_xy(model, crops, norm_ldmks, theta,
+                      topleft_offset, screen_size_px, screen_size_cm,
+                      face_resize, eyes_resize, gx_filter, gy_filter, buffers=None):
+  ort_outputs = predict_model_output(model, crops, norm_ldmks, face_resize, eyes_resize,
+                                     buffers)
+
+  return project_screen_xy(ort_outputs[0].squeeze(0), theta,
+                           topleft_offset, screen_size_px, screen_size_cm,
+                           gx_filter, gy_filter)
+
 
 class Inferencer:
   def __init__(self, topleft_offset, screen_size_px, screen_size_cm,
                face_resize=(224, 224), eyes_resize=(224, 224),
-               gx_filt_params=dict(), gy_filt_params=dict()):
+               gx_filt_params=dict(), gy_filt_params=dict(), timing=dict()):
     '''Initailize inference pipeline with device specific parameters.
 
     `topleft_offset`: offset of screen topleft corner in camera coordinate system.
@@ -90,19 +139,102 @@ class Inferencer:
     `gx_filt_params`: parameters for one-euro filter along x-axis.
 
     `gy_filt_params`: parameters for one-euro filter along y-axis.
+
+    `timing`: parameters for per-stage latency statistics, see `StageTimer`.
     '''
 
     self.hw_ratio = eyes_resize[1] / eyes_resize[0]
-    self.predict_fn = functools.partial(
-      predict_screen_xy,
+    self.crop_sizes = dict(face_size=tuple(face_resize), eyes_size=tuple(eyes_resize))
+    self.buffers = ModelInputBuffers(face_resize, eyes_resize)
+    self.predict_batch_fn = functools.partial(
+      predict_model_output_batch,
+      face_resize=face_resize,
+      eyes_resize=eyes_resize,
+      buffers=self.buffers,
+    )
+    self.project_fn = functools.partial(
+      project_screen_xy,
       topleft_offset=topleft_offset,
       screen_size_px=screen_size_px,
       screen_size_cm=screen_size_cm,
-      face_resize=face_resize,
-      eyes_resize=eyes_resize,
     )
     self.gx_filter = OneEuroFilter(**gx_filt_params)
     self.gy_filter = OneEuroFilter(**gy_filt_params)
+    self.timer = StageTimer(**timing)
+
+  def use_model(self, model):
+    '''Prepare model inputs in the input layout of the model, namely uint8
+    crops for models with normalization folded into the graph, or source
+    frames and crop transforms for models that crop in the graph.
+    '''
+
+    self.buffers.set_layout(model_input_layout(model))
+
+  @property
+  def warp_crops(self):
+    # Models that crop in the graph take crop transforms, instead of crops
+    return self.buffers.layout != 'frame_warp'
+
+  def reset(self):
+    '''Reset the one-euro filters, before frames of a new video stream.'''
+    self.gx_filter.reset()
+    self.gy_filter.reset()
+
+  def align_image(self, align, image, to_rgb=True, timings=None):
+    '''Detect face landmarks, returns the (RGB) image, landmarks and theta.'''
+
+    with measure(timings, 'color'):
+      if to_rgb: image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    with measure(timings, 'align'):
+      landmarks, theta = align.process(image)
+
+    return image, landmarks, theta
+
+  def prepare_input(self, align, image, landmarks, theta, buffers=None, timings=None):
+    '''Crop face and eyes from the aligned image, returns the model input,
+    written into `buffers` (or the buffers owned by this inferencer).
+    '''
+
+    with measure(timings, 'crop'):
+      crops, norm_ldmks, _ = align.get_face_crop(
+        image, landmarks, theta, hw_ratio=self.hw_ratio,
+        warp=self.warp_crops, **self.crop_sizes,
+      )
+
+    with measure(timings, 'normalize'):
+      return predict_model_input(
+        crops, norm_ldmks, self.crop_sizes['face_size'], self.crop_sizes['eyes_size'],
+        buffers if buffers is not None else self.buffers,
+      )
+
+  def predict_output(self, model, model_input, timings=None):
+    '''Run the model on the prepared model input.'''
+
+    with measure(timings, 'model'):
+      return do_model_inference(model, model_input)
+
+  def project_output(self, ort_outputs, theta, timestamp=None, timings=None):
+    '''Project model output into the screen, returns filtered PoG (x, y) in
+    screen coordinate frame and non-filtered PoG (x, y) in camera coordinate frame.
+    '''
+
+    with measure(timings, 'project'):
+      return self.project_fn(
+        ort_outputs[0].squeeze(0), theta, timestamp=timestamp,
+        gx_filter=self.gx_filter, gy_filter=self.gy_filter,
+      )
+
+  def record_timings(self, timings):
+    '''Add per-stage timings of a frame to the rolling statistics, which
+    are logged periodically if configured.
+    '''
+
+    self.timer.update(timings)
+    self.timer.maybe_log(rt_logger)
+
+  def timing_summary(self):
+    '''Per-stage latency percentiles in milliseconds, see `StageTimer.summary`.'''
+    return self.timer.summary()
 
   def run(self, model, align, image, to_rgb=True):
     '''Run inference with model on the aligned image.
@@ -112,28 +244,90 @@ class Inferencer:
       pog_scn: filtered PoG (x, y) in screen coordinate frame.
       pog_cam: non-filtered PoG (x, y) in camera coordinate frame.
       time: inference time in seconds.
+      stages: time spent in each stage in nanoseconds, namely color,
+        align, crop, normalize, model and project.
 
     Note that pog_scn and pog_cam are returned only on success.
     '''
 
-    result = dict(success=False)
-    inference_start = time.time()
+    timings = dict()
+    result = dict(success=False, stages=timings)
+    inference_start = time.perf_counter_ns()
 
-    if to_rgb: image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    landmarks, theta = align.process(image)
+    image, landmarks, theta = self.align_image(align, image, to_rgb, timings)
     if len(landmarks) > 0:
-      crops, norm_ldmks, _ = align.get_face_crop(
-        image, landmarks, theta, hw_ratio=self.hw_ratio,
-      )
-      pog_scn, pog_cam = self.predict_fn(
-        model, crops, norm_ldmks, theta,
-        gx_filter=self.gx_filter, gy_filter=self.gy_filter,
-      )
+      model_input = self.prepare_input(align, image, landmarks, theta, timings=timings)
+      ort_outputs = self.predict_output(model, model_input, timings)
+      pog_scn, pog_cam = self.project_output(ort_outputs, theta, timings=timings)
 
-      inference_finish = time.time()
+      inference_finish = time.perf_counter_ns()
       result.update(dict(
         success=True, pog_scn=pog_scn, pog_cam=pog_cam,
-        time=inference_finish - inference_start,
+        time=(inference_finish - inference_start) / 1e9,
       ))
 
+    self.record_timings(timings)
+
     return result
+
+  def run_batch(self, model, align, images, timestamps=None, to_rgb=True):
+    '''Run inference with model on a batch of images, in a single model call.
+
+    Face alignment runs frame by frame, then the face, eyes and key points
+    of all frames with a detected face are stacked along the batch axis.
+    Predictions are split back into per-frame results, which are filtered
+    by the one-euro filters in frame order.
+
+    `images`: a sequence of images, ordered by capture time.
+
+    `timestamps`: optional capture timestamps (seconds) for the filters,
+    the wall clock is used if omitted.
+
+    Returns a list of result dictionaries, one for each image, with the same
+    keys as `run`. Note that `time`, as well as the normalize and model
+    stages, are batch timings amortized over frames.
+    '''
+
+    results = [dict(success=False, stages=dict()) for _ in images]
+    inference_start = time.perf_counter_ns()
+
+    aligned = []  # Frame index, crops, normalized landmarks and theta
+    for index, image in enumerate(images):
+      timings = results[index]['stages']
+      image, landmarks, theta = self.align_image(align, image, to_rgb, timings)
+      if len(landmarks) > 0:
+        with measure(timings, 'crop'):
+          crops, norm_ldmks, _ = align.get_face_crop(
+            image, landmarks, theta, hw_ratio=self.hw_ratio,
+            warp=self.warp_crops, **self.crop_sizes,
+          )
+        aligned.append((index, crops, norm_ldmks, theta))
+
+    if len(aligned) > 0:
+      batch_timings = dict()
+      ort_outputs = self.predict_batch_fn(
+        model, [a[1] for a in aligned], [a[2] for a in aligned],
+        batch_size=model_batch_size(model), timings=batch_timings,
+      )
+
+      for (index, _, _, theta), gaze_cxy in zip(aligned, ort_outputs[0]):
+        timings = results[index]['stages']
+        timings.update({k: v // len(aligned) for k, v in batch_timings.items()})
+
+        timestamp = timestamps[index] if timestamps is not None else None
+        with measure(timings, 'project'):
+          pog_scn, pog_cam = self.project_fn(
+            gaze_cxy, theta, timestamp=timestamp,
+            gx_filter=self.gx_filter, gy_filter=self.gy_filter,
+          )
+        results[index].update(dict(success=True, pog_scn=pog_scn, pog_cam=pog_cam))
+
+    inference_finish = time.perf_counter_ns()
+    frame_time = (inference_finish - inference_start) / 1e9 / max(len(images), 1)
+    for index, _, _, _ in aligned:
+      results[index]['time'] = frame_time
+
+    for result in results:
+      self.record_timings(result['stages'])
+
+    return results
@@ -29,6 +29,12 @@ class OneEuroFilter():
 
     self._use_clock = clock
 
+  def reset(self):
+    '''Forget the signal filtered so far.'''
+    self._sig = None
+    self._dsig = None
+    self._time = None
+
   def _alpha(self, te, fc):
     a = 2 * math.pi * te * fc
     alpha = a / (1.0 + a)
@@ -45,6 +51,9 @@ class OneEuroFilter():
     if self._sig is not None:
       te = timestamp - self._time
 
+      # Signals sharing a timestamp (eg. batched frames) cannot be blended
+      if te <= 0.0: return self._sig
+
       a_dsig = self._alpha(te, self._d_cutoff)
       dsig = (signal - self._sig) / te
       dsig_hat = self._alpha_blend(a_dsig, dsig, self._dsig)
@@ -1,38 +1,286 @@
+from .log import runtime_logger
+
 import cv2  # OpenCV-Python
+import hashlib
 import numpy as np
 import onnx, onnxruntime
+import os
 import os.path as osp
 
 
-def load_onnx_model(model_path):
+rt_logger = runtime_logger(name='runtime').getChild('pipeline')
+
+
+_GRAPH_OPT_LEVELS = {
+  'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+  'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+  'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+  'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_EXECUTION_MODES = {
+  'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+  'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+_ORT_INPUT_DTYPES = {
+  'tensor(float)': np.float32,
+  'tensor(float16)': np.float16,
+  'tensor(double)': np.float64,
+  'tensor(uint8)': np.uint8,
+  'tensor(int8)': np.int8,
+  'tensor(int32)': np.int32,
+  'tensor(int64)': np.int64,
+}
+
+
+def create_session_options(intra_op_threads=0, inter_op_threads=0,
+                           graph_opt_level='all', execution_mode='sequential'):
+  '''Create session options for onnxruntime, zero threads means default.'''
+
+  options = onnxruntime.SessionOptions()
+
+  options.intra_op_num_threads = intra_op_threads
+  options.inter_op_num_threads = inter_op_threads
+  options.graph_optimization_level = _GRAPH_OPT_LEVELS[graph_opt_level]
+  options.execution_mode = _EXECUTION_MODES[execution_mode]
+
+  return options
+
+def hash_model_file(model_path, chunk_size=1 << 20):
+  digest = hashlib.sha256()
+
+  with open(model_path, 'rb') as model_file:
+    for chunk in iter(lambda: model_file.read(chunk_size), b''):
+      digest.update(chunk)
+
+  return digest.hexdigest()
+
+def optimized_model_path(model_path, cache_path, graph_opt_level):
+  # Optimized graphs depend on the model, the optimization level and the runtime
+  model_name = osp.splitext(osp.basename(model_path))[0]
+  model_hash = hash_model_file(model_path)[:16]
+  ort_version = onnxruntime.__version__
+
+  cache_name = f'{model_name}-{model_hash}-{graph_opt_level}-ort{ort_version}.onnx'
+  return osp.join(cache_path, cache_name)
+
+def warmup_model(model, runs=1):
+  # Run the model on dummy inputs, dynamic axes are set to 1
+  dummy_input = {
+    node.name: np.zeros(
+      [d if isinstance(d, int) else 1 for d in node.shape],
+      dtype=_ORT_INPUT_DTYPES.get(node.type, np.float32),
+    )
+    for node in model.get_inputs()
+  }
+
+  for _ in range(runs):
+    model.run(None, dummy_input)
+
+class BoundSession:
+  def __init__(self, session: onnxruntime.InferenceSession):
+    '''Inference session that runs with IO binding, where inputs are bound
+    in place and outputs are written into preallocated arrays, so that no
+    tensor is allocated per run once the shapes have been seen.
+
+    Inputs are bound again only if they are not the arrays bound last time,
+    thus inputs written in place (eg. `ModelInputBuffers`) are bound once.
+
+    Note that arrays returned by `run` are overwritten by the next run, copy
+    them if kept any longer. Other attributes are those of the session.
+
+    `session`: the wrapped inference session (on CPU).
+    '''
+
+    self.session = session
+    self._binding = session.io_binding()
+
+    self._bound_inputs = dict()   # Input name -> (address, shape, dtype, array)
+    self._bound_outputs = None    # Output arrays bound last time
+    self._output_arrays = dict()  # Batch size -> output arrays
+    self._output_nodes = session.get_outputs()
+
+  def __getattr__(self, name):
+    return getattr(self.session, name)
+
+  def _bind_input(self, name, array):
+    array = np.ascontiguousarray(array)
+    key = (array.__array_interface__['data'][0], array.shape, array.dtype)
+
+    bound = self._bound_inputs.get(name)
+    if bound is not None and bound[:3] == key: return
+
+    self._binding.bind_cpu_input(name, array)
+    self._bound_inputs[name] = (*key, array)
+
+  def _outputs_for(self, batch_size):
+    # Outputs are allocated by ORT if any axis other than batch is dynamic
+    if batch_size not in self._output_arrays:
+      outputs = []
+      for node in self._output_nodes:
+        dims = [batch_size if i == 0 and not isinstance(d, int) else d for i, d in enumerate(node.shape)]
+        if not all(isinstance(d, int) for d in dims): return None
+        outputs.append(np.empty(dims, dtype=_ORT_INPUT_DTYPES.get(node.type, np.float32)))
+      self._output_arrays[batch_size] = outputs
+    return self._output_arrays[batch_size]
+
+  def run(self, output_names, input_feed, run_options=None):
+    for name, array in input_feed.items():
+      self._bind_input(name, array)
+
+    batch_size = len(next(iter(input_feed.values())))
+    outputs = self._outputs_for(batch_size)
+
+    if outputs is None:
+      self._binding.clear_binding_outputs()
+      for node in self._output_nodes:
+        self._binding.bind_output(node.name)
+      self._bound_outputs = None
+    elif outputs is not self._bound_outputs:
+      for node, output in zip(self._output_nodes, outputs):
+        self._binding.bind_output(
+          node.name, 'cpu', 0, output.dtype, output.shape, output.__array_interface__['data'][0],
+        )
+      self._bound_outputs = outputs
+
+    self.session.run_with_iobinding(self._binding, run_options)
+
+    if outputs is None:
+      outputs = self._binding.copy_outputs_to_cpu()
+    if output_names is not None:
+      names = [node.name for node in self._output_nodes]
+      outputs = [outputs[names.index(name)] for name in output_names]
+
+    return outputs
+
+
+def load_onnx_model(model_path, session=dict(), cache_path='', warmup=0, io_binding=False):
+  '''Load onnx model as an inference session.
+
+  `model_path`: path to the onnx model.
+
+  `session`: session options, see also `create_session_options`.
+
+  `cache_path`: folder for optimized models, keyed by model hash. Cached
+  models skip the model checker and graph optimizations on later loads.
+
+  `warmup`: number of runs on dummy inputs before the session is returned.
+
+  `io_binding`: wrap the session as a `BoundSession`, see also its caveats.
+  '''
+
   model_path = osp.abspath(model_path)
+  session = dict(session)
+  graph_opt_level = session.get('graph_opt_level', 'all')
+
+  cached_path = ''
+  if cache_path:
+    try:
+      os.makedirs(cache_path, exist_ok=True)
+      cached_path = optimized_model_path(model_path, cache_path, graph_opt_level)
+    except Exception as ex:
+      rt_logger.warning(f'cannot use model cache "{cache_path}", due to {ex}')
+
+  if cached_path and osp.isfile(cached_path):
+    # The cached model has been checked and optimized already
+    session['graph_opt_level'] = 'disable'
+    options = create_session_options(**session)
+    model = onnxruntime.InferenceSession(cached_path, options)
+    rt_logger.info(f'optimized model loaded from cache "{cached_path}"')
+
+  else:
+    model = onnx.load_model(model_path)
+    onnx.checker.check_model(model)
+
+    options = create_session_options(**session)
+    if cached_path: options.optimized_model_filepath = cached_path
+    model = onnxruntime.InferenceSession(model_path, options)
+
+  if model_input_layout(model) == 'nhwc_uint8':
+    rt_logger.info('model takes uint8 crops, normalization runs in the graph')
+  elif model_input_layout(model) == 'frame_warp':
+    rt_logger.info('model takes source frames, cropping runs in the graph')
 
-  model = onnx.load_model(model_path)
-  onnx.checker.check_model(model)
-  model = onnxruntime.InferenceSession(model_path)
+  if io_binding:
+    model = BoundSession(model)
+
+  if warmup > 0:
+    warmup_model(model, warmup)
 
   return model
 
-def load_model(config_path, model_path):
+def variant_model_path(model_path, variant=''):
+  # Variants are saved next to the model, such as `model-int8-static.onnx`
+  if not variant: return model_path
+  model_root, model_ext = osp.splitext(model_path)
+  return f'{model_root}-{variant}{model_ext}'
+
+def load_model(config_path, model_path, session=dict(), cache_path='', warmup=0, variant='',
+               io_binding=False):
   config_root = osp.dirname(osp.abspath(config_path))
   model_path = osp.join(config_root, model_path)
-  return load_onnx_model(model_path)
+  if cache_path: cache_path = osp.join(config_root, cache_path)
 
+  if variant:
+    if osp.isfile(variant_model_path(model_path, variant)):
+      model_path = variant_model_path(model_path, variant)
+      rt_logger.info(f'model variant "{variant}" selected')
+    else:
+      rt_logger.warning(f'model variant "{variant}" not found, using the original model')
+
+  return load_onnx_model(model_path, session, cache_path, warmup, io_binding)
+
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
 
-def prepare_input_image_crop(cv2_image):
-  np_image = np.array(cv2_image, dtype=np.float32) / 255.0
 
-  mean = np.array([0.485, 0.456, 0.406])
-  std = np.array([0.229, 0.224, 0.225])
-  normed_image = (np_image - mean) / std
+def create_normalize_lut(mean=IMAGENET_MEAN, std=IMAGENET_STD):
+  # Per-channel lookup table: (v / 255 - mean) / std for all uint8 values
+  values = np.arange(256, dtype=np.float64) / 255.0
+  lut = (values[None, :] - np.array(mean)[:, None]) / np.array(std)[:, None]
+  return lut.astype(np.float32)
 
-  np_image = np.transpose(normed_image, axes=(2, 0, 1))
+_NORMALIZE_LUT = create_normalize_lut()
 
-  np_image = np_image.astype(dtype=np.float32)
-  np_image = np.expand_dims(np_image, axis=0)
+
+def normalize_image_crop(cv2_image, out, lut=_NORMALIZE_LUT):
+  # Write uint8 image (h, w, c) into float32 buffer (c, h, w) in a single pass,
+  # note that uint8 values never exceed the lut, so 'clip' avoids buffering
+  for channel in range(out.shape[0]):
+    np.take(lut[channel], cv2_image[:, :, channel], out=out[channel], mode='clip')
+  return out
+
+def prepare_input_image_crop(cv2_image):
+  height, width, channels = cv2_image.shape
+  np_image = np.empty((1, channels, height, width), dtype=np.float32)
+  normalize_image_crop(cv2_image, np_image[0])
 
   return np_image
 
+def facenet_input(image: np.ndarray, buffer: np.ndarray = None):
+  '''Normalize croped face image into FaceNet model input (1, c, h, w),
+  which is written into `buffer` (float32) if given, so that it is reused.
+  '''
+
+  if buffer is None:
+    buffer = np.empty((1, *np.transpose(image, (2, 0, 1)).shape), dtype=np.float32)
+
+  np.subtract(np.transpose(image, (2, 0, 1)), 127.5, out=buffer[0], dtype=np.float32)
+  np.divide(buffer[0], 128.0, out=buffer[0])
+
+  return {'img': buffer}
+
+def normalize_crop_warp(warp, height, width):
+  # Map crop pixels to normalized source coordinates in [-1, 1], namely the
+  # sampling grid of `GridSample` (align_corners=0) for a (h, w) source
+  to_grid = np.array([
+    [2.0 / width, 0.0, 1.0 / width - 1.0],
+    [0.0, 2.0 / height, 1.0 / height - 1.0],
+  ])
+  return np.dot(to_grid, np.concatenate([warp, [[0.0, 0.0, 1.0]]]))
+
 def prepare_input_key_points(face_bbox, eye_ldmks):
   kpts_ip = np.concatenate([face_bbox, eye_ldmks], axis=0)
 
@@ -41,22 +289,150 @@ def prepare_input_key_points(face_bbox, eye_ldmks):
 
   return kpts_ip
 
+
+class ModelInputBuffers:
+  def __init__(self, face_resize=(224, 224), eyes_resize=(224, 224), capacity=1,
+               layout='nchw_float'):
+    '''Preallocated model inputs, reused across frames to avoid allocations.
+
+    Crops are resized into uint8 buffers, then normalized into float32 buffers
+    of shape (n, c, h, w), where the first axis holds up to `capacity` frames.
+    Inputs returned by `view` are overwritten once the slots are filled again.
+
+    `face_resize`: resize input face image for estimator.
+
+    `eyes_resize`: resize input eye images for estimator.
+
+    `capacity`: number of frames allocated in advance, grows on demand.
+
+    `layout`: input layout of the model, see `model_input_layout`. Crops are
+    resized into uint8 buffers of shape (n, h, w, c) directly for models with
+    normalization folded into the graph, which are not normalized on host.
+    Models that crop in the graph take source frames and crop transforms of
+    shape (n, 2, 3) instead, where crops are not warped (see `get_face_crop`).
+    '''
+
+    self.resizes = dict(face=tuple(face_resize), reye=tuple(eyes_resize), leye=tuple(eyes_resize))
+    self.resized = {
+      name: np.empty((dsize[1], dsize[0], 3), dtype=np.uint8)
+      for name, dsize in self.resizes.items()
+    }
+
+    self.layout = layout
+    self.capacity = 0
+    self.reserve(capacity)
+
+  def set_layout(self, layout):
+    '''Switch to another input layout, buffers are allocated again.'''
+
+    if layout == self.layout: return
+
+    capacity, self.capacity = self.capacity, 0
+    self.layout = layout
+    self.reserve(capacity)
+
+  def reserve(self, capacity):
+    '''Make sure there are at least `capacity` frame slots.'''
+
+    if capacity <= self.capacity: return
+
+    if self.layout == 'frame_warp':
+      self.inputs = {
+        f'{name}_warp': np.empty((capacity, 2, 3), dtype=np.float32)
+        for name in self.resizes.keys()
+      }
+      self.frames = [None] * capacity
+      self.frame_batch = None
+    elif self.layout == 'nhwc_uint8':
+      self.inputs = {
+        name: np.empty((capacity, dsize[1], dsize[0], 3), dtype=np.uint8)
+        for name, dsize in self.resizes.items()
+      }
+    else:
+      self.inputs = {
+        name: np.empty((capacity, 3, dsize[1], dsize[0]), dtype=np.float32)
+        for name, dsize in self.resizes.items()
+      }
+    self.inputs['kpts'] = np.empty((capacity, 8), dtype=np.float32)
+    self.capacity = capacity
+
+  def fill(self, index, face_crop, reye_crop, leye_crop, eye_ldmks):
+    '''Resize and normalize crops of a frame into slot `index`.'''
+
+    if self.layout == 'frame_warp':
+      return self._fill_warp(index, face_crop, reye_crop, leye_crop, eye_ldmks)
+
+    raw_input = self.layout == 'nhwc_uint8'
+
+    crops = dict(face=face_crop, reye=reye_crop, leye=leye_crop)
+    for name, crop in crops.items():
+      resized = crop.get_crop()
+      dst = self.inputs[name][index] if raw_input else self.resized[name]
+      # Crops warped at the model input size need no further resizing
+      if resized.shape[1::-1] != self.resizes[name]:
+        resized = cv2.resize(resized, self.resizes[name],
+                             dst=dst, interpolation=cv2.INTER_CUBIC)
+      elif raw_input:
+        np.copyto(dst, resized)
+
+      if not raw_input:
+        normalize_image_crop(resized, self.inputs[name][index])
+
+    self.inputs['kpts'][index, :4] = face_crop.get_sas()
+    self.inputs['kpts'][index, 4:] = eye_ldmks
+
+  def repeat(self, index, start, stop):
+    '''Copy inputs of slot `index` into slots [start, stop), eg. padding.'''
+
+    for array in self.inputs.values():
+      array[start:stop] = array[index]
+    if self.layout == 'frame_warp':
+      self.frames[start:stop] = [self.frames[index]] * (stop - start)
+
+  def _fill_warp(self, index, face_crop, reye_crop, leye_crop, eye_ldmks):
+    # Crops are warped in the graph, from the source frame of the face crop
+    self.frames[index] = face_crop.get_source()
+    height, width = self.frames[index].shape[:2]
+
+    crops = dict(face=face_crop, reye=reye_crop, leye=leye_crop)
+    for name, crop in crops.items():
+      self.inputs[f'{name}_warp'][index] = normalize_crop_warp(crop.get_warp(), height, width)
+
+    self.inputs['kpts'][index, :4] = face_crop.get_sas()
+    self.inputs['kpts'][index, 4:] = eye_ldmks
+
+  def _frame_view(self, start, stop):
+    # A single frame is passed as is, frames of a batch are stacked
+    frames = self.frames[start:stop]
+    if len(frames) == 1:
+      return np.ascontiguousarray(frames[0])[None]
+
+    shape = (len(frames), *frames[0].shape)
+    if self.frame_batch is None or self.frame_batch.shape[1:] != shape[1:] \
+        or self.frame_batch.shape[0] < shape[0]:
+      self.frame_batch = np.empty((self.capacity, *shape[1:]), dtype=np.uint8)
+    return np.stack(frames, out=self.frame_batch[:len(frames)])
+
+  def view(self, start, stop):
+    '''Model inputs for slots [start, stop), as contiguous views.'''
+
+    inputs = {name: array[start:stop] for name, array in self.inputs.items()}
+    if self.layout == 'frame_warp':
+      inputs['frame'] = self._frame_view(start, stop)
+    return inputs
+
+
 def prepare_model_input(face_crop, reye_crop, leye_crop, eye_ldmks,
-                        face_resize=(224, 224), eyes_resize=(224, 224)):
-  # Get resized crops: ndarray of shape (h, w, c)
-  face = cv2.resize(face_crop.get_crop(), face_resize, interpolation=cv2.INTER_CUBIC)
-  reye = cv2.resize(reye_crop.get_crop(), eyes_resize, interpolation=cv2.INTER_CUBIC)
-  leye = cv2.resize(leye_crop.get_crop(), eyes_resize, interpolation=cv2.INTER_CUBIC)
+                        face_resize=(224, 224), eyes_resize=(224, 224),
+                        buffers=None, index=0):
+  # Inputs are written into slot `index` of the buffers, if provided
+  if buffers is None:
+    buffers = ModelInputBuffers(face_resize, eyes_resize)
 
   # Convert inputs to ndarrays requested by the estimation model
-  model_input = {
-    'face': prepare_input_image_crop(face),
-    'reye': prepare_input_image_crop(reye),
-    'leye': prepare_input_image_crop(leye),
-    'kpts': prepare_input_key_points(face_crop.get_sas(), eye_ldmks),
-  }
+  buffers.fill(index, face_crop, reye_crop, leye_crop, eye_ldmks)
 
-  return model_input
+  return buffers.view(index, index + 1)
 
 
 def rotate_vector_a(x, y, theta):
@@ -86,5 +462,18 @@ def rotate_vector_v(x, y, theta):
     for i in range(len(theta))
   ], axis=0)
 
+def model_input_layout(model):
+  # Models patched by `fold_preprocess` take uint8 crops (n, h, w, c), while
+  # models patched by `fold_crops` take source frames and crop transforms
+  inputs = {node.name: node for node in model.get_inputs()}
+  if 'frame' in inputs: return 'frame_warp'
+  if 'face' in inputs and inputs['face'].type == 'tensor(uint8)': return 'nhwc_uint8'
+  return 'nchw_float'
+
+def model_batch_size(model):
+  # Fixed batch size of the model, or None if the batch axis is dynamic
+  batch_size = model.get_inputs()[0].shape[0]
+  return batch_size if isinstance(batch_size, int) else None
+
 def do_model_inference(model, model_input):
   return model.run(None, model_input)
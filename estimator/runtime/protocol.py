@@ -0,0 +1,55 @@
+import numpy as np
+
+
+# Binary gaze frames: a header, followed by `count` records (little-endian)
+#   header: version (u8), kind (u8), count (u16)
+#   record: seq (u32), fid (u32), timestamp (f64), gx (f32), gy (f32),
+#           valid (u8), padding (3 bytes)
+GAZE_PROTOCOL_VERSION = 1
+GAZE_FRAME_KIND = 1
+
+GAZE_HEADER_DTYPE = np.dtype([
+  ('version', '<u1'), ('kind', '<u1'), ('count', '<u2'),
+])
+
+GAZE_RECORD_DTYPE = np.dtype({
+  'names': ['seq', 'fid', 'timestamp', 'gx', 'gy', 'valid'],
+  'formats': ['<u4', '<u4', '<f8', '<f4', '<f4', '<u1'],
+  'offsets': [0, 4, 8, 16, 20, 24],
+  'itemsize': 28,
+})
+
+
+def gaze_protocols():
+  '''Protocols for gaze updates, advertised in the server hello.'''
+
+  return dict(
+    json=dict(),
+    binary=dict(
+      version=GAZE_PROTOCOL_VERSION,
+      header_size=GAZE_HEADER_DTYPE.itemsize,
+      record_size=GAZE_RECORD_DTYPE.itemsize,
+    ),
+  )
+
+
+def pack_gaze_records(records):
+  '''Pack results read from a `ResultRing` into a binary gaze frame, where
+  gx and gy are taken from `pog_cam` (zero if not valid).
+  '''
+
+  header = np.zeros(1, dtype=GAZE_HEADER_DTYPE)
+  header['version'] = GAZE_PROTOCOL_VERSION
+  header['kind'] = GAZE_FRAME_KIND
+  header['count'] = len(records)
+
+  packed = np.zeros(len(records), dtype=GAZE_RECORD_DTYPE)
+  packed['seq'] = records['seq']
+  packed['fid'] = records['fid']
+  packed['timestamp'] = records['timestamp']
+  packed['valid'] = records['valid']
+  packed['gx'] = np.where(records['valid'], records['pog_cam'][:, 0], 0.0)
+  packed['gy'] = np.where(records['valid'], records['pog_cam'][:, 1], 0.0)
+
+  return header.tobytes() + packed.tobytes()
+
@@ -0,0 +1,89 @@
+from .log import runtime_logger
+from .pipeline import variant_model_path
+
+from onnxruntime.quantization import (
+  CalibrationDataReader,
+  QuantFormat,
+  QuantType,
+  quantize_dynamic,
+  quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+import os
+import os.path as osp
+import tempfile
+
+
+rt_logger = runtime_logger(name='runtime').getChild('quantize')
+
+
+QUANT_VARIANTS = {
+  'dynamic': 'int8-dynamic',
+  'static': 'int8-static',
+}
+
+
+class CalibrationReader(CalibrationDataReader):
+  def __init__(self, inputs_iter):
+    '''Feed model inputs to static quantization, one dict per frame.
+
+    `inputs_iter`: an iterable of model input dicts, which are consumed
+    only once, note that arrays should not be overwritten afterwards.
+    '''
+
+    self._inputs = iter(inputs_iter)
+
+  def get_next(self):
+    return next(self._inputs, None)
+
+
+def preprocess_model(model_path, output_path):
+  '''Shape inference and graph cleanup recommended before quantization, the
+  original model is copied as is if preprocessing fails.
+  '''
+
+  try:
+    quant_pre_process(model_path, output_path, skip_symbolic_shape=True)
+  except Exception as ex:
+    rt_logger.warning(f'cannot preprocess model "{model_path}", due to {ex}')
+    with open(model_path, 'rb') as src, open(output_path, 'wb') as dst:
+      dst.write(src.read())
+
+def quantize_model(model_path, mode, inputs_iter=None, per_channel=True):
+  '''Quantize weights (and activations if static) of the model to INT8,
+  saved as a model variant next to the model, returns its path.
+
+  `mode`: 'dynamic' quantizes weights only, activations are quantized on the
+  fly, while 'static' quantizes activations with ranges from calibration.
+
+  `inputs_iter`: model inputs for calibration, required by 'static'.
+
+  `per_channel`: quantize weights per output channel, for 'static'.
+  '''
+
+  output_path = variant_model_path(model_path, QUANT_VARIANTS[mode])
+
+  with tempfile.TemporaryDirectory() as temp_folder:
+    prep_path = osp.join(temp_folder, osp.basename(model_path))
+    preprocess_model(model_path, prep_path)
+
+    if mode == 'dynamic':
+      quantize_dynamic(prep_path, output_path, weight_type=QuantType.QInt8)
+
+    elif mode == 'static':
+      if inputs_iter is None:
+        raise ValueError('static quantization requires calibration inputs')
+      quantize_static(
+        prep_path, output_path, CalibrationReader(inputs_iter),
+        quant_format=QuantFormat.QDQ, per_channel=per_channel,
+        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+      )
+
+    else:
+      raise ValueError(f'unsupported quantization mode "{mode}"')
+
+  model_size = os.path.getsize(output_path) / (1 << 20)
+  rt_logger.info(f'{mode} quantized model saved to "{output_path}" ({model_size:.1f} MB)')
+
+  return output_path
@@ -0,0 +1,129 @@
+from .container import ImageReader, is_chunked
+from .log import runtime_logger
+from .ringbuf import RESULT_STAGES, result_dtype
+
+import cv2  # OpenCV-Python
+import numpy as np
+import os
+import os.path as osp
+import re
+
+
+rt_logger = runtime_logger(name='runtime').getChild('replay')
+
+
+_FRAME_NAME = re.compile(r'^(\d{5})\.(jpg|png|webp)$')
+
+
+class ReplaySource:
+  def __init__(self, source, fps=30.0):
+    '''Frames of a recording folder (image files or chunk files, as saved
+    in record mode) or a video file, read as fast as possible.
+
+    `source`: path to the recording folder or the video file.
+
+    `fps`: frame rate of recordings, which keep no capture timestamps, so
+    that frame timestamps are derived from frame ids. Timestamps of video
+    frames are taken from the video.
+    '''
+
+    if not osp.exists(source):
+      raise FileNotFoundError(f'replay source "{source}" not found')
+
+    self.source = source
+    self.fps = fps
+
+  def __iter__(self):
+    '''Yields a tuple `(fid, timestamp, frame)` for each frame, where fid is
+    the item id of recordings, or the frame index of videos.
+    '''
+
+    if osp.isdir(self.source):
+      yield from self._recording_frames()
+    else:
+      yield from self._video_frames()
+
+  def _recording_frames(self):
+    with ImageReader(self.source) as reader:
+      if is_chunked(self.source):
+        items = [(fid, f'{fid:05d}{reader.chunks.image_ext}') for fid in reader.chunks.items()]
+      else:
+        matches = [_FRAME_NAME.match(name) for name in os.listdir(self.source)]
+        items = sorted((int(m.group(1)), m.group(0)) for m in matches if m is not None)
+
+      for fid, image_name in items:
+        frame = reader.read(image_name, cv2.IMREAD_COLOR)
+        if frame is None:
+          rt_logger.warning(f'cannot read frame "{image_name}" in "{self.source}"')
+          continue
+        yield fid, fid / self.fps, frame
+
+  def _video_frames(self):
+    capture = cv2.VideoCapture(self.source)
+    if not capture.isOpened():
+      raise ValueError(f'cannot open video "{self.source}"')
+
+    try:
+      fid = 0
+      while True:
+        success, frame = capture.read()
+        if not success: break
+        yield fid, capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0, frame
+        fid += 1
+
+    finally:
+      capture.release()
+
+
+def replay_output_path(source):
+  '''Default output path, next to the source, namely `{source}-replay.npy`.'''
+
+  source = osp.normpath(source)
+  if osp.isfile(source):
+    source = osp.splitext(source)[0]
+
+  return f'{source}-replay.npy'
+
+
+class ReplayResults:
+  def __init__(self, stages=RESULT_STAGES):
+    '''Per-frame results of a replay, stored as the same records as those in
+    a `ResultRing`, where `seq` is the order of frames in the replay, and
+    `valid` marks frames with a prediction (`pog_scn` is zero if off screen).
+    '''
+
+    self.stages = tuple(stages)
+    self.dtype = result_dtype(self.stages)
+    self._chunks, self._count = [], 0
+
+  def __len__(self):
+    return self._count
+
+  def extend(self, fids, timestamps, results):
+    records = np.zeros(len(results), dtype=self.dtype)
+
+    records['seq'] = np.arange(self._count, self._count + len(results))
+    records['fid'] = fids
+    records['timestamp'] = timestamps
+
+    for record, result in zip(records, results):
+      record['valid'] = result['success']
+      if result['success']:
+        record['pog_cam'] = result['pog_cam'][:2]
+        if result['pog_scn'] is not None:
+          record['pog_scn'] = result['pog_scn'][:2]
+      record['stages'] = [result['stages'].get(name, 0) for name in self.stages]
+
+    self._chunks.append(records)
+    self._count += len(records)
+
+  def records(self):
+    if not self._chunks:
+      return np.empty((0, ), dtype=self.dtype)
+    return np.concatenate(self._chunks)
+
+  def save(self, output_path):
+    '''Save records as a structured array, loaded by `np.load`.'''
+
+    os.makedirs(osp.dirname(osp.abspath(output_path)), exist_ok=True)
+    np.save(output_path, self.records())
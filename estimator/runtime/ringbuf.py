@@ -0,0 +1,131 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+RESULT_STAGES = ('transform', 'color', 'align', 'crop', 'normalize', 'model', 'project')
+
+_HEADER_SIZE = 64  # Bytes reserved for the write cursor, one cache line
+
+
+def result_dtype(stages=RESULT_STAGES):
+  '''Layout of a result slot, stage timings are in nanoseconds.'''
+
+  return np.dtype([
+    ('seq', np.int64),        # Sequence number, -1 while being written
+    ('fid', np.int64),        # Frame id
+    ('timestamp', np.float64),  # Capture time of the frame, from time.time
+    ('valid', np.bool_),
+    ('pog_cam', np.float64, (2, )),
+    ('pog_scn', np.float64, (2, )),
+    ('stages', np.int64, (len(stages), )),
+  ], align=True)
+
+
+class ResultRing:
+  def __init__(self, capacity=256, stages=RESULT_STAGES, name=None):
+    '''Ring buffer of inference results in shared memory, written by a single
+    producer (the camera process) and read by consumers that follow sequence
+    numbers, without any lock.
+
+    Each slot is stamped with its sequence number after being written, and
+    marked as -1 while being written. A reader copies slots, then checks the
+    stamp again, so that slots overwritten in the meantime are reported as
+    missing instead of being read torn.
+
+    `capacity`: number of slots, namely the latest results kept.
+
+    `stages`: names of stage timings kept in each slot.
+
+    `name`: attach to an existing ring buffer, otherwise create a new one.
+    The ring buffer is attached by name when pickled to another process.
+    '''
+
+    self.capacity = capacity
+    self.stages = tuple(stages)
+    self.dtype = result_dtype(self.stages)
+
+    size = _HEADER_SIZE + self.dtype.itemsize * capacity
+    self.owner = name is None
+    if self.owner:
+      self.shm = shared_memory.SharedMemory(create=True, size=size)
+    else:
+      self.shm = shared_memory.SharedMemory(name=name)
+
+    self._header = np.ndarray((1, ), dtype=np.int64, buffer=self.shm.buf)
+    self._slots = np.ndarray((capacity, ), dtype=self.dtype, buffer=self.shm.buf, offset=_HEADER_SIZE)
+
+    if self.owner:
+      self._header[0] = 0
+      self._slots['seq'] = -1
+
+  def __reduce__(self):
+    return (self.__class__, (self.capacity, self.stages, self.shm.name))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  @property
+  def head(self):
+    '''Sequence number of the next result to be written.'''
+    return int(self._header[0])
+
+  def write(self, fid, timestamp, valid, pog_cam=None, pog_scn=None, stages=dict()):
+    '''Write a result to the next slot, returns its sequence number.
+
+    `timestamp`: capture time of the frame, from `time.time`.
+
+    `stages`: stage timings in nanoseconds, such as `result['stages']`.
+    '''
+
+    seq = int(self._header[0])
+    index = seq % self.capacity
+    slot = self._slots[index:index + 1]  # View, written in place
+
+    slot['seq'] = -1
+    slot['fid'] = fid
+    slot['timestamp'] = timestamp
+    slot['valid'] = valid
+    slot['pog_cam'] = pog_cam[:2] if pog_cam is not None else 0.0
+    slot['pog_scn'] = pog_scn[:2] if pog_scn is not None else 0.0
+    slot['stages'] = [stages.get(name, 0) for name in self.stages]
+    slot['seq'] = seq
+
+    self._header[0] = seq + 1
+
+    return seq
+
+  def read(self, start, stop=None):
+    '''Read results with sequence numbers in `[start, stop)`, where `stop`
+    defaults to the current head.
+
+    Returns the records (a structured array, copied) in order, and a list of
+    sequence numbers that are missing, as they were overwritten.
+    '''
+
+    head = self.head
+    stop = head if stop is None else min(stop, head)
+    start = max(start, 0)
+    if start >= stop:
+      return np.empty((0, ), dtype=self.dtype), []
+
+    # Results older than the capacity are overwritten for sure
+    kept = max(start, stop - self.capacity)
+    seqs = np.arange(kept, stop, dtype=np.int64)
+    indices = seqs % self.capacity
+
+    records = self._slots[indices]  # Copied by fancy indexing
+    intact = (records['seq'] == seqs) & (self._slots['seq'][indices] == seqs)
+
+    return records[intact], list(range(start, kept)) + seqs[~intact].tolist()
+
+  def close(self):
+    '''Detach from the shared memory, which is released by the owner.'''
+
+    self._header, self._slots = None, None
+    self.shm.close()
+    if self.owner:
+      self.shm.unlink()
@@ -3,6 +3,7 @@ import contextlib
 import functools
 import http.server as hs
 import socket
+import threading
 import websockets
 
 
@@ -71,3 +72,30 @@ async def websocket_server(ws_handler, host, port):
 
   async with websockets.serve(ws_handler, host, port):
     await stop_future # Run until stop future is resolved
+
+
+def forward_connection(conn, loop, callback):
+  '''Forward objects received from a multiprocessing connection to `callback`,
+  called on the event loop as soon as they arrive. A reader thread blocks on
+  the connection, which works with all event loops (eg. proactor on Windows).
+
+  `conn`: the read end of a `multiprocessing.Pipe`, read by this thread only.
+
+  `loop`: the running event loop of the caller.
+
+  `callback`: a callable that takes the received object.
+
+  Returns the reader thread, which stops once all write ends are closed.
+  '''
+
+  def read_loop():
+    try:
+      while True:
+        loop.call_soon_threadsafe(callback, conn.recv())
+    except (EOFError, OSError, RuntimeError):
+      pass  # Writers closed, or the event loop is closed
+
+  thread = threading.Thread(target=read_loop, daemon=True)
+  thread.start()
+
+  return thread
@@ -0,0 +1,204 @@
+from .log import runtime_logger
+
+import queue
+import threading
+import time
+
+
+rt_logger = runtime_logger(name='runtime').getChild('stages')
+
+
+_STOP = object()  # Sentinel that stops stage workers
+
+
+class StageStats:
+  def __init__(self, name):
+    self.name = name
+    self.items = 0
+    self.busy_time = 0.0
+    self.queue_sum = 0
+
+  def record(self, busy_time, queue_size):
+    self.items += 1
+    self.busy_time += busy_time
+    self.queue_sum += queue_size
+
+  def summary(self, elapsed):
+    return dict(
+      items=self.items,
+      busy_time=self.busy_time / max(self.items, 1),
+      occupancy=self.busy_time / elapsed if elapsed > 0 else 0.0,
+      queue_size=self.queue_sum / max(self.items, 1),
+    )
+
+
+class StagedExecutor:
+  def __init__(self, stages, depth=2):
+    '''Run a sequence of stages on items in order, each stage on its own
+    worker thread, so that stages of consecutive items overlap in time.
+
+    ```
+    with StagedExecutor([('a', fn_a), ('b', fn_b)], depth=2) as executor:
+      for item in items:
+        executor.submit(item)
+        for output in executor.completed():
+          ...
+    ```
+
+    `stages`: a list of `(name, fn)`, where `fn` takes the output of the
+    previous stage and returns the input of the next stage.
+
+    `depth`: max number of items waiting in front of each stage, submitting
+    more items blocks the caller until the first stage catches up.
+
+    Items still in flight once submission ends are yielded by `drain`, those
+    left behind on exit are dropped. If any stage fails, the other workers
+    stop as well, and the error is raised to the caller.
+    '''
+
+    self.stages = stages
+    self.depth = depth
+
+    # Queue i feeds stage i, the last queue collects outputs (unbounded)
+    self._queues = [queue.Queue(maxsize=depth) for _ in stages] + [queue.Queue()]
+    self._stats = [StageStats(name) for name, _ in stages]
+    self._workers = [
+      threading.Thread(target=self._work_loop, args=(index, ), daemon=True)
+      for index in range(len(stages))
+    ]
+
+    self._error = None
+    self._stopped = False
+    self._start_time = 0.0
+
+  def __enter__(self):
+    self._start_time = time.perf_counter()
+    for worker in self._workers: worker.start()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self._stop()
+    for worker in self._workers:
+      worker.join(timeout=5.0)  # Stage functions that never return are left behind
+      if worker.is_alive():
+        rt_logger.warning(f'stage worker "{worker.name}" did not stop, left running')
+
+    dropped = 0
+    while True:
+      try:
+        output = self._queues[-1].get_nowait()
+      except queue.Empty:
+        break
+      if output is not _STOP: dropped += 1
+    if dropped > 0:
+      rt_logger.warning(f'{dropped} outputs were not drained, which are dropped')
+
+    rt_logger.info(f'stage stats: {self.stats()}')
+
+  def _put(self, out_queue, item):
+    # Put the item, unless any stage fails meanwhile, returns False then
+    while self._error is None:
+      try:
+        out_queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass  # Wait for the next stage, unless any stage failed
+    return False
+
+  def _abort(self, out_queue):
+    # Wake the next stage up, which stops as well, as does any waiting caller
+    try:
+      out_queue.put_nowait(_STOP)
+    except queue.Full:
+      pass  # The next stage sees the error once its queue has been read
+
+  def _stop(self):
+    if self._stopped: return
+    self._stopped = True
+    self._put(self._queues[0], _STOP)
+
+  def _work_loop(self, index):
+    _, stage_fn = self.stages[index]
+    in_queue, out_queue = self._queues[index], self._queues[index + 1]
+
+    while True:
+      try:
+        item = in_queue.get(timeout=0.1)
+      except queue.Empty:
+        if self._error is None: continue
+        item = None
+
+      if item is _STOP:
+        if self._put(out_queue, _STOP): break
+      if self._error is not None:
+        self._abort(out_queue)
+        break
+
+      stage_start = time.perf_counter()
+      try:
+        output = stage_fn(item)
+      except Exception as ex:
+        self._error = ex
+        self._abort(out_queue)
+        break
+      self._stats[index].record(time.perf_counter() - stage_start, in_queue.qsize())
+
+      self._put(out_queue, output)
+
+  def _check_error(self):
+    if self._error is not None:
+      raise RuntimeError(f'stage worker failed, due to {self._error}') from self._error
+
+  def submit(self, item):
+    '''Submit an item to the first stage, blocks while its queue is full.'''
+
+    self._check_error()
+    if not self._put(self._queues[0], item):
+      self._check_error()
+
+  def completed(self, block=False, timeout=None):
+    '''Yield outputs of the last stage, in the order of submission. Only
+    available outputs are yielded, unless `block` is set, which waits for
+    the next output (up to `timeout` seconds).
+    '''
+
+    out_queue = self._queues[-1]
+
+    while True:
+      try:
+        output = out_queue.get(block=block, timeout=timeout)
+      except queue.Empty:
+        break
+      if output is _STOP: break
+
+      yield output
+      block = False
+
+    self._check_error()
+
+  def drain(self):
+    '''Stop accepting items, then yield outputs of all items in flight, in
+    the order of submission, until the last stage is done.
+    '''
+
+    self._stop()
+    out_queue = self._queues[-1]
+
+    while True:
+      try:
+        output = out_queue.get(timeout=0.1)
+      except queue.Empty:
+        if self._error is None: continue
+        break  # The sentinel may have been taken by `completed` already
+      if output is _STOP: break
+      yield output
+
+    self._check_error()
+
+  def stats(self):
+    '''Per-stage summary: number of items processed, mean busy time per item
+    in seconds, occupancy (fraction of time busy) and mean input queue size.
+    '''
+
+    elapsed = time.perf_counter() - self._start_time
+    return {stats.name: stats.summary(elapsed) for stats in self._stats}
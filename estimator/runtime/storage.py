@@ -1,62 +1,334 @@
+from .container import ChunkWriter
+from .framepool import FramePool
 from .log import runtime_logger
 
+import concurrent.futures as futures
 import cv2  # OpenCV-Python
 import datetime
+import functools
 import json
+import numpy as np
 import os
+import threading
+import time
 
 
 rt_logger = runtime_logger(name='runtime').getChild('storage')
 
 
+_IMAGE_FORMATS = {
+  'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+  'png': ('.png', None),    # Lossless, quality is ignored
+  'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
 def _dump_json(json_data, json_path):
   with open(json_path, 'w') as fp:
     json.dump(json_data, fp, indent=None)
 
 
 class FrameCache():
-  def __init__(self, max_count=600):
-    '''A simple FIFO cache with limited max size.'''
+  def __init__(self, max_count=600, retain=False):
+    '''A ring buffer of frames looked up by fid, backed by one array of shape
+    `(max_count, h, w, c)`, allocated on the first insert.
+
+    Frames are fetched in the order of their fids. Once a frame is fetched,
+    the frame and all older frames are dropped, unless `retain` is set. When
+    the cache is full, a new frame evicts the oldest one.
+    '''
 
-    self.frame_count = 0
     self.max_count = max_count
-    self.frame_cache = []
-    self.fid_cache = []
+    self.retain = retain
+
+    self._frames = None
+    self._fids = [None] * max_count
+    self._orders = np.full(max_count, -1, dtype=np.int64)
+    self._slots = dict()  # Fid -> slot
+    self._next_order = 0  # Insertion order of the next frame
+    self._min_order = 0   # Frames inserted before are dropped
+
+    self.hits, self.misses, self.evictions = 0, 0, 0
+
+  @property
+  def frame_count(self):
+    return min(self._next_order - self._min_order, self.max_count)
+
+  def _allocate(self, frame):
+    if self._frames is not None:
+      rt_logger.warning(f'frame shape changed to {frame.shape}, frame cache cleared')
+
+    self._frames = np.empty((self.max_count, *frame.shape), dtype=frame.dtype)
+    self._min_order = self._next_order
 
   def insert_frame(self, frame, fid):
-    if self.frame_count >= self.max_count:
-      self.frame_cache.pop(0)
-      self.fid_cache.pop(0)
-      self.frame_count -= 1
+    if self._frames is None or self._frames.shape[1:] != frame.shape:
+      self._allocate(frame)
+
+    slot = self._next_order % self.max_count
+    if self._orders[slot] >= self._min_order:
+      self.evictions += 1   # Overwrite a frame still in the cache
+
+    if self._slots.get(self._fids[slot], None) == slot:
+      del self._slots[self._fids[slot]]
+    self._slots[fid] = slot
+    self._fids[slot] = fid
 
-    self.frame_cache.append(frame)
-    self.fid_cache.append(fid)
-    self.frame_count += 1
+    np.copyto(self._frames[slot], frame)
+    self._orders[slot] = self._next_order
+    self._next_order += 1
 
   def fast_fetch(self, fid):
-    fetched_item = None
+    '''Returns the frame tagged `fid` (a view into the cache), or None if not
+    found. The view is valid until its slot is reused by a later insert.
+    '''
+
+    slot = self._slots.get(fid, None)
+    if slot is None or self._orders[slot] < self._min_order:
+      self.misses += 1
+      if not self.retain:
+        self._min_order = self._next_order
+      return None
+
+    self.hits += 1
+    if not self.retain:
+      self._min_order = int(self._orders[slot]) + 1
+
+    return self._frames[slot]
+
+  def stats(self):
+    '''Counters of fetch hits and misses, and frames evicted before fetched.'''
+    return dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+class RecordingWriter():
+  def __init__(self, image_format='jpg', quality=95, workers=2, queue_size=64,
+               container=False, chunk_size=256):
+    '''Encode and write frames on a thread pool, so that recording never
+    blocks the caller on disk, with at most `queue_size` frames pending.
+
+    `image_format`: image format of the written frames, 'jpg', 'png' or 'webp'.
+
+    `quality`: encoding quality (0-100) for 'jpg' and 'webp'.
+
+    `workers`: number of writer threads, OpenCV encodes without the GIL.
+
+    `queue_size`: max number of frames submitted but not yet written, which
+    are copied into as many preallocated frames, see `submit`.
+
+    `container`: append frames to chunk files of `chunk_size` MB with an
+    index, instead of writing an image file per frame.
+    '''
+
+    if image_format not in _IMAGE_FORMATS:
+      raise ValueError(f'unsupported image format "{image_format}"')
+
+    self.image_ext, quality_flag = _IMAGE_FORMATS[image_format]
+    self.params = [quality_flag, int(quality)] if quality_flag is not None else []
+    self.queue_size = queue_size
+
+    self.container = container
+    self.chunk_size = chunk_size << 20
+    self._chunks = None
+
+    self._executor = futures.ThreadPoolExecutor(workers, thread_name_prefix='recording')
+    self._cond = threading.Condition()
+    self._pending = 0
+    self._pool = None  # Copies of pending frames, allocated on the first submit
+
+    self.written, self.failed = 0, []
+    self.deferred, self.max_pending = 0, 0
+    self.write_time = 0.0
+
+  def full(self):
+    with self._cond:
+      return self._pending >= self.queue_size
+
+  def defer(self):
+    '''Count a frame that waits for a free slot (backpressure).'''
+    with self._cond:
+      self.deferred += 1
+
+  def open(self, folder):
+    '''Prepare for frames written to the recording folder.'''
+    if self.container:
+      self._chunks = ChunkWriter(folder, self.image_ext, self.chunk_size)
+
+  def _write(self, frame, frame_path, item_id):
+    write_start = time.perf_counter()
+
+    encoded, buffer = cv2.imencode(self.image_ext, frame, self.params)
+    if not encoded:
+      raise RuntimeError(f'cannot encode frame as "{self.image_ext}"')
+
+    if self._chunks is not None:
+      self._chunks.append(item_id, buffer)
+    else:
+      buffer.tofile(frame_path)
+
+    return time.perf_counter() - write_start
+
+  def _copy(self, frame):
+    if self._pool is None or (self._pool.shape, self._pool.dtype) != (frame.shape, frame.dtype):
+      # Frames still pending keep their memory once the former pool is closed
+      if self._pool is not None: self._pool.close()
+      self._pool = FramePool(self.queue_size, frame.shape, frame.dtype, register=False)
+
+    pool, buffer = self._pool, self._pool.acquire()
+    if buffer is None: return None, frame.copy()
+
+    np.copyto(buffer, frame)
+    return pool, buffer
+
+  def _done(self, item_id, frame_path, pool, buffer, on_written, future: futures.Future):
+    if pool is not None: pool.release(buffer)
 
-    try:  # Find the frame tagged 'fid'
-      item_idx = self.fid_cache.index(fid)
-      fetched_item = self.frame_cache[item_idx]
+    with self._cond:
+      self._pending -= 1
+      self._cond.notify_all()
 
-      self.frame_cache = self.frame_cache[item_idx + 1:]
-      self.fid_cache = self.fid_cache[item_idx + 1:]
-      self.frame_count -= (item_idx + 1)
+      try:
+        self.write_time += future.result()
+        self.written += 1
+      except Exception as ex:
+        self.failed.append(item_id)
+        rt_logger.warning(f'cannot save frame to path "{frame_path}", due to {ex}')
+        return
 
-    except ValueError:
-      self.frame_cache = []
-      self.fid_cache = []
-      self.frame_count = 0
+    if on_written is not None:
+      on_written(item_id)
 
-    return fetched_item
+  def submit(self, frame, frame_path, item_id, on_written=None):
+    '''Write the frame in the background, blocks while the queue is full.
+    The frame is copied before returning, so that views into a frame cache
+    may be submitted, even if their slots are overwritten before written.
+
+    `on_written`: called with `item_id` on a writer thread, once the frame
+    is written, frames failed to write are listed in `failed` instead.
+    '''
+
+    with self._cond:
+      self._cond.wait_for(lambda: self._pending < self.queue_size)
+      self._pending += 1
+      self.max_pending = max(self.max_pending, self._pending)
+
+    pool, buffer = self._copy(frame)
+    future = self._executor.submit(self._write, buffer, frame_path, item_id)
+    future.add_done_callback(functools.partial(self._done, item_id, frame_path, pool, buffer, on_written))
+
+  def close(self):
+    '''Wait for all pending frames to be written.'''
+    self._executor.shutdown(wait=True)
+    if self._chunks is not None:
+      self._chunks.close()
+    if self._pool is not None:
+      self._pool.close()
+      self._pool = None
+
+  def stats(self):
+    with self._cond:
+      return dict(
+        written=self.written, failed=len(self.failed),
+        deferred=self.deferred, max_pending=self.max_pending,
+        write_time=self.write_time / max(self.written, 1),
+      )
+
+
+class LabelJournal():
+  def __init__(self, journal_path, flush_count=16, flush_interval=1.0):
+    '''An append-only journal of labels in JSON Lines, so that labels of a
+    recording survive a crash. Events are flushed in batches, once every
+    `flush_count` events, and by a flusher thread once pending events are
+    `flush_interval` seconds old, as well as on close. Events may be
+    appended from any thread.
+
+    Each line is one of the following events:
+      {"target": {"tid": ..., "lx": ..., "ly": ...}}, a new target.
+      {"frame": fid, "target": index}, a frame written to disk, of the
+      target at `index` (0-based) in the journal, or the last target if
+      `target` is missing (journals written before frames were asynchronous).
+      {"drop": fid}, a frame failed to save, which is dropped (older journals).
+    '''
+
+    self.journal_path = journal_path
+    self.flush_count = flush_count
+    self.flush_interval = flush_interval
+
+    self._fp = open(journal_path, 'a', encoding='utf-8')
+    self._lock = threading.Lock()
+    self._pending = 0
+
+    self._closed = threading.Event()
+    self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+    self._flusher.start()
+
+  def _flush_loop(self):
+    # Events stay pending for at most `flush_interval`, even if no more arrive
+    while not self._closed.wait(self.flush_interval):
+      with self._lock:
+        if self._pending > 0: self._flush()
+
+  def _flush(self):
+    self._fp.flush()
+    self._pending = 0
+
+  def append(self, event: dict):
+    with self._lock:
+      self._fp.write(json.dumps(event, separators=(',', ':')) + '\n')
+      self._pending += 1
+      if self._pending >= self.flush_count: self._flush()
+
+  def flush(self):
+    with self._lock:
+      self._flush()
+
+  def close(self):
+    self._closed.set()
+    self._flusher.join()
+    with self._lock:
+      self._fp.close()
+
+
+def load_label_journal(journal_path):
+  '''Replay a labels journal into targets, as saved in `labels.json`. The
+  last line is ignored if it was cut short by a crash.
+  '''
+
+  targets, dropped = [], set()
+
+  with open(journal_path, 'r', encoding='utf-8') as fp:
+    for line in fp:
+      try:
+        event = json.loads(line)
+      except json.JSONDecodeError:
+        break  # Partially written line
+
+      if 'frame' in event:
+        targets[event.get('target', -1)]['fids'].append(event['frame'])
+      elif 'target' in event:
+        targets.append(dict(**event['target'], fids=[]))
+      elif 'drop' in event:
+        dropped.add(event['drop'])
+
+  # Frames are journaled once written, which may complete out of order
+  for target in targets:
+    target['fids'] = sorted(fid for fid in target['fids'] if fid not in dropped)
+
+  return targets
 
 
 class RecordingManager():
-  def __init__(self, root: str):
-    '''A simple recording manager based on time and item count.'''
+  def __init__(self, root: str, writer: RecordingWriter = None):
+    '''A simple recording manager based on time and item count. Frames are
+    written in the background if a writer is given, otherwise in place.
+
+    Labels are appended to a journal (`labels.jsonl`) as they arrive, which
+    is compacted into `labels.json` by `save_label`. Frames are journaled
+    once written to disk, so that the journal never lists missing frames.
+    '''
 
     self.root = os.path.abspath(root)
+    self.writer = writer
 
     try:
       os.makedirs(self.root, exist_ok=True)
@@ -77,25 +349,70 @@ class RecordingManager():
     except Exception as ex:
       rt_logger.warning(f'cannot make recording folder "{folder_path}", due to {ex}')
 
+    if self.writer is not None:
+      self.writer.open(folder_path)
+
+    self.journal = LabelJournal(os.path.join(folder_path, 'labels.jsonl'))
+
   def new_target(self, tid, lx, ly):
     self.targets.append(dict(tid=tid, lx=lx, ly=ly, fids=[]))
+    self.journal.append(dict(target=dict(tid=tid, lx=lx, ly=ly)))
 
   def new_frame(self):
     self.targets[-1]['fids'].append(self.item_count)
     self.item_count += 1
 
+  def frame_written(self, target, fid):
+    self.journal.append(dict(frame=fid, target=target))
+
   def save_frame(self, frame, image_ext='.jpg'):
+    if self.writer is not None:
+      image_ext = self.writer.image_ext
+
     frame_name = f'{self.item_count:05d}{image_ext}'
     frame_path = os.path.join(self.root, self.folder, frame_name)
 
+    on_written = functools.partial(self.frame_written, len(self.targets) - 1)
+
+    if self.writer is not None:
+      # Items are numbered in order, frames failed to write are dropped later
+      self.writer.submit(frame, frame_path, self.item_count, on_written)
+      self.new_frame()
+      return
+
     try:  # Save frame to the specified path
       encoded, buffer = cv2.imencode(image_ext, frame)
       if encoded:
         buffer.tofile(frame_path)
+        on_written(self.item_count)
         self.new_frame()
     except Exception as ex:
       rt_logger.warning(f'cannot save frame to path "{frame_path}", due to {ex}')
 
+  def close(self):
+    '''Wait for the writer, then drop frames failed to write from targets.'''
+
+    if self.writer is not None:
+      self.writer.close()
+      rt_logger.info('recording writer stats: {written} written, {failed} failed, '
+                     '{deferred} deferred, {max_pending} max pending, '
+                     '{write_time:.4f} s per frame'.format(**self.writer.stats()))
+
+      # Frames failed to write have never been journaled
+      failed = set(self.writer.failed)
+      for target in self.targets:
+        target['fids'] = [fid for fid in target['fids'] if fid not in failed]
+
+    self.journal.close()
+
   def save_label(self):
-    label_path = os.path.join(self.root, self.folder, 'labels.json')
-    _dump_json(self.targets, label_path)
+    '''Compact the labels journal into `labels.json`, once the recording is
+    closed, replacing the journal only after labels are saved.
+    '''
+
+    folder_path = os.path.join(self.root, self.folder)
+    label_path = os.path.join(folder_path, 'labels.json')
+
+    _dump_json(self.targets, label_path + '.tmp')
+    os.replace(label_path + '.tmp', label_path)
+    os.remove(self.journal.journal_path)
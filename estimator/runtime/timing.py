@@ -0,0 +1,78 @@
+import contextlib
+import numpy as np
+import time
+
+
+@contextlib.contextmanager
+def measure(timings, name):
+  '''Measure the elapsed time of a code block in nanoseconds (monotonic clock),
+  which is stored as `timings[name]`, unless `timings` is None.
+  '''
+
+  start = time.perf_counter_ns()
+  try:
+    yield
+  finally:
+    if timings is not None:
+      timings[name] = timings.get(name, 0) + time.perf_counter_ns() - start
+
+
+class StageTimer:
+  def __init__(self, window=300, log_interval=0.0):
+    '''Rolling latency statistics for named stages, over the last `window`
+    samples of each stage, measured in nanoseconds.
+
+    `window`: number of latest samples kept for each stage.
+
+    `log_interval`: seconds between two summaries logged by `maybe_log`,
+    no summary is logged if set to zero.
+    '''
+
+    self.window = window
+    self.log_interval = log_interval
+
+    self._samples = dict()  # Stage name -> (ring buffer, count)
+    self._last_log = time.monotonic()
+
+  def record(self, name, elapsed_ns):
+    if name not in self._samples:
+      self._samples[name] = [np.zeros(self.window, dtype=np.int64), 0]
+
+    samples = self._samples[name]
+    samples[0][samples[1] % self.window] = elapsed_ns
+    samples[1] += 1
+
+  def update(self, timings: dict):
+    '''Record timings of a frame, as measured by `measure`.'''
+    for name, elapsed_ns in timings.items():
+      self.record(name, elapsed_ns)
+
+  def summary(self, percentiles=(50, 95, 99)):
+    '''Latency percentiles for each stage in milliseconds, such as
+    `{'model': {'count': 300, 'p50': 8.1, 'p95': 9.6, 'p99': 12.0}}`.
+    '''
+
+    summary = dict()
+
+    for name, (buffer, count) in self._samples.items():
+      samples = buffer[:min(count, self.window)] / 1e6
+      values = np.percentile(samples, percentiles)
+      summary[name] = dict(count=count, **{f'p{p}': round(float(v), 3) for p, v in zip(percentiles, values)})
+
+    return summary
+
+  def format_summary(self):
+    return ', '.join(
+      '{}: {p50:.2f}/{p95:.2f}/{p99:.2f} ms'.format(name, **stats)
+      for name, stats in self.summary().items()
+    )
+
+  def maybe_log(self, logger):
+    '''Log the summary (p50/p95/p99), if `log_interval` seconds have passed.'''
+
+    if self.log_interval <= 0: return
+
+    now = time.monotonic()
+    if now - self._last_log >= self.log_interval:
+      logger.info(f'stage latency (p50/p95/p99): {self.format_summary()}')
+      self._last_log = now
@@ -1,4 +1,11 @@
+from .log import runtime_logger
+from .timing import StageTimer, measure
+
 import cv2
+import numpy as np
+
+
+rt_logger = runtime_logger(name='runtime').getChild('transform')
 
 
 class Transforms:
@@ -7,6 +14,7 @@ class Transforms:
 
   def __init__(self, **transform_config):
     self.transforms = []
+    self.names = []
 
     sort_fn = lambda k: transform_config[k]['index']
     for key in sorted(transform_config, key=sort_fn):
@@ -14,6 +22,7 @@ class Transforms:
       kwargs = {k:v for k, v in config.items() if k != 'index'}
       transform = self._TRANSFORMS[key](**kwargs)
       self.transforms.append(transform)
+      self.names.append(key)
 
   @classmethod
   def register(cls, obj=None, *, name='', force=False):
@@ -60,21 +69,44 @@ class Transforms:
       image = t.transform(image)
     return image
 
+  def compile(self, to_rgb=False, slots=1):
+    '''Compile the transform chain into an execution plan, see `TransformPlan`.
 
-def rescale_frame(image, src_res, tgt_res, resize=True):
-  '''Rescale source resolution to target resolution (crop + resize).'''
+    `to_rgb`: emit RGB images, for consumers that convert BGR images to RGB.
+
+    `slots`: number of output images in rotation, namely the max number of
+    transformed images in use at the same time.
+    '''
+
+    return TransformPlan(self, to_rgb, slots)
+
+
+def rescale_region(src_res, tgt_res):
+  '''Rows and columns (slices) of the source resolution, which are kept
+  when cropping to the aspect ratio of the target resolution.
+  '''
 
   src_asp = src_res[1] / src_res[0]
   tgt_asp = tgt_res[1] / tgt_res[0]
 
+  rows, cols = slice(0, src_res[0]), slice(0, src_res[1])
+
   if tgt_asp > src_asp:
     rescale_h = int(src_res[1] / tgt_asp)
     padding_h = (src_res[0] - rescale_h) // 2
-    image = image[padding_h:-padding_h, :]
+    rows = slice(padding_h, src_res[0] - padding_h)
   if tgt_asp < src_asp:
     rescale_w = int(src_res[0] * tgt_asp)
     padding_w = (src_res[1] - rescale_w) // 2
-    image = image[:, padding_w:-padding_w]
+    cols = slice(padding_w, src_res[1] - padding_w)
+
+  return rows, cols
+
+def rescale_frame(image, src_res, tgt_res, resize=True):
+  '''Rescale source resolution to target resolution (crop + resize).'''
+
+  rows, cols = rescale_region(src_res, tgt_res)
+  image = image[rows, cols]
 
   if resize:
     dsize = (tgt_res[1], tgt_res[0])
@@ -101,6 +133,253 @@ def equalize_frame(image, clahe, to_lab=cv2.COLOR_BGR2LAB, to_img=cv2.COLOR_LAB2
   return image
 
 
+class PlanOp:
+  def __init__(self, kind, sources, **params):
+    '''A step of a transform plan, which may fuse steps of several transforms.
+
+    `kind`: one of 'crop', 'resize', 'crop_resize', 'cvt', 'clahe', 'denoise',
+    or 'call' for transforms that cannot be planned.
+
+    `sources`: names of transforms that the step comes from.
+    '''
+
+    self.kind = kind
+    self.sources = list(sources)
+    self.params = params
+
+  @property
+  def label(self):
+    return '+'.join(dict.fromkeys(self.sources))
+
+  def describe(self):
+    p = self.params
+
+    if self.kind in ('crop', 'crop_resize'):
+      region = f'crop [{p["rows"].start}:{p["rows"].stop}, {p["cols"].start}:{p["cols"].stop}]'
+      return region if self.kind == 'crop' else f'{region} + resize {p["dsize"]}'
+    if self.kind == 'resize':
+      return f'resize {p["dsize"]}'
+    if self.kind == 'cvt':
+      return f'cvt {_CVT_NAMES.get(p["code"], p["code"])}'
+    if self.kind == 'clahe':
+      return 'clahe on channel 0'
+
+    return self.kind
+
+
+_CVT_NAMES = {
+  cv2.COLOR_BGR2RGB: 'BGR2RGB',  # Same code as RGB2BGR
+  cv2.COLOR_BGR2LAB: 'BGR2LAB',
+  cv2.COLOR_RGB2LAB: 'RGB2LAB',
+  cv2.COLOR_LAB2BGR: 'LAB2BGR',
+  cv2.COLOR_LAB2RGB: 'LAB2RGB',
+}
+
+# Adjacent color conversions (first, second) -> fused conversion, or None if
+# they cancel out, only channel swaps are fused, which are exact
+_CVT_FUSIONS = {
+  (cv2.COLOR_BGR2RGB, cv2.COLOR_BGR2RGB): None,
+  (cv2.COLOR_LAB2BGR, cv2.COLOR_BGR2RGB): cv2.COLOR_LAB2RGB,
+  (cv2.COLOR_LAB2RGB, cv2.COLOR_BGR2RGB): cv2.COLOR_LAB2BGR,
+  (cv2.COLOR_BGR2RGB, cv2.COLOR_BGR2LAB): cv2.COLOR_RGB2LAB,
+  (cv2.COLOR_BGR2RGB, cv2.COLOR_RGB2LAB): cv2.COLOR_BGR2LAB,
+}
+
+def fuse_plan_ops(ops):
+  '''Fuse a crop with the resize next to it, and adjacent color conversions.'''
+
+  fused = []
+
+  for op in ops:
+    prev = fused[-1] if fused else None
+
+    if prev is not None and prev.kind == 'crop' and op.kind == 'resize':
+      fused[-1] = PlanOp('crop_resize', prev.sources + op.sources, **prev.params, **op.params)
+      continue
+
+    if prev is not None and prev.kind == 'cvt' and op.kind == 'cvt':
+      codes = (prev.params['code'], op.params['code'])
+      if codes in _CVT_FUSIONS:
+        fused.pop()
+        if _CVT_FUSIONS[codes] is not None:
+          fused.append(PlanOp('cvt', prev.sources + op.sources, code=_CVT_FUSIONS[codes]))
+        continue
+
+    fused.append(op)
+
+  return fused
+
+def make_plan_step(op: PlanOp, shape, dtype, owned, scratch):
+  '''Build the step of a plan op for input images of `shape`, where `owned`
+  tells whether inputs are images owned by the plan, which pixel-wise steps
+  overwrite in place. Returns a tuple `(fn, out_shape, mode)`.
+  '''
+
+  p = op.params
+
+  if op.kind == 'crop':
+    out_shape = (p['rows'].stop - p['rows'].start, p['cols'].stop - p['cols'].start, *shape[2:])
+    return (lambda image: image[p['rows'], p['cols']]), out_shape, 'view'
+
+  if op.kind in ('resize', 'crop_resize'):
+    dst = np.empty((p['dsize'][1], p['dsize'][0], *shape[2:]), dtype=dtype)
+    region = (p['rows'], p['cols']) if op.kind == 'crop_resize' else (slice(None), slice(None))
+    fn = lambda image: cv2.resize(image[region], p['dsize'], dst=dst, interpolation=p['interpolation'])
+    return fn, dst.shape, 'new'
+
+  if op.kind == 'cvt':
+    dst = None if owned else np.empty(shape, dtype=dtype)
+    fn = lambda image: cv2.cvtColor(image, p['code'], dst=image if dst is None else dst)
+    return fn, shape, 'in place' if owned else 'new'
+
+  if op.kind == 'clahe':
+    # The first channel is equalized, other channels are left as they are
+    channel = scratch.setdefault(('channel', shape[:2]), np.empty(shape[:2], dtype=dtype))
+    dst = None if owned else np.empty(shape, dtype=dtype)
+    def fn(image):
+      if dst is not None:
+        np.copyto(dst, image)
+        image = dst
+      cv2.extractChannel(image, 0, dst=channel)
+      p['clahe'].apply(channel, dst=channel)
+      return cv2.insertChannel(channel, image, 0)
+    return fn, shape, 'in place' if owned else 'new'
+
+  if op.kind == 'denoise':
+    dst = np.empty(shape, dtype=dtype)
+    fn = lambda image: cv2.fastNlMeansDenoisingColored(
+      image, dst, p['h_lumin'], p['h_color'], p['psize'], p['wsize'],
+    )
+    return fn, shape, 'new'
+
+  # Transforms that cannot be planned, output shapes are found by a dry run
+  out_shape = p['fn'](np.zeros(shape, dtype=dtype)).shape
+  return p['fn'], out_shape, 'call'
+
+
+class TransformPlan:
+  def __init__(self, transforms: Transforms, to_rgb=False, slots=1):
+    '''Execution plan of a transform chain, which is compiled for the shape
+    of input images on the first image, and again if the shape changes.
+
+    Compared with `Transforms.transform`, the plan crops by slicing, then
+    resizes into a preallocated image, adjacent color conversions are fused
+    (eg. LAB -> BGR -> RGB), and pixel-wise steps run in place, so that a few
+    full-frame passes and allocations are saved for each frame.
+
+    Note that the output may be a view of the input image, or an image owned
+    by the plan, which is overwritten `slots` calls later.
+
+    `transforms`: the configured transform chain.
+
+    `to_rgb`: emit RGB images, converted along with the last color conversion.
+
+    `slots`: number of output images in rotation.
+    '''
+
+    self.transforms = transforms
+    self.to_rgb = to_rgb
+    self.slots = max(slots, 1)
+
+    self._input_key = None  # Shape and dtype of input images
+    self._steps = []        # Steps of each slot, as (op, fn, out_shape, mode)
+    self._next_slot = 0
+
+  def plan_ops(self, shape, dtype):
+    '''Fused plan ops of the transform chain for input images of `shape`.'''
+
+    ops = []
+
+    for name, t in zip(self.transforms.names, self.transforms.transforms):
+      if hasattr(t, 'plan_ops'):
+        t_ops, shape = t.plan_ops(shape)
+        ops.extend(PlanOp(kind, [name], **params) for kind, params in t_ops)
+      else:
+        ops.append(PlanOp('call', [name], fn=t.transform))
+        shape = t.transform(np.zeros(shape, dtype=dtype)).shape
+
+    if self.to_rgb:
+      ops.append(PlanOp('cvt', ['rgb'], code=cv2.COLOR_BGR2RGB))
+
+    return fuse_plan_ops(ops)
+
+  def compile(self, shape, dtype=np.uint8):
+    ops = self.plan_ops(shape, dtype)
+    scratch = dict()  # Scratch images, shared by slots as steps run one by one
+
+    self._steps = []
+    for _ in range(self.slots):
+      steps, out_shape, owned = [], shape, False
+      for op in ops:
+        fn, out_shape, mode = make_plan_step(op, out_shape, dtype, owned, scratch)
+        owned = mode in ('new', 'in place') or (owned and mode == 'view')
+        steps.append((op, fn, out_shape, mode))
+      self._steps.append(steps)
+
+    self._input_key = (tuple(shape), np.dtype(dtype))
+    self._next_slot = 0
+
+    rt_logger.info(f'transform plan compiled, {self.describe()}')
+
+  def transform(self, image):
+    '''Transform image of shape (h, w, c), as `Transforms.transform` does,
+    followed by a conversion to RGB if `to_rgb` is set.
+    '''
+
+    if (image.shape, image.dtype) != self._input_key:
+      self.compile(image.shape, image.dtype)
+
+    steps = self._steps[self._next_slot]
+    self._next_slot = (self._next_slot + 1) % self.slots
+
+    for _, fn, _, _ in steps:
+      image = fn(image)
+    return image
+
+  def describe(self):
+    '''Steps of the compiled plan, one line for each step, with transforms it
+    comes from, its output shape and how the output is written.
+    '''
+
+    if self._input_key is None:
+      return 'transform plan (not compiled)'
+
+    color = 'RGB' if self.to_rgb else 'BGR'
+    lines = [f'transform plan for {self._input_key[0]} to {color}, {self.slots} slots:']
+    for op, _, out_shape, mode in self._steps[0]:
+      lines.append(f'  {op.label}: {op.describe()} -> {out_shape} ({mode})')
+    if not self._steps[0]:
+      lines.append('  identity')
+
+    return '\n'.join(lines)
+
+  def benchmark(self, image, runs=100):
+    '''Latency of each step of the plan on the image, named after transforms
+    of the step, as well as the whole plan (`plan`) and the chain run by
+    `Transforms.transform` (`chain`), see `StageTimer.summary`.
+    '''
+
+    self.transform(image)  # Compile the plan for the image
+    timer = StageTimer(window=runs)
+
+    for _ in range(runs):
+      timings = dict()  # Steps from the same transforms are summed up
+
+      with measure(timings, 'chain'):
+        output = self.transforms.transform(image)
+        if self.to_rgb: output = cv2.cvtColor(output, cv2.COLOR_BGR2RGB)
+
+      with measure(timings, 'plan'):
+        output = image
+        for op, fn, _, _ in self._steps[0]:
+          with measure(timings, op.label):
+            output = fn(output)
+
+      timer.update(timings)
+
+    return timer.summary()
+
+
 @Transforms.register(name='rescale')
 class Rescale:
   def __init__(self, **transform_config):
@@ -109,6 +388,20 @@ class Rescale:
   def transform(self, image):
     return rescale_frame(image, image.shape[:2], **self.transform_config)
 
+  def plan_ops(self, shape):
+    # The crop is skipped if nothing is cropped, as is the resize if the size matches
+    tgt_res = tuple(self.transform_config['tgt_res'])
+    rows, cols = rescale_region(shape[:2], tgt_res)
+
+    ops, out_shape = [], (rows.stop - rows.start, cols.stop - cols.start, *shape[2:])
+    if out_shape[:2] != tuple(shape[:2]):
+      ops.append(('crop', dict(rows=rows, cols=cols)))
+    if self.transform_config.get('resize', True) and out_shape[:2] != tgt_res:
+      ops.append(('resize', dict(dsize=(tgt_res[1], tgt_res[0]), interpolation=cv2.INTER_CUBIC)))
+      out_shape = (*tgt_res, *shape[2:])
+
+    return ops, out_shape
+
 @Transforms.register(name='denoise')
 class Denoise:
   def __init__(self, **transform_config):
@@ -117,6 +410,9 @@ class Denoise:
   def transform(self, image):
     return denoise_frame(image, **self.transform_config)
 
+  def plan_ops(self, shape):
+    return [('denoise', dict(dict(psize=7, wsize=21), **self.transform_config))], shape
+
 @Transforms.register(name='equalize')
 class Equalize:
   def __init__(self, ccode='bgr', clahe=dict()):
@@ -132,3 +428,10 @@ class Equalize:
 
   def transform(self, image):
     return equalize_frame(image, self.clahe, **self.cvt)
+
+  def plan_ops(self, shape):
+    return [
+      ('cvt', dict(code=self.cvt['to_lab'])),
+      ('clahe', dict(clahe=self.clahe)),
+      ('cvt', dict(code=self.cvt['to_img'])),
+    ], shape
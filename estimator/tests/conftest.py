@@ -0,0 +1,72 @@
+import numpy as np
+import os.path as osp
+import pytest
+import sys
+
+
+# Tests import modules the way scripts do, from the estimator folder
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+
+FACE_SIZE = (8, 8)
+EYES_SIZE = (8, 8)
+
+
+def make_gaze_model(model_path, batch_size=None):
+  '''Save a toy gaze model with the inputs of the PoG estimation model, its
+  output (n, 2) mixes key points with mean values of crops, so that frames
+  with different inputs have different outputs.
+
+  `batch_size`: fixed batch axis, or None for a dynamic batch axis.
+  '''
+
+  onnx = pytest.importorskip('onnx')
+  from onnx import TensorProto, helper, numpy_helper
+
+  n = batch_size if batch_size is not None else 'n'
+  inputs = [
+    helper.make_tensor_value_info('face', TensorProto.FLOAT, [n, 3, FACE_SIZE[1], FACE_SIZE[0]]),
+    helper.make_tensor_value_info('reye', TensorProto.FLOAT, [n, 3, EYES_SIZE[1], EYES_SIZE[0]]),
+    helper.make_tensor_value_info('leye', TensorProto.FLOAT, [n, 3, EYES_SIZE[1], EYES_SIZE[0]]),
+    helper.make_tensor_value_info('kpts', TensorProto.FLOAT, [n, 8]),
+  ]
+  outputs = [helper.make_tensor_value_info('gaze', TensorProto.FLOAT, [n, 2])]
+
+  weight = np.linspace(-0.5, 0.5, 16, dtype=np.float32).reshape(8, 2)
+  initializers = [
+    numpy_helper.from_array(weight, 'weight'),
+    numpy_helper.from_array(np.array([-1, 1], dtype=np.int64), 'column'),
+  ]
+
+  nodes = [helper.make_node('MatMul', ['kpts', 'weight'], ['kpts_xy'])]
+  for name in ('face', 'reye', 'leye'):
+    nodes.extend([
+      helper.make_node('ReduceMean', [name], [f'{name}_mean'], axes=[1, 2, 3], keepdims=1),
+      helper.make_node('Reshape', [f'{name}_mean', 'column'], [f'{name}_column']),
+    ])
+  nodes.extend([
+    helper.make_node('Add', ['kpts_xy', 'face_column'], ['gaze_face']),
+    helper.make_node('Add', ['gaze_face', 'reye_column'], ['gaze_reye']),
+    helper.make_node('Add', ['gaze_reye', 'leye_column'], ['gaze']),
+  ])
+
+  graph = helper.make_graph(nodes, 'toy-gaze', inputs, outputs, initializers)
+  model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+  model.ir_version = 8
+  onnx.checker.check_model(model)
+  onnx.save_model(model, model_path)
+
+  return model_path
+
+
+@pytest.fixture
+def gaze_model(tmp_path):
+  '''Factory of toy gaze models, see `make_gaze_model`.'''
+
+  pytest.importorskip('onnxruntime')
+
+  def factory(batch_size=None):
+    suffix = batch_size if batch_size is not None else 'dynamic'
+    return make_gaze_model(str(tmp_path / f'gaze-{suffix}.onnx'), batch_size)
+
+  return factory
@@ -0,0 +1,114 @@
+from runtime import captures
+from runtime.captures import CaptureHandler
+
+import cv2
+import numpy as np
+import pytest
+import time
+import types
+
+
+class FakeCapture:
+  '''Capture of `n_frames` frames filled with their index, which reports
+  `size` as its frame size, while frames are (6, 8) if it is unknown.
+  '''
+
+  def __init__(self, size, n_frames=5):
+    self.size = size
+    self.n_frames = n_frames
+    self.reads = 0
+
+  def get(self, prop):
+    if prop == cv2.CAP_PROP_FRAME_HEIGHT: return float(self.size[0])
+    if prop == cv2.CAP_PROP_FRAME_WIDTH: return float(self.size[1])
+    return 0.0
+
+  def read(self, image=None):
+    if self.reads >= self.n_frames: return False, None
+
+    shape = (*self.size, 3) if self.size[0] > 0 else (6, 8, 3)
+    if image is None or image.shape != shape:
+      image = np.empty(shape, dtype=np.uint8)
+    image.fill(self.reads)
+    self.reads += 1
+
+    return True, image
+
+  def release(self):
+    pass
+
+
+def run_capture(capture, drop_stale, monkeypatch):
+  pools = []
+  frame_pool = captures.FramePool
+  def create_pool(*args, **kwargs):
+    pools.append(frame_pool(*args, **kwargs))
+    return pools[-1]
+  monkeypatch.setattr(captures, 'FramePool', create_pool)
+
+  consumed = []
+  def consumer(src_image, set_exit_cond, timestamp):
+    pooled = any(pool.slot_index(src_image) is not None for pool in pools)
+    consumed.append((int(src_image[0, 0, 0]), pooled))
+    set_exit_cond(consumed[-1][0] == capture.n_frames - 1)
+
+  builder = types.SimpleNamespace(build=lambda: capture, drop_stale=drop_stale, pool_size=4)
+  CaptureHandler(builder, consumer).main_loop()
+
+  return consumed, pools
+
+
+@pytest.mark.parametrize('drop_stale', [False, True])
+def test_frame_pool_sized_from_capture(monkeypatch, drop_stale):
+  capture = FakeCapture((4, 6))
+  consumed, pools = run_capture(capture, drop_stale, monkeypatch)
+
+  assert [pool.shape for pool in pools] == [(4, 6, 3)]
+  assert capture.reads == capture.n_frames
+  assert all(pooled for _, pooled in consumed)
+  if not drop_stale:
+    assert [value for value, _ in consumed] == list(range(capture.n_frames))
+
+def test_frame_pool_disabled_with_warning(monkeypatch):
+  warnings = []
+  monkeypatch.setattr(captures.rt_logger, 'warning', warnings.append)
+
+  capture = FakeCapture((0, 0))
+  consumed, pools = run_capture(capture, False, monkeypatch)
+
+  assert pools == [] and len(warnings) == 1
+  assert [value for value, _ in consumed] == list(range(capture.n_frames))
+
+def test_frame_pool_holds_frames_in_flight(monkeypatch):
+  estimator = pytest.importorskip('estimator')
+
+  pools = []
+  frame_pool = captures.FramePool
+  def create_pool(*args, **kwargs):
+    pools.append(frame_pool(*args, **kwargs))
+    return pools[-1]
+  monkeypatch.setattr(captures, 'FramePool', create_pool)
+
+  # Slow stages, so that frames in flight pile up to the bound of the executor
+  def slow_stage(frame):
+    time.sleep(0.005)
+    return frame
+  create_stages = lambda depth: [(f'stage{i}', slow_stage) for i in range(5)]
+
+  capture = FakeCapture((4, 6), n_frames=200)
+  builder = types.SimpleNamespace(build=lambda: capture, drop_stale=False, pool_size=4)
+
+  consumed = []
+  def consumer(src_image, set_exit_cond, pipeline, timestamp):
+    consumed.append(int(src_image[0, 0, 0]))
+    set_exit_cond(len(consumed) >= 40)
+
+  estimator.run_capture_loop(
+    builder, consumer, None, dict(enable=True, depth=1), create_stages,
+    output_fn=lambda frame: None,
+  )
+
+  assert builder.pool_size == estimator.frames_in_flight(5, 1) + 2
+  # Frames left in flight once exit is set complete on flush
+  assert consumed == list(range(capture.reads))
+  assert pools[0].stats()['exhausted'] == 0
@@ -0,0 +1,26 @@
+from annotate.io_pass import ExportImagesPass
+from runtime.container import ChunkWriter, ImageReader, is_chunked
+
+import cv2
+import numpy as np
+import os
+
+
+def test_export_images_replaces_chunk_files(tmp_path):
+  images_folder = tmp_path / 'images'
+  images_folder.mkdir()
+  frames = [np.full((6, 8, 3), value, dtype=np.uint8) for value in (10, 20, 30)]
+
+  # Chunks of a single frame each, namely several chunk files to remove
+  with ChunkWriter(str(images_folder), image_ext='.png', chunk_size=1) as writer:
+    for item_id, frame in enumerate(frames):
+      writer.append(item_id, cv2.imencode('.png', frame)[1])
+
+  ExportImagesPass(str(tmp_path), None).run()
+
+  assert not is_chunked(str(images_folder))
+  assert sorted(os.listdir(images_folder)) == ['00000.png', '00001.png', '00002.png']
+  with ImageReader(str(images_folder)) as reader:
+    assert reader.chunks is None
+    for item_id, frame in enumerate(frames):
+      np.testing.assert_array_equal(reader.read(f'{item_id:05d}.png'), frame)
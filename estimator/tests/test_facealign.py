@@ -0,0 +1,216 @@
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip('mediapipe')
+
+from mediapipe.framework.formats import landmark_pb2
+from runtime.facealign import real
+from runtime.facealign.real import FaceAlignment
+
+
+HEIGHT, WIDTH = 480, 640
+
+
+@pytest.fixture(scope='module')
+def alignment():
+  with FaceAlignment() as alignment:
+    yield alignment
+
+
+def synthetic_image(seed=0):
+  # Smooth texture, so that interpolation differences stay small
+  rng = np.random.default_rng(seed)
+  noise = rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+  return cv2.GaussianBlur(noise, (0, 0), 3.0)
+
+def synthetic_landmarks(center, radius, angle, seed=0):
+  '''Face mesh landmarks (478, 2) of an upright face scattered in a disk,
+  with eyes and irises placed as mediapipe does, rotated by `angle`.
+  '''
+
+  rng = np.random.default_rng(seed)
+  rho = radius * np.sqrt(rng.uniform(0, 1, 478))
+  phi = rng.uniform(0, 2 * np.pi, 478)
+  points = np.stack([rho * np.cos(phi), rho * np.sin(phi)], axis=1)
+
+  eyes = [
+    (real._RIGHT_EYE, real._RIGHT_EYE_CENTER, 133, -0.35),
+    (real._LEFT_EYE, real._LEFT_EYE_CENTER, 362, 0.35),
+  ]
+  for contour, eye_center, inner_corner, offset in eyes:
+    eye_xy = np.array([offset * radius, -0.2 * radius])
+    points[contour] = eye_xy + rng.uniform(-0.12, 0.12, (len(contour), 2)) * radius * [1.0, 0.4]
+    points[eye_center] = eye_xy
+    points[inner_corner] = eye_xy - [np.sign(offset) * 0.12 * radius, 0.0]
+
+  rad = np.deg2rad(angle)
+  rotation = np.array([[np.cos(rad), -np.sin(rad)], [np.sin(rad), np.cos(rad)]])
+  return np.dot(points, rotation.T) + np.array(center)
+
+
+def reference_face_crop(alignment: FaceAlignment, image, landmarks, theta,
+                        width_expand=1.6, hw_ratio=0.6):
+  '''The former pad-and-rotate path: pad the image to a `2*max(h, w)` square,
+  rotate it as a whole, then slice the crops. Returns `(crop, sas)` pairs.
+  '''
+
+  height, width, _ = image.shape
+
+  length = 2 * max(height, width)
+  a = int((length - width) / 2)
+  b = int((length - height) / 2)
+  padded = cv2.copyMakeBorder(image, b, b, a, a, cv2.BORDER_CONSTANT, None, value=(0, 0, 0))
+  M = alignment.get_rotation_matrix_2d((width/2 + a, height/2 + b), theta, scale=1.0)
+  rotated = cv2.warpAffine(padded, M, (width + 2*a, height + 2*b))
+
+  new_ldmks = alignment.apply_rotation_matrix_2d(M, landmarks + np.array([a, b]))
+  camera_center = [rotated.shape[1] / 2, rotated.shape[0] / 2]
+  camera_metric = max(height, width)
+
+  def crop_region(bbox):
+    x_min, y_min, x_max, y_max = bbox
+    sas = alignment._get_crop_shift_and_size(camera_center, bbox, camera_metric)
+    return rotated[y_min:y_max, x_min:x_max], sas
+
+  cx_min, cy_min, cx_max, cy_max = np.asarray(alignment._get_bbox_for_points(new_ldmks), dtype=int)
+  cy_max = cx_max - cx_min + cy_min
+  crops = [crop_region([cx_min, cy_min, cx_max, cy_max])]
+
+  for contour, eye_center in [(real._RIGHT_EYE, real._RIGHT_EYE_CENTER), (real._LEFT_EYE, real._LEFT_EYE_CENTER)]:
+    eye_bbox = alignment._get_bbox_for_points(new_ldmks[contour])
+    crop_bbox = alignment._get_eye_crop_bbox(new_ldmks[eye_center[0]], eye_bbox, width_expand, hw_ratio)
+    crops.append(crop_region(list(np.asarray(crop_bbox, dtype=int))))
+
+  norm_ldmks = (new_ldmks - np.array(camera_center)) / camera_metric
+
+  return crops, norm_ldmks
+
+
+FACES = [
+  ((320, 240), 80, 0.0),     # Upright face at the center
+  ((300, 260), 90, 12.0),    # Rotated faces
+  ((340, 220), 70, -25.0),
+  ((330, 250), 100, 40.0),
+  ((30, 240), 80, 8.0),      # Faces across frame borders
+  ((620, 40), 90, -15.0),
+  ((320, 470), 110, 20.0),
+]
+
+
+@pytest.mark.parametrize('center, radius, angle', FACES)
+def test_face_crop_matches_pad_and_rotate(alignment, center, radius, angle):
+  image = synthetic_image()
+  landmarks = synthetic_landmarks(center, radius, angle)
+  theta = alignment._get_rotation_angle(landmarks[133], landmarks[362])
+
+  reference, ref_norm_ldmks = reference_face_crop(alignment, image, landmarks, theta)
+  crops, norm_ldmks, _ = alignment.get_face_crop(image, landmarks, theta)
+
+  np.testing.assert_array_equal(norm_ldmks, ref_norm_ldmks)
+  for crop, (ref_crop, ref_sas) in zip(crops, reference):
+    np.testing.assert_array_equal(crop.get_sas(), ref_sas)
+
+    # Fixed-point rounding of warpAffine differs by at most one grey level
+    assert crop.get_crop().shape == ref_crop.shape
+    diff = np.abs(crop.get_crop().astype(np.int16) - ref_crop)
+    assert diff.max() <= 1
+
+@pytest.mark.parametrize('center, radius, angle', FACES)
+def test_face_crop_resized_within_warp(alignment, center, radius, angle):
+  image = synthetic_image()
+  landmarks = synthetic_landmarks(center, radius, angle)
+  theta = alignment._get_rotation_angle(landmarks[133], landmarks[362])
+  face_size, eyes_size = (224, 224), (60, 36)
+
+  reference, ref_norm_ldmks = reference_face_crop(alignment, image, landmarks, theta)
+  crops, norm_ldmks, _ = alignment.get_face_crop(
+    image, landmarks, theta, face_size=face_size, eyes_size=eyes_size,
+  )
+
+  np.testing.assert_array_equal(norm_ldmks, ref_norm_ldmks)
+  for crop, (ref_crop, ref_sas), size in zip(crops, reference, [face_size, eyes_size, eyes_size]):
+    np.testing.assert_array_equal(crop.get_sas(), ref_sas)
+
+    # Sampled once instead of rotated then resized, thus within interpolation tolerance
+    ref_resized = cv2.resize(ref_crop, size, interpolation=cv2.INTER_CUBIC)
+    assert crop.get_crop().shape == ref_resized.shape
+    diff = np.abs(crop.get_crop().astype(np.int16) - ref_resized)
+    assert diff.mean() < 1.5
+
+
+def landmark_list(n_ldmks=478, with_z=True, seed=0):
+  rng = np.random.default_rng(seed)
+  landmarks = landmark_pb2.NormalizedLandmarkList()
+  for x, y, z in rng.uniform(-0.5, 1.5, (n_ldmks, 3)).astype(np.float32):
+    landmark = landmarks.landmark.add(x=x, y=y)
+    if with_z: landmark.z = z
+  return landmarks
+
+def landmark_attributes(landmarks):
+  # Decoded by attributes, as mediapipe solutions do
+  return np.array([(l.x, l.y, l.z) for l in landmarks.landmark], dtype=np.float32)
+
+
+def test_unpack_landmark_list_matches_attributes():
+  landmarks = landmark_list()
+  out = np.empty((478, 3), dtype=np.float32)
+
+  assert real._unpack_landmark_list(landmarks, out)
+  np.testing.assert_array_equal(out, landmark_attributes(landmarks))
+
+def test_unpack_landmark_list_with_visibility():
+  # Trailing fields after (x, y, z) keep the layout, with a longer stride
+  landmarks = landmark_list()
+  for landmark in landmarks.landmark:
+    landmark.visibility, landmark.presence = 0.5, 0.25
+  out = np.empty((478, 3), dtype=np.float32)
+
+  assert real._unpack_landmark_list(landmarks, out)
+  np.testing.assert_array_equal(out, landmark_attributes(landmarks))
+
+def test_parse_landmarks_falls_back_once(alignment, monkeypatch):
+  # Landmarks without z break the layout, which are decoded one by one
+  warnings = []
+  monkeypatch.setattr(real.rt_logger, 'warning', warnings.append)
+  monkeypatch.setattr(alignment, '_ldmk_fallback', False)
+
+  for seed in range(3):
+    landmarks = landmark_list(with_z=False, seed=seed)
+    assert not real._unpack_landmark_list(landmarks, np.empty((478, 3), dtype=np.float32))
+
+    parsed = alignment._parse_mediapipe_landmarks(landmarks)
+    np.testing.assert_array_equal(parsed, landmark_attributes(landmarks)[:, :2])
+
+  assert len(warnings) == 1
+
+
+def marker_landmarks(image, radius=40):
+  # Landmarks of an upright face centered on the marker pixel of the image
+  markers = np.argwhere(image[:, :, 0] == 255)
+  if len(markers) == 0: return None
+  y, x = markers[0]
+  return synthetic_landmarks((x, y), radius, 0.0)
+
+@pytest.mark.parametrize('static_image_mode', [True, False])
+def test_roi_landmarks_in_frame_coordinates(monkeypatch, static_image_mode):
+  with FaceAlignment(static_image_mode=static_image_mode, roi_tracking=True) as alignment:
+    meshes = []
+    def detect_landmarks(image, face_mesh=None):
+      meshes.append((image.shape[:2] == (HEIGHT, WIDTH), face_mesh))
+      return marker_landmarks(image)
+    monkeypatch.setattr(alignment, '_detect_landmarks', detect_landmarks)
+
+    # The face moves within the region, then jumps out of it
+    for center in [(320, 240), (340, 250), (360, 230), (600, 30), (590, 40)]:
+      image = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+      image[center[1], center[0]] = 255
+      landmarks, _ = alignment.process(image)
+
+      np.testing.assert_allclose(landmarks, synthetic_landmarks(center, 40, 0.0))
+
+    # Regions are processed by a face mesh in static image mode
+    roi_mesh = alignment._roi_mesh
+    assert [full for full, _ in meshes] == [True, False, False, False, True, False]
+    assert all(mesh is (None if full else roi_mesh) for full, mesh in meshes)
+    assert (roi_mesh is alignment._face_mesh) == static_image_mode
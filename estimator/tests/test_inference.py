@@ -0,0 +1,104 @@
+from conftest import EYES_SIZE, FACE_SIZE
+
+from runtime import one_euro
+from runtime.inference import Inferencer
+from runtime.pipeline import load_onnx_model
+
+import numpy as np
+import pytest
+import types
+
+
+class StubCrop:
+  def __init__(self, crop, sas):
+    self._crop, self._sas = crop, sas
+
+  def get_crop(self):
+    return self._crop
+
+  def get_sas(self):
+    return self._sas
+
+
+class StubAlignment:
+  '''Face alignment derived from pixel values of the image, where images
+  filled with zeros have no face, so that tests run without mediapipe.
+  '''
+
+  def process(self, image):
+    value = float(image[0, 0, 0])
+    if value == 0: return [], 0.0
+    return np.full((478, 2), value / 255.0), value / 20.0
+
+  def get_face_crop(self, image, landmarks, theta, hw_ratio=1.0, warp=True,
+                    face_size=FACE_SIZE, eyes_size=EYES_SIZE):
+    value = int(image[0, 0, 0])
+    sas = np.array([value / 255.0, 1.0 - value / 255.0, 0.5, 0.5])
+    crops = [
+      StubCrop(np.full((size[1], size[0], 3), value + offset, dtype=np.uint8), sas)
+      for offset, size in enumerate([face_size, eyes_size, eyes_size])
+    ]
+    return crops, landmarks, landmarks
+
+
+def create_inferencer():
+  return Inferencer(
+    topleft_offset=(-10.0, 10.0), screen_size_px=(200, 300), screen_size_cm=(20.0, 30.0),
+    face_resize=FACE_SIZE, eyes_resize=EYES_SIZE,
+    gx_filt_params=dict(beta=0.5, min_cutoff=0.5, clock=True),
+    gy_filt_params=dict(beta=0.5, min_cutoff=0.5, clock=True),
+  )
+
+def create_images(values):
+  return [np.full((16, 16, 3), value, dtype=np.uint8) for value in values]
+
+
+@pytest.mark.parametrize('batch_size', [None, 1, 2, 3])
+def test_run_batch_matches_run(gaze_model, monkeypatch, batch_size):
+  # Frames without a face are skipped, the last chunk of fixed batches is partial
+  images = create_images([40, 0, 80, 120, 160, 0, 200, 220, 240])
+  timestamps = [0.1 * index for index in range(len(images))]
+
+  # Filters in `run` read the clock, which ticks with timestamps of frames
+  clock = types.SimpleNamespace(now=0.0)
+  monkeypatch.setattr(one_euro, 'time', types.SimpleNamespace(time=lambda: clock.now))
+
+  expected = []
+  inferencer = create_inferencer()
+  model = load_onnx_model(gaze_model())
+  for image, timestamp in zip(images, timestamps):
+    clock.now = timestamp
+    expected.append(inferencer.run(model, StubAlignment(), image, to_rgb=False))
+
+  inferencer = create_inferencer()
+  model = load_onnx_model(gaze_model(batch_size))
+  results = inferencer.run_batch(model, StubAlignment(), images, timestamps, to_rgb=False)
+
+  assert [r['success'] for r in results] == [r['success'] for r in expected]
+  for result, reference in zip(results, expected):
+    if not reference['success']: continue
+    np.testing.assert_allclose(result['pog_cam'], reference['pog_cam'], rtol=1e-5, atol=1e-5)
+    assert reference['pog_scn'] is not None
+    assert result['pog_scn'] == reference['pog_scn']
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+def test_run_batch_with_io_binding(gaze_model, batch_size):
+  # Bound sessions reuse output arrays, which must not be shared by chunks
+  images = create_images([40, 80, 0, 120, 160, 200])
+  timestamps = [0.1 * index for index in range(len(images))]
+
+  model_path = gaze_model(batch_size)
+  expected = create_inferencer().run_batch(
+    load_onnx_model(model_path), StubAlignment(), images, timestamps, to_rgb=False,
+  )
+  results = create_inferencer().run_batch(
+    load_onnx_model(model_path, io_binding=True), StubAlignment(), images, timestamps, to_rgb=False,
+  )
+
+  pog_cams = [tuple(result['pog_cam']) for result in results if result['success']]
+  assert len(set(pog_cams)) == len(pog_cams)
+  for result, reference in zip(results, expected):
+    assert result['success'] == reference['success']
+    if not reference['success']: continue
+    np.testing.assert_array_equal(result['pog_cam'], reference['pog_cam'])
+    assert result['pog_scn'] == reference['pog_scn']
@@ -0,0 +1,62 @@
+from runtime.stages import StagedExecutor
+
+import pytest
+import threading
+import time
+
+
+def run_with_timeout(fn, timeout=10.0):
+  # Shutdown must never hang, which fails the test instead
+  outcome = dict()
+  def target():
+    try:
+      outcome['result'] = fn()
+    except Exception as ex:
+      outcome['error'] = ex
+  thread = threading.Thread(target=target, daemon=True)
+  thread.start()
+  thread.join(timeout)
+  assert not thread.is_alive(), 'executor did not shut down'
+  return outcome
+
+
+def slow_stage(item):
+  time.sleep(0.01)
+  return item
+
+
+def test_drain_yields_items_in_flight():
+  stages = [('a', slow_stage), ('b', lambda item: item * 10)]
+
+  def run():
+    outputs = []
+    with StagedExecutor(stages, depth=2) as executor:
+      for item in range(4):
+        executor.submit(item)
+        outputs.extend(executor.completed())
+      outputs.extend(executor.drain())
+      assert executor._queues[-1].empty()
+    return outputs
+
+  outcome = run_with_timeout(run)
+  assert outcome['result'] == [0, 10, 20, 30]
+
+@pytest.mark.parametrize('drain', [True, False])
+def test_stage_failure_during_shutdown(drain):
+  def failing_stage(item):
+    if item == 3: raise ValueError('stage failed')
+    return slow_stage(item)
+
+  stages = [('a', lambda item: item), ('b', failing_stage), ('c', slow_stage)]
+
+  def run():
+    outputs = []
+    with StagedExecutor(stages, depth=1) as executor:
+      for item in range(6):
+        executor.submit(item)
+      if drain: outputs.extend(executor.drain())
+    return outputs
+
+  outcome = run_with_timeout(run)
+  if drain:
+    assert isinstance(outcome['error'], RuntimeError)
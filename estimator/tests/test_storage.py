@@ -0,0 +1,114 @@
+from runtime import framepool, storage
+from runtime.storage import (
+  FrameCache,
+  LabelJournal,
+  RecordingManager,
+  RecordingWriter,
+  load_label_journal,
+)
+
+import cv2
+import numpy as np
+import os.path as osp
+import threading
+import time
+
+
+def test_submit_copies_cached_frame(tmp_path, monkeypatch):
+  # Encoding waits until the cache slot of the frame has been overwritten
+  overwritten = threading.Event()
+  imencode = cv2.imencode
+  def blocked_imencode(*args):
+    assert overwritten.wait(timeout=5.0)
+    return imencode(*args)
+  monkeypatch.setattr(storage.cv2, 'imencode', blocked_imencode)
+
+  frames = [np.full((8, 8, 3), value, dtype=np.uint8) for value in (10, 20, 30, 40)]
+  cache = FrameCache(max_count=2)
+  writer = RecordingWriter(image_format='png', workers=1, queue_size=2)
+
+  paths = []
+  for fid, frame in enumerate(frames):
+    cache.insert_frame(frame, fid)
+    if fid < 2:
+      paths.append(str(tmp_path / f'{fid:05d}.png'))
+      writer.submit(cache.fast_fetch(fid), paths[-1], fid)
+
+  overwritten.set()
+  writer.close()
+
+  assert writer.stats()['written'] == 2
+  for path, frame in zip(paths, frames):
+    np.testing.assert_array_equal(cv2.imread(path), frame)
+
+
+def test_writer_pool_is_private(tmp_path):
+  # Frames of other shapes replace the pool, frames pending keep their memory
+  writer = RecordingWriter(image_format='png', workers=1, queue_size=2)
+  frames = [np.full(shape, 50, dtype=np.uint8) for shape in [(8, 8, 3), (8, 8, 3), (6, 4, 3)]]
+
+  pools = []
+  for fid, frame in enumerate(frames):
+    writer.submit(frame, str(tmp_path / f'{fid:05d}.png'), fid)
+    if writer._pool not in pools: pools.append(writer._pool)
+    assert writer._pool not in framepool._LIVE_POOLS
+  writer.close()
+
+  assert len(pools) == 2 and pools[0]._slots is None
+  for fid, frame in enumerate(frames):
+    np.testing.assert_array_equal(cv2.imread(str(tmp_path / f'{fid:05d}.png')), frame)
+
+def test_frames_journaled_once_written(tmp_path, monkeypatch):
+  # Encoding waits, as if the recording crashed before frames were written
+  released = threading.Event()
+  imencode = cv2.imencode
+  def blocked_imencode(*args):
+    assert released.wait(timeout=5.0)
+    return imencode(*args)
+  monkeypatch.setattr(storage.cv2, 'imencode', blocked_imencode)
+
+  manager = RecordingManager(str(tmp_path), RecordingWriter(image_format='png', workers=2))
+  manager.new_recording('recording')
+  journal_path = osp.join(tmp_path, 'recording', 'labels.jsonl')
+
+  for tid in range(2):
+    manager.new_target(tid, 0.1 * tid, 0.2 * tid)
+    for value in (10, 20, 30):
+      manager.save_frame(np.full((8, 8, 3), value + tid, dtype=np.uint8))
+
+  manager.journal.flush()
+  assert [t['fids'] for t in load_label_journal(journal_path)] == [[], []]
+
+  released.set()
+  manager.close()
+
+  targets = load_label_journal(journal_path)
+  assert [t['fids'] for t in targets] == [[0, 1, 2], [3, 4, 5]]
+  assert [t['tid'] for t in targets] == [0, 1]
+  for target in targets:
+    for fid in target['fids']:
+      assert osp.isfile(osp.join(tmp_path, 'recording', f'{fid:05d}.png'))
+
+def test_journal_flushed_without_new_events(tmp_path):
+  journal_path = str(tmp_path / 'labels.jsonl')
+  journal = LabelJournal(journal_path, flush_count=16, flush_interval=0.05)
+  try:
+    journal.append(dict(target=dict(tid=0, lx=0.5, ly=0.5)))
+    journal.append(dict(frame=0, target=0))
+
+    deadline = time.monotonic() + 5.0
+    while time.monotonic() < deadline and not load_label_journal(journal_path):
+      time.sleep(0.01)
+    assert [t['fids'] for t in load_label_journal(journal_path)] == [[0]]
+  finally:
+    journal.close()
+
+def test_load_label_journal_of_older_format(tmp_path):
+  # Frames of the last target, and frames dropped once failed to write
+  journal_path = tmp_path / 'labels.jsonl'
+  journal_path.write_text('\n'.join([
+    '{"target":{"tid":0,"lx":0.1,"ly":0.2}}', '{"frame":0}', '{"frame":1}',
+    '{"target":{"tid":1,"lx":0.3,"ly":0.4}}', '{"frame":2}', '{"drop":1}', '{"fra',
+  ]))
+
+  assert [t['fids'] for t in load_label_journal(str(journal_path))] == [[0], [2]]
@@ -1,15 +1,70 @@
+/**
+ * Binary gaze frames (little-endian), negotiated after the server hello
+ *
+ * Each frame contains a header and several records:
+ *   1. header: version (u8), kind (u8), count (u16)
+ *   2. record: seq (u32), fid (u32), timestamp (f64), gx (f32), gy (f32),
+ *      valid (u8), padding (3 bytes)
+ */
+const GAZE_PROTOCOL_VERSION = 1
+const GAZE_HEADER_SIZE = 4
+const GAZE_RECORD_SIZE = 28
+
 class SocketManager {
   constructor() {
     this.socket = undefined
     this.onMessage = (msgObj) => {}
+    this.gazeBatch = 32
   }
 
   startSocket(host, port) {
     this.socket = new WebSocket(`ws://${host}:${port}/`)
+    this.socket.binaryType = 'arraybuffer'
     this.socket.onmessage = (event) => {
-      const msgObj = JSON.parse(event.data)
-      this.onMessage(msgObj)
+      if (event.data instanceof ArrayBuffer) {
+        this.decodeGazeFrame(event.data).forEach((msgObj) => this.onMessage(msgObj))
+      } else {
+        const msgObj = JSON.parse(event.data)
+        if (msgObj.status == 'server_on') this.negotiateProtocol(msgObj)
+        this.onMessage(msgObj)
+      }
+    }
+  }
+
+  negotiateProtocol(helloObj) {
+    // Servers without the binary protocol keep sending JSON messages
+    const binary = (helloObj.protocols || {}).binary
+
+    if (binary !== undefined && binary.version == GAZE_PROTOCOL_VERSION) {
+      this.sendMessage({opcode: 'use_protocol', protocol: 'binary', batch: this.gazeBatch})
+    }
+  }
+
+  decodeGazeFrame(buffer) {
+    // Records are decoded as 'next_ready' messages, as sent in JSON
+    const view = new DataView(buffer)
+    const count = view.getUint16(2, true)
+    const msgObjs = []
+
+    for (let i = 0; i < count; i++) {
+      const offset = GAZE_HEADER_SIZE + i * GAZE_RECORD_SIZE
+
+      const msgObj = {
+        status: 'next_ready',
+        seq: view.getUint32(offset, true),
+        fid: view.getUint32(offset + 4, true),
+        timestamp: view.getFloat64(offset + 8, true),
+        valid: view.getUint8(offset + 24) != 0,
+      }
+      if (msgObj.valid) {
+        msgObj.gx = view.getFloat32(offset + 16, true)
+        msgObj.gy = view.getFloat32(offset + 20, true)
+      }
+
+      msgObjs.push(msgObj)
     }
+
+    return msgObjs
   }
 
   setOnMessage(onMessage) {